@@ -0,0 +1,138 @@
+'''
+Sending email through an outbox.
+
+With settings.EMAIL_OUTBOX, queue_mail stores the rendered message as an
+OutboxEmail in the current transaction instead of sending it, so alarm
+evaluation and requests don't wait on the mail server, and an email is only
+sent if what it reports was committed. dispatch_email sends pending emails
+in batches over one connection, at most EMAIL_OUTBOX_RATE per second, and
+retries failures with a backoff. Batches are claimed rather than locked
+while they are sent, so no transaction waits on the mail server. Without
+EMAIL_OUTBOX, emails are sent right away as before.
+'''
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+
+from core.models import OutboxEmail
+
+from datetime import datetime, timedelta
+import pytz
+import time
+
+
+# longest wait between attempts
+MAX_BACKOFF = timedelta(hours=1)
+# how long claimed emails are left to a dispatcher, on top of the time its
+# batch takes at the rate limit
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def build_message(subject, message, from_email, recipient_list,
+                  html_message=None, connection=None):
+    msg = EmailMultiAlternatives(subject, message, from_email,
+                                 recipient_list, connection=connection)
+    if html_message:
+        msg.attach_alternative(html_message, 'text/html')
+    return msg
+
+
+def queue_mail(subject, message, from_email, recipient_list,
+               html_message=None, outbox=None):
+    '''
+    Same as django's send_mail (without fail_silently): queue the email in
+    the outbox, or send it when the outbox isn't enabled. outbox overrides
+    settings.EMAIL_OUTBOX, e.g. so the emails of a dry run are rolled back
+    '''
+    if outbox is None:
+        outbox = settings.EMAIL_OUTBOX
+    if not outbox:
+        return build_message(subject, message, from_email, recipient_list,
+                             html_message).send()
+    OutboxEmail.objects.create(
+        subject=subject, body=message, html_body=html_message or '',
+        from_email=from_email or '', to=list(recipient_list),
+        next_attempt_at=datetime.now(tz=pytz.UTC))
+    return 1
+
+
+def backoff(attempts):
+    ''' wait before the next attempt, doubling from a minute '''
+    return min(timedelta(minutes=2 ** (attempts - 1)), MAX_BACKOFF)
+
+
+def claim_batch(batch_size, lease):
+    '''
+    The pending emails that are due, batch_size at most, with their next
+    attempt put off by lease so other dispatchers skip them until they are
+    marked sent or failed (or the dispatcher died and the lease ran out)
+    '''
+    now = datetime.now(tz=pytz.UTC)
+    with transaction.atomic():
+        batch = list(OutboxEmail.objects.select_for_update(
+            skip_locked=True).filter(
+            status=OutboxEmail.Status.PENDING,
+            next_attempt_at__lte=now).order_by(
+            'next_attempt_at', 'id')[:batch_size])
+        OutboxEmail.objects.filter(
+            id__in=[email.id for email in batch]).update(
+            next_attempt_at=now + lease)
+    return batch
+
+
+def mark_failed(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.status = OutboxEmail.Status.FAILED
+    email.next_attempt_at = datetime.now(tz=pytz.UTC) + \
+        backoff(email.attempts)
+    email.save()
+
+
+def dispatch_outbox(batch_size=50, rate=None, max_attempts=None):
+    '''
+    Send the pending emails that are due, batch_size at a time over one
+    connection. A batch is claimed in a short transaction and sent outside
+    of it, then each email is marked sent or failed. If the mail server
+    can't be reached, the batch counts as a failed attempt and the rest
+    waits for the next run. Returns the numbers of emails sent and failed
+    attempts
+    '''
+    rate = rate or settings.EMAIL_OUTBOX_RATE
+    max_attempts = max_attempts or settings.EMAIL_OUTBOX_MAX_ATTEMPTS
+    lease = CLAIM_TIMEOUT + timedelta(seconds=batch_size / rate)
+    sent, failed = 0, 0
+    while True:
+        batch = claim_batch(batch_size, lease)
+        if not batch:
+            break
+        try:
+            connection = get_connection()
+            connection.open()
+        except Exception as e:
+            for email in batch:
+                mark_failed(email, e, max_attempts)
+            return sent, failed + len(batch)
+        try:
+            for email in batch:
+                started = time.monotonic()
+                try:
+                    build_message(
+                        email.subject, email.body, email.from_email,
+                        email.to, email.html_body,
+                        connection=connection).send()
+                except Exception as e:
+                    failed += 1
+                    mark_failed(email, e, max_attempts)
+                else:
+                    sent += 1
+                    email.attempts += 1
+                    email.status = OutboxEmail.Status.SENT
+                    email.sent_at = datetime.now(tz=pytz.UTC)
+                    email.save()
+                # rate limit
+                time.sleep(max(0, 1 / rate - (time.monotonic() - started)))
+        finally:
+            connection.close()
+    return sent, failed
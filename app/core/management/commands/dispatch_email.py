@@ -0,0 +1,58 @@
+'''
+Send the emails queued in the outbox (see core.mail), needs
+settings.EMAIL_OUTBOX so emails are queued.
+
+Send everything due and exit (run by cron every minute):
+$: ./mg.sh 'dispatch_email'
+
+Keep sending as emails are queued:
+$: ./mg.sh 'dispatch_email --loop --interval=10'
+'''
+from django.core.management.base import BaseCommand
+
+from core.mail import dispatch_outbox
+
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Dispatch queued emails
+    '''
+    help = 'Send the emails queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            default=50,
+            help="Emails sent over one connection"
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help="Emails per second at most "
+                 "(default: settings.EMAIL_OUTBOX_RATE)"
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help="Keep checking for queued emails until interrupted"
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=10,
+            help="Seconds between checks with --loop"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = dispatch_outbox(options['batch_size'],
+                                           options['rate'])
+            if sent or failed:
+                self.stdout.write(
+                    f'Sent {sent} email(s), {failed} failed attempt(s)')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -88,3 +88,38 @@ class User(AbstractBaseUser, PermissionsMixin):
         else:  # viewer (least priv)
             reporter.user_set.remove(self)
             contributor.user_set.remove(self)
+
+
+class OutboxEmail(models.Model):
+    '''
+    A rendered email waiting to be sent by dispatch_email, see core.mail
+    '''
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        SENT = 'sent', 'Sent'
+        # gave up after EMAIL_OUTBOX_MAX_ATTEMPTS
+        FAILED = 'failed', 'Failed'
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=255, blank=True, default='')
+    to = models.JSONField(default=list)
+    status = models.CharField(
+        max_length=8,
+        choices=Status.choices,
+        default=Status.PENDING
+    )
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}: {self.status}"
@@ -0,0 +1,105 @@
+from unittest.mock import patch
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from io import StringIO
+
+from core.mail import dispatch_outbox, queue_mail
+from core.models import OutboxEmail
+
+from datetime import datetime, timedelta
+import pytz
+
+'''
+./mg.sh "test core.tests.test_mail && flake8"
+'''
+
+
+@override_settings(EMAIL_OUTBOX=True, EMAIL_OUTBOX_RATE=1000)
+class OutboxTests(TestCase):
+
+    def queue(self, n=1):
+        for i in range(n):
+            queue_mail(f'Subject {i}', 'text', 'from@pnsn.org',
+                       ['to@pnsn.org'], html_message='<p>html</p>')
+
+    def test_queue_mail(self):
+        self.queue()
+        self.assertEqual(0, len(mail.outbox))
+        email = OutboxEmail.objects.get()
+        self.assertEqual(OutboxEmail.Status.PENDING, email.status)
+        self.assertEqual(['to@pnsn.org'], email.to)
+
+    @override_settings(EMAIL_OUTBOX=False)
+    def test_send_without_outbox(self):
+        self.queue()
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(0, OutboxEmail.objects.count())
+
+    def test_dispatch(self):
+        self.queue(3)
+        self.assertEqual((3, 0), dispatch_outbox(batch_size=2))
+        self.assertEqual(3, len(mail.outbox))
+        self.assertEqual(
+            [('text/html', '<p>html</p>')],
+            [(mimetype, content) for content, mimetype in
+             mail.outbox[0].alternatives])
+        self.assertEqual(3, OutboxEmail.objects.filter(
+            status=OutboxEmail.Status.SENT).count())
+        # nothing left to send
+        self.assertEqual((0, 0), dispatch_outbox())
+
+    def test_retry(self):
+        self.queue()
+        with patch('django.core.mail.EmailMessage.send',
+                   side_effect=OSError('down')):
+            self.assertEqual((0, 1), dispatch_outbox(max_attempts=2))
+        email = OutboxEmail.objects.get()
+        self.assertEqual((OutboxEmail.Status.PENDING, 1, 'down'),
+                         (email.status, email.attempts, email.last_error))
+        self.assertGreater(email.next_attempt_at, datetime.now(tz=pytz.UTC))
+
+        # not due yet
+        self.assertEqual((0, 0), dispatch_outbox(max_attempts=2))
+
+        OutboxEmail.objects.update(
+            next_attempt_at=datetime.now(tz=pytz.UTC) - timedelta(minutes=1))
+        with patch('django.core.mail.EmailMessage.send',
+                   side_effect=OSError('down')):
+            dispatch_outbox(max_attempts=2)
+        self.assertEqual(OutboxEmail.Status.FAILED,
+                         OutboxEmail.objects.get().status)
+
+    def test_dispatch_claims_batch(self):
+        '''Emails being sent are put off, so other dispatchers skip them'''
+        self.queue()
+        now = datetime.now(tz=pytz.UTC)
+
+        def send(*args, **kwargs):
+            self.assertGreater(OutboxEmail.objects.get().next_attempt_at,
+                               now + timedelta(minutes=5))
+            return 1
+
+        with patch('django.core.mail.EmailMessage.send', side_effect=send):
+            self.assertEqual((1, 0), dispatch_outbox())
+        self.assertEqual(OutboxEmail.Status.SENT,
+                         OutboxEmail.objects.get().status)
+
+    def test_connection_failure(self):
+        '''A batch that can't connect counts as an attempt'''
+        self.queue(3)
+        with patch('django.core.mail.backends.locmem.EmailBackend.open',
+                   side_effect=OSError('refused')):
+            self.assertEqual((0, 2), dispatch_outbox(batch_size=2))
+        self.assertEqual(
+            [(1, 'refused'), (1, 'refused'), (0, '')],
+            list(OutboxEmail.objects.order_by('id').values_list(
+                'attempts', 'last_error')))
+        self.assertEqual(0, len(mail.outbox))
+
+    def test_dispatch_email_command(self):
+        self.queue(2)
+        out = StringIO()
+        call_command('dispatch_email', stdout=out)
+        self.assertIn('Sent 2 email(s)', out.getvalue())
+        self.assertEqual(2, len(mail.outbox))
@@ -2,7 +2,8 @@ import base64
 import uuid
 from django.db import models
 from django.conf import settings
-from django.core.mail import send_mail
+
+from core.mail import queue_mail
 
 
 class InviteToken(models.Model):
@@ -19,15 +20,14 @@ class InviteToken(models.Model):
     def send_invite(self):
         token = base64.urlsafe_b64encode(str(self.id).encode()).decode()
         org_desc = self.user.organization.description
-        send_mail("You've been invited to SQUAC",
-                  f"You have been invited to the {org_desc} organization in"
-                  f" SQUAC. Please visit: \n"
-                  f"https://squac.pnsn.org/signup?token={token} \n"
-                  f"to complete your registration.",
-                  settings.EMAIL_NO_REPLY,
-                  [self.user.email, ],
-                  fail_silently=False,
-                  )
+        queue_mail("You've been invited to SQUAC",
+                   f"You have been invited to the {org_desc} organization in"
+                   f" SQUAC. Please visit: \n"
+                   f"https://squac.pnsn.org/signup?token={token} \n"
+                   f"to complete your registration.",
+                   settings.EMAIL_NO_REPLY,
+                   [self.user.email, ],
+                   )
 
     # override save rather then creating signal
     def save(self, *args, **kwargs):
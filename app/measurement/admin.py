@@ -1,4 +1,12 @@
 from django.contrib import admin
-from .models import Metric
+from .models import Metric, MonitorEvaluation
 
 admin.site.register(Metric)
+
+
+@admin.register(MonitorEvaluation)
+class MonitorEvaluationAdmin(admin.ModelAdmin):
+    list_display = ('monitor', 'endtime', 'status', 'duration',
+                    'aggregate_duration', 'query_count')
+    list_filter = ('status',)
+    ordering = ('-started_at',)
@@ -0,0 +1,480 @@
+'''
+Batched evaluation of monitors.
+
+Monitors that share a metric and interval window need the same per channel
+aggregates, only over different channel groups. Rather than having every
+monitor query its own aggregates, monitors are batched by
+(metric, interval type, interval count): the aggregates are calculated once
+per batch over the union of the batch's channel groups, then handed to each
+monitor's evaluate_alarm. The number of aggregate queries is the number of
+distinct windows rather than the number of monitors. Channel names for
+breaching channels come from one cache shared by every monitor. Monitors of
+groups with at least settings.MONITOR_SQL_BREACHES_MIN_CHANNELS channels
+have the database evaluate their triggers instead, and only get their
+breaching channels back (see Monitor.aggregate_breaching).
+
+Each monitor keeps the aggregates it was last evaluated with, and the
+channels breaching each trigger, as its MonitorState, which also serves the
+monitor's status endpoint. When nothing was ingested for its metric since
+and no measurement left its window, the monitor reuses them, or isn't
+evaluated at all when its triggers haven't changed either.
+
+Batches are independent, so they can be evaluated concurrently by a pool of
+worker threads, each with its own db connection. Each monitor is evaluated
+holding its own advisory lock, so monitors that another process (e.g.
+evaluate_dirty_monitors, or an overrunning run) is evaluating are skipped as
+LOCKED rather than alerting twice, and alerts are unique per trigger and
+timestamp. Every monitor evaluation is
+recorded as a MonitorEvaluation with its duration, query count and outcome.
+Daily digests due are sent once every monitor was evaluated, together.
+
+A dry run evaluates monitors the same way but rolls every evaluation back,
+and can profile each one's queries with a QueryProfiler, to find out which
+monitors and queries make a run slow.
+'''
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Prefetch
+
+from measurement.models import (Alert, Monitor, MonitorEvaluation,
+                                MonitorState, Trigger)
+from nslc.models import Group
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import pytz
+import time
+
+
+# keys of the advisory locks held while evaluate_alarms and
+# evaluate_dirty_monitors run
+EVALUATE_ALARMS_LOCK = 727001
+EVALUATE_DIRTY_LOCK = 727002
+# class of the transaction level advisory locks of each monitor, keyed by
+# (MONITOR_LOCK, monitor id), held while it is evaluated
+MONITOR_LOCK = 727003
+# monitors whose alerts weren't brought up to endtime, left out of digests
+NOT_EVALUATED = (MonitorEvaluation.Status.ERROR,
+                 MonitorEvaluation.Status.SKIPPED,
+                 MonitorEvaluation.Status.LOCKED)
+
+
+@contextmanager
+def advisory_lock(key):
+    '''
+    Try to take a session level postgres advisory lock without waiting.
+    Yields whether the lock was acquired, and releases it afterwards
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s);', [key])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s);', [key])
+
+
+def lock_monitor(monitor):
+    '''
+    Try to take the advisory lock of monitor for the current transaction,
+    without waiting. Once it is taken, the latest alerts of the monitor's
+    triggers are reloaded if another evaluation changed them since they
+    were read. Returns whether the lock was taken
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s);',
+                       [MONITOR_LOCK, monitor.id])
+        if not cursor.fetchone()[0]:
+            return False
+    latest = dict(Trigger.objects.filter(monitor=monitor).values_list(
+        'id', 'latest_alert_id'))
+    stale = [trigger for trigger in monitor.triggers.all()
+             if latest.get(trigger.id) != trigger.latest_alert_id]
+    if stale:
+        alerts = Alert.objects.in_bulk(
+            [latest[trigger.id] for trigger in stale if latest[trigger.id]])
+        for trigger in stale:
+            trigger.latest_alert = alerts.get(latest[trigger.id])
+    return True
+
+
+class QueryCounter:
+    ''' execute_wrapper counting the queries run through a connection '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryProfiler(QueryCounter):
+    '''
+    QueryCounter also timing the queries and counting the rows they return
+    or change, keeping the slowest SELECT so it can be explained
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.sql_time = 0
+        self.rows = 0
+        self.slowest = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.monotonic()
+        result = super().__call__(execute, sql, params, many, context)
+        duration = time.monotonic() - started
+        self.sql_time += duration
+        self.rows += max(context['cursor'].rowcount, 0)
+        select = sql.lstrip().upper().startswith(('SELECT', 'WITH'))
+        if select and not many and (
+                self.slowest is None or duration > self.slowest['duration']):
+            self.slowest = {'sql': sql, 'params': params,
+                            'duration': duration}
+        return result
+
+    def report(self, aggregate=None):
+        '''
+        the profile of a monitor's evaluation, with that of the aggregate
+        query of its batch if it needed one
+        '''
+        slowest = [profiler.slowest for profiler in (self, aggregate)
+                   if profiler and profiler.slowest]
+        return {
+            'queries': self.count,
+            'sql_time': self.sql_time,
+            'rows': self.rows,
+            'aggregate_queries': aggregate.count if aggregate else 0,
+            'aggregate_sql_time': aggregate.sql_time if aggregate else 0,
+            'aggregate_rows': aggregate.rows if aggregate else 0,
+            'slowest_query': max(slowest, key=lambda query: query['duration'],
+                                 default=None),
+        }
+
+
+def explain_analyze(sql, params):
+    '''
+    EXPLAIN ANALYZE a query in a transaction that is rolled back. Returns the
+    lines of the plan
+    '''
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN ANALYZE {sql}', params)
+        plan = [row[0] for row in cursor.fetchall()]
+        transaction.set_rollback(True)
+    return plan
+
+
+def window_key(monitor):
+    return (monitor.metric_id, monitor.interval_type, monitor.interval_count)
+
+
+def group_channel_ids(group_ids):
+    ''' return {group id: sorted channel ids} for the given groups, at once '''
+    channel_ids = {group_id: [] for group_id in group_ids}
+    memberships = Group.channels.through.objects.filter(
+        group_id__in=group_ids).order_by('channel_id').values_list(
+        'group_id', 'channel_id')
+    for group_id, channel_id in memberships:
+        channel_ids[group_id].append(channel_id)
+    return channel_ids
+
+
+def batch_monitors(monitors):
+    ''' split monitors into batches sharing a window: {window: monitors} '''
+    batches = defaultdict(list)
+    for monitor in monitors:
+        batches[window_key(monitor)].append(monitor)
+    return batches
+
+
+def reuse_state(monitor, starttime, endtime, channel_ids):
+    '''
+    How the last evaluation of monitor can be reused (see MonitorState):
+    UNCHANGED when its inputs and outcome are the same so it needn't be
+    evaluated, CACHED when only its aggregates can be reused, else None.
+    Alerts are only created on changes, so unchanged monitors in alarm
+    needn't be evaluated either
+    '''
+    state = getattr(monitor, 'state', None)
+    if state is None or monitor.updated_at > state.evaluated_at:
+        return None
+    if not state.unchanged(monitor, starttime, endtime, channel_ids):
+        return None
+    triggers_changed = any(trigger.updated_at > state.evaluated_at
+                           for trigger in monitor.triggers.all())
+    if triggers_changed:
+        return MonitorEvaluation.Status.CACHED
+    return MonitorEvaluation.Status.UNCHANGED
+
+
+def filters_breaches(monitor, channel_ids, threshold):
+    ''' whether monitor's group is large enough for aggregate_breaching '''
+    return len(channel_ids[monitor.channel_group_id]) >= threshold and \
+        monitor.can_filter_breaches()
+
+
+def monitor_state(monitor, reuse, starttime, endtime, channel_values,
+                  in_alarm, evaluated_at, duration, breaches=None):
+    '''
+    the MonitorState of an evaluation, unsaved. States of evaluations whose
+    breaches were found by the database only have the breaching channels,
+    and no watermark so they aren't reused
+    '''
+    if breaches is not None:
+        channels = {channel['channel_id']: channel[monitor.stat]
+                    for channels in breaches.values()
+                    for channel in channels}
+        return MonitorState(
+            monitor=monitor, evaluated_at=evaluated_at, starttime=starttime,
+            endtime=endtime, watermark=None, first_starttime=None,
+            channel_values=[{'channel': channel_id, monitor.stat: value}
+                            for channel_id, value in sorted(channels.items())],
+            in_alarm=bool(in_alarm), duration=duration,
+            breaching={str(trigger_id): [channel['channel_id']
+                                         for channel in channels]
+                       for trigger_id, channels in breaches.items()})
+
+    breaching = MonitorState.breaching_channels(monitor, channel_values)
+    if reuse == MonitorEvaluation.Status.CACHED:
+        watermark = monitor.state.watermark
+        first_starttime = monitor.state.first_starttime
+    else:
+        watermark = monitor.metric.last_ingested_at
+        first_starttime = min(
+            (value['first_starttime'] for value in channel_values
+             if value.get('first_starttime')), default=None)
+        channel_values = [
+            {key: value for key, value in channel_value.items()
+             if key != 'first_starttime'}
+            for channel_value in channel_values]
+    return MonitorState(
+        monitor=monitor, evaluated_at=evaluated_at, starttime=starttime,
+        endtime=endtime, watermark=watermark,
+        first_starttime=first_starttime, channel_values=channel_values,
+        in_alarm=bool(in_alarm), breaching=breaching, duration=duration)
+
+
+def evaluate_batch(window, batch, channel_ids, nslcs, endtime, deadline=None,
+                   dry_run=False, profiles=None):
+    '''
+    Calculate the aggregates of a window once, then evaluate each monitor of
+    the batch with them. Monitors whose inputs haven't changed since their
+    last evaluation reuse it instead, and if none of the batch changed the
+    aggregates aren't calculated at all. Monitors are evaluated in their own
+    transaction so one failing doesn't affect the others. Monitors not
+    started before the deadline (time.monotonic() value) are skipped.
+    With dry_run monitors aren't locked, the transactions are rolled back
+    and states aren't saved.
+    With a profiles dict, the QueryProfiler report of each evaluated monitor
+    is added to it by monitor id.
+    Returns an unsaved MonitorEvaluation for each monitor
+    '''
+    metric_id, interval_type, interval_count = window
+    evaluations = []
+    states = []
+
+    def record(monitor, started_at=None, **kwargs):
+        evaluations.append(MonitorEvaluation(
+            monitor=monitor, endtime=endtime,
+            started_at=started_at or datetime.now(tz=pytz.UTC), **kwargs))
+
+    def expired():
+        return deadline is not None and time.monotonic() > deadline
+
+    if expired():
+        for monitor in batch:
+            record(monitor, status=MonitorEvaluation.Status.SKIPPED)
+        return evaluations
+
+    starttime = batch[0].calc_starttime(endtime)
+    reuses = {
+        monitor.id: reuse_state(monitor, starttime, endtime,
+                                channel_ids[monitor.channel_group_id])
+        for monitor in batch
+    }
+    stale = [monitor for monitor in batch if reuses[monitor.id] is None]
+    # large groups can have the database find their breaching channels
+    # instead of returning every channel's aggregates
+    threshold = settings.MONITOR_SQL_BREACHES_MIN_CHANNELS
+    filtered = {
+        monitor.id for monitor in stale
+        if threshold and filters_breaches(monitor, channel_ids, threshold)}
+    stale = [monitor for monitor in stale if monitor.id not in filtered]
+    aggregated = {monitor.id for monitor in stale}
+    values = {}
+    aggregate_duration = 0
+    aggregate = QueryProfiler() if profiles is not None else QueryCounter()
+    if stale:
+        union = sorted(set().union(
+            *(channel_ids[monitor.channel_group_id] for monitor in stale)))
+        last_n = (interval_count
+                  if interval_type == Monitor.IntervalType.LASTN else None)
+        started = time.monotonic()
+        try:
+            with connection.execute_wrapper(aggregate):
+                values = Monitor.aggregate_channels(
+                    metric_id, union, starttime, endtime, last_n=last_n,
+                    stats={monitor.stat for monitor in stale})
+        except Exception as e:
+            for monitor in stale:
+                record(monitor, status=MonitorEvaluation.Status.ERROR,
+                       error=f'aggregate query failed: {e}')
+            failed = {monitor.id for monitor in stale}
+            batch = [monitor for monitor in batch
+                     if monitor.id not in failed]
+        aggregate_duration = time.monotonic() - started
+
+    for monitor in batch:
+        reuse = reuses[monitor.id]
+        if expired():
+            record(monitor, status=MonitorEvaluation.Status.SKIPPED,
+                   aggregate_duration=aggregate_duration)
+            continue
+        if reuse == MonitorEvaluation.Status.UNCHANGED:
+            record(monitor, status=reuse)
+            continue
+
+        group_channels = channel_ids[monitor.channel_group_id]
+        breaches = None
+        if reuse == MonitorEvaluation.Status.CACHED:
+            channel_values = monitor.state.channel_values
+        elif monitor.id in filtered:
+            channel_values = None
+        else:
+            channel_values = Monitor.fill_channel_values(group_channels,
+                                                         values)
+        counter = QueryProfiler() if profiles is not None else QueryCounter()
+        started_at = datetime.now(tz=pytz.UTC)
+        started = time.monotonic()
+        status, error = reuse or MonitorEvaluation.Status.OK, ''
+        try:
+            with connection.execute_wrapper(counter), transaction.atomic():
+                # a dry run writes nothing, so it doesn't keep a real run
+                # from evaluating the monitor
+                if not dry_run and not lock_monitor(monitor):
+                    status = MonitorEvaluation.Status.LOCKED
+                else:
+                    if monitor.id in filtered:
+                        breaches = monitor.aggregate_breaching(
+                            group_channels, starttime, endtime)
+                    # the emails of a dry run are queued, to be rolled back
+                    in_alarm = monitor.evaluate_alarm(
+                        endtime=endtime, channel_values=channel_values,
+                        nslcs=nslcs, total_channels=len(group_channels),
+                        digest=False, breaches=breaches,
+                        outbox=True if dry_run else None)
+                if dry_run:
+                    transaction.set_rollback(True)
+        except Exception as e:
+            status, error = MonitorEvaluation.Status.ERROR, str(e)
+        duration = time.monotonic() - started
+        if status not in (MonitorEvaluation.Status.ERROR,
+                          MonitorEvaluation.Status.LOCKED):
+            states.append(monitor_state(
+                monitor, reuse, starttime, endtime, channel_values,
+                in_alarm, started_at, duration, breaches))
+        record(monitor, started_at=started_at, duration=duration,
+               aggregate_duration=aggregate_duration,
+               query_count=counter.count, status=status, error=error)
+        if profiles is not None:
+            profiles[monitor.id] = counter.report(
+                aggregate if monitor.id in aggregated else None)
+
+    if dry_run:
+        return evaluations
+    MonitorState.objects.bulk_create(
+        states, update_conflicts=True, unique_fields=['monitor'],
+        update_fields=['evaluated_at', 'starttime', 'endtime', 'watermark',
+                       'first_starttime', 'channel_values', 'in_alarm',
+                       'breaching', 'duration'])
+    return evaluations
+
+
+def run_batch(*args, **kwargs):
+    ''' evaluate_batch in a worker thread, which has its own connection '''
+    try:
+        return evaluate_batch(*args, **kwargs)
+    finally:
+        connection.close()
+
+
+def with_related(monitors):
+    ''' a Monitor queryset with what evaluating its monitors needs '''
+    return monitors.select_related(
+        'metric', 'channel_group', 'state').prefetch_related(Prefetch(
+            'triggers',
+            queryset=Trigger.objects.select_related('latest_alert')))
+
+
+def prune_evaluations(now=None):
+    '''
+    Delete MonitorEvaluations older than
+    settings.MONITOR_EVALUATION_RETENTION_DAYS, 0 keeps them all. Returns
+    the number deleted
+    '''
+    retention = settings.MONITOR_EVALUATION_RETENTION_DAYS
+    if not retention:
+        return 0
+    now = now or datetime.now(tz=pytz.UTC)
+    deleted, _ = MonitorEvaluation.objects.filter(
+        started_at__lt=now - relativedelta(days=retention)).delete()
+    return deleted
+
+
+def evaluate_monitors(monitors, endtime, workers=1, deadline=None,
+                      digest=True, dry_run=False, profiles=None):
+    '''
+    Evaluate monitors (a Monitor queryset or list) at endtime, batched by
+    window, with up to workers batches at once. deadline is a number of
+    seconds after which monitors that haven't started are skipped. With
+    digest, the daily digests due at endtime are sent afterwards.
+    Monitors that failed, were skipped or locked get no digest.
+    With dry_run, every evaluation is rolled back with the emails it queued,
+    and nothing is saved or sent. profiles is filled as in evaluate_batch.
+    Returns a MonitorEvaluation for each monitor, saved unless dry_run
+    '''
+    if hasattr(monitors, 'select_related'):
+        monitors = with_related(monitors)
+    monitors = list(monitors)
+    batches = batch_monitors(monitors)
+    channel_ids = group_channel_ids(
+        {monitor.channel_group_id for monitor in monitors})
+    if deadline is not None:
+        deadline = time.monotonic() + deadline
+
+    # {channel id: str(channel)}, filled as triggers find breaching channels
+    nslcs = {}
+    evaluations = []
+    if workers <= 1:
+        for window, batch in batches.items():
+            results = evaluate_batch(window, batch, channel_ids, nslcs,
+                                     endtime, deadline, dry_run, profiles)
+            evaluations += results if dry_run else \
+                MonitorEvaluation.objects.bulk_create(results)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(run_batch, window, batch, channel_ids, nslcs,
+                                endtime, deadline, dry_run, profiles)
+                for window, batch in batches.items()
+            ]
+            for future in as_completed(futures):
+                results = future.result()
+                evaluations += results if dry_run else \
+                    MonitorEvaluation.objects.bulk_create(results)
+
+    if digest and not dry_run:
+        failed = {evaluation.monitor_id for evaluation in evaluations
+                  if evaluation.status in NOT_EVALUATED}
+        due = [monitor for monitor in monitors
+               if monitor.id not in failed and monitor.digest_due(endtime)]
+        if due:
+            Monitor.send_daily_digests(due, endtime - relativedelta(
+                minute=0, second=0, microsecond=0))
+    return evaluations
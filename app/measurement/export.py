@@ -0,0 +1,314 @@
+'''
+Export measurements to a storage backend (see measurement.storage), one file
+per day and metric, plus a manifest per day.
+
+Files are compressed npz, or parquet when pyarrow is installed, named like
+the csv files of s3_query_export:
+    raw/YYYY/mm/YYYY_mm_dd_metric_{id}.npz
+    raw/YYYY/mm/YYYY_mm_dd_manifest.json
+Every file holds one array per measurement column. Timestamps are
+datetime64[us] in UTC. The manifest lists the files of the day with their
+row counts and sha256 checksums.
+'''
+from django.db import connection, models
+
+from measurement.models import Measurement
+
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import hashlib
+import io
+import json
+import numpy as np
+import pytz
+import tempfile
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ['npz', 'parquet']
+
+ExportTask = namedtuple('ExportTask', ['day', 'metric'])
+''' a day (date) and metric id to export '''
+
+
+class ExportError(Exception):
+    ''' Raised when a file can't be exported or read back '''
+    pass
+
+
+def measurement_columns():
+    ''' return (column name, numpy dtype) for every measurement column '''
+    columns = []
+    for field in Measurement._meta.concrete_fields:
+        if isinstance(field, models.DateTimeField):
+            dtype = 'datetime64[us]'
+        elif isinstance(field, models.FloatField):
+            dtype = 'float64'
+        else:
+            dtype = 'int64'
+        columns.append((field.column, dtype))
+    return columns
+
+
+def day_prefix(day):
+    return f"raw/{day.strftime('%Y/%m/%Y_%m_%d')}"
+
+
+def file_path(day, metric, fmt='npz'):
+    return f'{day_prefix(day)}_metric_{metric}.{fmt}'
+
+
+def manifest_path(day):
+    return f'{day_prefix(day)}_manifest.json'
+
+
+def day_range(day):
+    ''' return the utc start and end of a date '''
+    start = datetime(day.year, day.month, day.day, tzinfo=pytz.UTC)
+    return start, start + timedelta(days=1)
+
+
+def day_metrics(day):
+    ''' return ids of metrics with measurements on day '''
+    start, end = day_range(day)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            '''SELECT DISTINCT metric_id FROM measurement_measurement
+               WHERE starttime >= %s AND starttime < %s
+               ORDER BY metric_id;''', [start, end])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def fetch_columns(day, metric, chunk_size=10000):
+    '''
+    Stream the measurements of a metric on day through a server side cursor
+    and return them as a dict of numpy arrays. Timestamps are selected as
+    epoch microseconds so no datetime objects are built
+    '''
+    columns = measurement_columns()
+    select = ', '.join(
+        f'(EXTRACT(EPOCH FROM {name}) * 1000000)::bigint'
+        if dtype.startswith('datetime') else name
+        for name, dtype in columns)
+    start, end = day_range(day)
+
+    chunks = []
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            f'''SELECT {select} FROM measurement_measurement
+                WHERE metric_id = %s AND starttime >= %s AND starttime < %s
+                ORDER BY channel_id, starttime;''', [metric, start, end])
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            # one tuple per column
+            chunks.append(list(zip(*rows)))
+
+    data = {}
+    for i, (name, dtype) in enumerate(columns):
+        stored = 'int64' if dtype.startswith('datetime') else dtype
+        arrays = [np.array(chunk[i], dtype=stored) for chunk in chunks]
+        array = np.concatenate(arrays) if arrays else np.array(
+            [], dtype=stored)
+        data[name] = array.view(dtype)
+    return data
+
+
+def write_columns(f, data, fmt):
+    ''' write a dict of arrays to a binary file object '''
+    if fmt == 'npz':
+        np.savez_compressed(f, **data)
+    elif fmt == 'parquet':
+        if pyarrow is None:
+            raise ExportError('parquet export requires pyarrow')
+        arrays = {}
+        for name, array in data.items():
+            if array.dtype.kind == 'M':
+                arrays[name] = pyarrow.array(
+                    array.view('int64'), type=pyarrow.timestamp('us', 'UTC'))
+            else:
+                arrays[name] = pyarrow.array(array)
+        pyarrow.parquet.write_table(pyarrow.table(arrays), f,
+                                    compression='zstd')
+    else:
+        raise ExportError(f'Unknown export format: {fmt}')
+
+
+def read_columns(f, fmt):
+    ''' read a file written by write_columns back into a dict of arrays '''
+    if fmt == 'npz':
+        with np.load(f, allow_pickle=False) as npz:
+            return {name: npz[name] for name in npz.files}
+    if fmt == 'parquet':
+        if pyarrow is None:
+            raise ExportError('parquet files require pyarrow')
+        table = pyarrow.parquet.read_table(f)
+        data = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if pyarrow.types.is_timestamp(column.type):
+                data[name] = column.cast(pyarrow.int64()).to_numpy().view(
+                    'datetime64[us]')
+            else:
+                data[name] = column.to_numpy()
+        return data
+    raise ExportError(f'Unknown export format: {fmt}')
+
+
+def export_file(storage, day, metric, fmt='npz', chunk_size=10000):
+    '''
+    Export the measurements of metric on day to storage. Returns the
+    manifest entry of the file
+    '''
+    started = time.monotonic()
+    data = fetch_columns(day, metric, chunk_size=chunk_size)
+    path = file_path(day, metric, fmt)
+
+    digest = hashlib.sha256()
+    with tempfile.TemporaryFile() as f:
+        write_columns(f, data, fmt)
+        size = f.tell()
+        f.seek(0)
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+        f.seek(0)
+        storage.save(path, f)
+
+    return {
+        'metric': metric,
+        'path': path,
+        'format': fmt,
+        'rows': len(data['id']),
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+        'columns': list(data),
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+def read_file(storage, entry, verify=True):
+    ''' read the file of a manifest entry, checking its checksum '''
+    content = storage.read(entry['path'])
+    if verify and hashlib.sha256(content).hexdigest() != entry['sha256']:
+        raise ExportError(f"Checksum mismatch for {entry['path']}")
+    data = read_columns(io.BytesIO(content), entry['format'])
+    rows = len(next(iter(data.values()))) if data else 0
+    if verify and rows != entry['rows']:
+        raise ExportError(
+            f"{entry['path']} has {rows} rows, expected {entry['rows']}")
+    return data
+
+
+def read_manifest(storage, day):
+    ''' return the manifest of day, None if there is none '''
+    path = manifest_path(day)
+    if not storage.exists(path):
+        return None
+    return json.loads(storage.read(path))
+
+
+def write_manifest(storage, day, entries):
+    '''
+    Write the manifest for day. Entries of an existing manifest for other
+    metrics are kept, so exporting a single metric doesn't lose the others
+    '''
+    files = {}
+    existing = read_manifest(storage, day)
+    if existing:
+        files = {entry['metric']: entry for entry in existing['files']}
+    files.update({entry['metric']: entry for entry in entries})
+
+    manifest = {
+        'day': day.isoformat(),
+        'created_at': datetime.now(tz=pytz.UTC).isoformat(),
+        'files': [files[metric] for metric in sorted(files)],
+    }
+    storage.write(manifest_path(day),
+                  json.dumps(manifest, indent=2).encode())
+    return manifest
+
+
+def run_export(storage, task, fmt, chunk_size, close_connection):
+    try:
+        return export_file(storage, task.day, task.metric, fmt=fmt,
+                           chunk_size=chunk_size)
+    finally:
+        # worker threads get their own connection, which would otherwise
+        # stay open after the thread is done
+        if close_connection:
+            connection.close()
+
+
+def export_days(storage, days, metrics=None, fmt='npz', workers=1,
+                overwrite=True, chunk_size=10000, report=None):
+    '''
+    Export every (day, metric) of days to storage with a pool of worker
+    threads, each with its own db connection, then write a manifest for
+    each day once all of its files are done.
+
+    report, if given, is called with (task, entry, error) as each file
+    finishes; entry is None for skipped files. Returns the manifest
+    entries and a list of (task, error) for the failures
+    '''
+    if fmt not in FORMATS:
+        raise ExportError(f'Unknown export format: {fmt}')
+    tasks = []
+    for day in days:
+        available = day_metrics(day)
+        if metrics:
+            available = [m for m in available if m in metrics]
+        for metric in available:
+            if not overwrite and storage.exists(file_path(day, metric, fmt)):
+                if report:
+                    report(ExportTask(day, metric), None, None)
+                continue
+            tasks.append(ExportTask(day, metric))
+
+    remaining = Counter(task.day for task in tasks)
+    entries = defaultdict(list)
+    exported, errors = [], []
+
+    def finish(task, entry=None, error=None):
+        if error is not None:
+            errors.append((task, error))
+        else:
+            entries[task.day].append(entry)
+            exported.append(entry)
+        if report:
+            report(task, entry, error)
+        remaining[task.day] -= 1
+        if remaining[task.day] == 0 and entries[task.day]:
+            write_manifest(storage, task.day, entries[task.day])
+
+    if workers <= 1:
+        for task in tasks:
+            try:
+                entry = run_export(storage, task, fmt, chunk_size, False)
+            except Exception as e:
+                finish(task, error=e)
+            else:
+                finish(task, entry=entry)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(run_export, storage, task, fmt, chunk_size,
+                                True): task
+                for task in tasks
+            }
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    finish(task, error=e)
+                else:
+                    finish(task, entry=entry)
+    return exported, errors
@@ -0,0 +1,139 @@
+'''
+Bookkeeping of ingested measurements for monitor evaluation.
+
+Ingest moves the last_ingested_at watermark of the metrics it writes, which
+tells evaluate_alarms which monitors have new inputs (see MonitorState).
+Measurements written other than through the api should call touch_metrics.
+
+With settings.MONITOR_INCREMENTAL_EVALUATION on, the measurement create
+endpoints mark the (metric, channel) series they write as dirty.
+evaluate_dirty_monitors then takes the series that have been quiet for a
+debounce period, so a burst of posts is evaluated once, or that have been
+waiting longer than a max delay, and re-evaluates only the monitors whose
+metric and channel group include one of them. Alerts then follow the data
+within minutes instead of at the next hourly evaluate_alarms.
+'''
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from measurement.evaluation import evaluate_monitors
+from measurement.models import DirtySeries, Metric, Monitor
+from measurement.scheduler import aligned
+from nslc.models import Group
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+import pytz
+
+
+def record_ingest(measurements):
+    ''' bookkeeping for newly written measurements (Measurement objects) '''
+    touch_metrics({measurement.metric_id for measurement in measurements})
+    mark_dirty(measurements)
+
+
+def touch_metrics(metric_ids, now=None):
+    '''
+    Move the ingest watermark of metrics, unless it was moved less than
+    MONITOR_WATERMARK_RESOLUTION seconds before now. Rows left alone aren't
+    locked, so concurrent ingests of a metric only wait on each other when
+    it moves (see MonitorState.unchanged)
+    '''
+    if metric_ids:
+        now = now or datetime.now(tz=pytz.UTC)
+        moved = now - timedelta(seconds=settings.MONITOR_WATERMARK_RESOLUTION)
+        Metric.objects.filter(
+            Q(last_ingested_at__isnull=True) | ~Q(
+                last_ingested_at__range=(moved, now)),
+            id__in=sorted(metric_ids)).update(last_ingested_at=now)
+
+
+def mark_dirty(measurements):
+    '''
+    Mark the series of measurements (Measurement objects) as dirty, when
+    incremental evaluation is on
+    '''
+    if not settings.MONITOR_INCREMENTAL_EVALUATION:
+        return
+    # sorted so concurrent ingests lock rows in the same order
+    series = sorted({(measurement.metric_id, measurement.channel_id)
+                     for measurement in measurements})
+    if not series:
+        return
+    now = datetime.now(tz=pytz.UTC)
+    DirtySeries.objects.bulk_create(
+        [DirtySeries(metric_id=metric_id, channel_id=channel_id,
+                     first_marked_at=now, last_marked_at=now)
+         for metric_id, channel_id in series],
+        update_conflicts=True,
+        update_fields=['last_marked_at'],
+        unique_fields=['metric', 'channel'])
+
+
+def take_dirty(quiet_since, marked_before):
+    '''
+    Remove and return the dirty series, as a set of (metric id, channel id),
+    last marked before quiet_since or first marked before marked_before.
+    Series being taken by another evaluator are left to it
+    '''
+    with transaction.atomic():
+        quiet = Q(last_marked_at__lte=quiet_since)
+        overdue = Q(first_marked_at__lte=marked_before)
+        ready = list(DirtySeries.objects.select_for_update(
+            skip_locked=True).filter(quiet | overdue).values_list(
+            'id', 'metric_id', 'channel_id'))
+        DirtySeries.objects.filter(id__in=[row[0] for row in ready]).delete()
+    return {(metric_id, channel_id) for _, metric_id, channel_id in ready}
+
+
+def dirty_monitors(series):
+    '''
+    Return the monitors whose metric and channel group include one of
+    series, a set of (metric id, channel id)
+    '''
+    channels_by_group = defaultdict(set)
+    memberships = Group.channels.through.objects.filter(
+        channel_id__in={channel_id for _, channel_id in series}).values_list(
+        'group_id', 'channel_id')
+    for group_id, channel_id in memberships:
+        channels_by_group[group_id].add(channel_id)
+
+    candidates = Monitor.objects.filter(
+        metric_id__in={metric_id for metric_id, _ in series},
+        channel_group_id__in=channels_by_group).values_list(
+        'id', 'metric_id', 'channel_group_id')
+    ids = [monitor_id for monitor_id, metric_id, group_id in candidates
+           if any((metric_id, channel_id) in series
+                  for channel_id in channels_by_group[group_id])]
+    return Monitor.objects.filter(id__in=ids)
+
+
+def evaluate_dirty(debounce=None, max_delay=None, workers=1, now=None):
+    '''
+    Evaluate the monitors of the dirty series that are ready, with debounce
+    and max_delay in seconds (default from settings), each at the end of its
+    last full evaluation period like measurement.scheduler. Returns the
+    MonitorEvaluations, empty if nothing was dirty
+    '''
+    if debounce is None:
+        debounce = settings.MONITOR_INCREMENTAL_DEBOUNCE
+    if max_delay is None:
+        max_delay = settings.MONITOR_INCREMENTAL_MAX_DELAY
+    now = now or datetime.now(tz=pytz.UTC)
+    series = take_dirty(now - timedelta(seconds=debounce),
+                        now - timedelta(seconds=max_delay))
+    if not series:
+        return []
+    # the same windows as scheduled evaluations, which would otherwise
+    # disagree with these about monitors near a threshold
+    batches = defaultdict(list)
+    for monitor in dirty_monitors(series).select_related('metric'):
+        batches[aligned(now, monitor.evaluation_period())].append(monitor.id)
+    evaluations = []
+    for endtime, ids in sorted(batches.items()):
+        # digests are sent by the scheduled evaluations
+        evaluations += evaluate_monitors(
+            Monitor.objects.filter(id__in=ids), endtime, workers=workers,
+            digest=False)
+    return evaluations
@@ -1,9 +1,16 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
+from django.db import connections
 
+from measurement.models import Metric
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from io import StringIO
+import multiprocessing
 import pytz
+import time
 """
 Run command on production server like:
 $: python app/manage.py backfill_archives day --start_time=03-01-2021
@@ -11,9 +18,29 @@ $: python app/manage.py backfill_archives day --start_time=03-01-2021
 Run command locally like:
 $: docker-compose run --rm app sh -c "python manage.py backfill_archives ..."
 $: ./mg.sh 'backfill_archives month --start_time=03-01-2021'
+
+To spread the periods over 4 worker processes, one task per metric:
+$: ./mg.sh 'backfill_archives day --start_time=03-01-2021 --workers=4
+            --shard_metrics'
 """
 
 
+def archive_period(archive_type, overwrite, period_end, metric=None):
+    '''
+    Run archive_measurements for a single period (and optionally a single
+    metric). Module level so it can be pickled and sent to a worker process.
+    Returns the elapsed time in seconds and the output of the command.
+    '''
+    args = [archive_type, overwrite, f'--period_end={period_end}']
+    if metric is not None:
+        args.append(f'--metric={metric}')
+
+    out = StringIO()
+    start = time.monotonic()
+    call_command('archive_measurements', *args, stdout=out)
+    return time.monotonic() - start, out.getvalue().strip()
+
+
 class Command(BaseCommand):
     """
     Command to call archive_measurements multiple times (for backfilling)
@@ -59,6 +86,32 @@ class Command(BaseCommand):
                             action='store_false')
         parser.add_argument('--overwrite', dest='overwrite',
                             action='store_true')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help=("Number of worker processes to archive periods with. Each "
+                  "worker uses its own db connection (default: 1, serial)")
+        )
+        parser.add_argument(
+            '--metric',
+            action='append',
+            type=int,
+            default=[],
+            help='id of a metric to be archived (default: all metrics)'
+        )
+        parser.add_argument(
+            '--shard_metrics',
+            action='store_true',
+            help=("Split every period into one task per metric so that a "
+                  "single long period can use several workers")
+        )
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=1,
+            help="How many times to retry periods that failed (default: 1)"
+        )
 
     def handle(self, *args, **kwargs):
         '''method called by manager'''
@@ -66,6 +119,7 @@ class Command(BaseCommand):
         current_time = kwargs['start_time']
         end_time = kwargs['end_time']
         period_size = kwargs['period_size']
+        workers = max(kwargs['workers'], 1)
 
         if kwargs['overwrite']:
             overwrite = '--overwrite'
@@ -82,11 +136,93 @@ class Command(BaseCommand):
             f' {end_time.strftime("%m-%d-%Y")} with {overwrite}'
         )
 
+        periods = []
         while current_time <= end_time:
-            call_command('archive_measurements',
-                         archive_type,
-                         overwrite,
-                         f'--period_end={current_time.strftime("%m-%d-%Y")}',
-                         stdout=self.stdout)
-
+            periods.append(current_time.strftime("%m-%d-%Y"))
             current_time = current_time + self.DURATIONS[archive_type](1)
+
+        # A task is a (period_end, metric) pair, metric None means every
+        # metric is archived in one call
+        metrics = kwargs['metric']
+        if kwargs['shard_metrics'] and not metrics:
+            metrics = list(Metric.objects.order_by('id').values_list(
+                'id', flat=True))
+        tasks = [(period, metric)
+                 for period in periods for metric in (metrics or [None])]
+
+        failed = self.run_tasks(tasks, archive_type, overwrite, workers)
+        for attempt in range(kwargs['retries']):
+            if not failed:
+                break
+            self.stdout.write(
+                f'Retrying {len(failed)} failed task(s), attempt {attempt + 1}'
+            )
+            failed = self.run_tasks(failed, archive_type, overwrite, workers)
+
+        if failed:
+            raise CommandError(
+                'Archiving failed for: ' + ', '.join(
+                    self.describe_task(task) for task in failed))
+
+    def run_tasks(self, tasks, archive_type, overwrite, workers):
+        '''
+        Archive every task, either serially or in a process pool. Reports
+        progress and timing as tasks finish and returns the failed tasks
+        '''
+        failed = []
+        total = len(tasks)
+        started = time.monotonic()
+
+        def report(index, task, result=None, error=None):
+            prefix = f'[{index}/{total}] {self.describe_task(task)}'
+            if error is not None:
+                failed.append(task)
+                self.stderr.write(f'{prefix} failed: {error}')
+            else:
+                elapsed, output = result
+                self.stdout.write(f'{prefix} done in {elapsed:.1f}s')
+                if output:
+                    self.stdout.write(output)
+
+        if workers == 1:
+            for index, task in enumerate(tasks, start=1):
+                try:
+                    result = archive_period(archive_type, overwrite, *task)
+                except Exception as e:
+                    report(index, task, error=e)
+                else:
+                    report(index, task, result=result)
+        else:
+            # Children are forked, so they must not share the parent's open
+            # connection. Each one opens its own on first use
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=context) as executor:
+                futures = {
+                    executor.submit(archive_period, archive_type, overwrite,
+                                    *task): task
+                    for task in tasks
+                }
+                for index, future in enumerate(as_completed(futures),
+                                               start=1):
+                    task = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        report(index, task, error=e)
+                    else:
+                        report(index, task, result=result)
+
+        self.stdout.write(
+            f'Finished {total - len(failed)}/{total} task(s) in '
+            f'{time.monotonic() - started:.1f}s with {workers} worker(s)'
+        )
+        return failed
+
+    @staticmethod
+    def describe_task(task):
+        period, metric = task
+        if metric is None:
+            return period
+        return f'{period} (metric {metric})'
@@ -0,0 +1,204 @@
+'''
+Compare the ingest and read cost of the measurement index profiles (see
+measurement.partitions.MEASUREMENT_INDEX_PROFILES)
+
+Each profile gets a scratch table shaped like a measurement partition, which
+is loaded with synthetic hourly measurements using the same upsert as the
+measurement API, then queried. The tables are dropped afterwards.
+
+$: ./mg.sh 'benchmark_index_profiles --rows=1000000 --profile=hot
+            --profile=cold'
+'''
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from psycopg2.extensions import AsIs
+
+from measurement.partitions import (MEASUREMENT_INDEX_PROFILES,
+                                    PartitionManager)
+from measurement.management.commands.partitions import format_size
+
+from datetime import datetime, timedelta
+import pytz
+import random
+import statistics
+import time
+
+
+UNIQUE = 'UNIQUE (metric_id, channel_id, starttime)'
+
+# what every partition inherits from the parent, besides the channel_id
+# index: the legacy profile goes with the plain unique constraint, the
+# others with the covering one
+INHERITED = {
+    'legacy': UNIQUE,
+}
+
+
+class Command(BaseCommand):
+    '''
+    Benchmark index profiles on scratch tables
+    '''
+    help = 'Compare ingest and read cost of measurement index profiles'
+
+    START = datetime(2021, 3, 1, tzinfo=pytz.UTC)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile',
+            action='append',
+            choices=sorted(MEASUREMENT_INDEX_PROFILES),
+            default=[],
+            help='Profile to benchmark (default: all of them)'
+        )
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=100000,
+            help='Number of measurements to load per profile'
+        )
+        parser.add_argument(
+            '--metrics',
+            type=int,
+            default=10,
+            help='Number of distinct metrics in the synthetic data'
+        )
+        parser.add_argument(
+            '--channels',
+            type=int,
+            default=100,
+            help='Number of distinct channels in the synthetic data'
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=1000,
+            help='Rows per insert, like a POST to the measurement API'
+        )
+        parser.add_argument(
+            '--reads',
+            type=int,
+            default=100,
+            help='Number of read queries of each kind'
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help="Don't drop the scratch tables"
+        )
+
+    def handle(self, *args, **options):
+        '''method called by manager'''
+        profiles = options['profile'] or sorted(MEASUREMENT_INDEX_PROFILES)
+        if min(options['rows'], options['metrics'], options['channels'],
+               options['batch']) < 1:
+            raise CommandError('rows, metrics, channels and batch must be > 0')
+        manager = PartitionManager('benchmark_measurement',
+                                   index_profiles=MEASUREMENT_INDEX_PROFILES)
+
+        results = []
+        for profile in profiles:
+            table = f'benchmark_measurement_{profile}'
+            self.create_table(manager, table, profile)
+            try:
+                results.append(self.benchmark(table, profile, options))
+            finally:
+                if not options['keep']:
+                    with connection.cursor() as cursor:
+                        cursor.execute('DROP TABLE %s;', [AsIs(table)])
+
+        self.stdout.write(
+            f"{'profile':<10} {'ingest rows/s':>14} {'index size':>11} "
+            f"{'lookup ms':>10} {'range ms':>9}")
+        for result in results:
+            self.stdout.write(
+                f"{result['profile']:<10} {result['ingest_rate']:>14,.0f} "
+                f"{format_size(result['index_size']):>11} "
+                f"{result['lookup_ms']:>10.2f} {result['range_ms']:>9.2f}")
+
+    def create_table(self, manager, table, profile):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s;', [AsIs(table)])
+            cursor.execute(f'''
+                CREATE TABLE {table} (
+                    id BIGSERIAL NOT NULL,
+                    metric_id integer NOT NULL,
+                    channel_id integer NOT NULL,
+                    value double precision NOT NULL,
+                    starttime timestamp with time zone NOT NULL,
+                    endtime timestamp with time zone NOT NULL,
+                    PRIMARY KEY (id),
+                    {INHERITED.get(profile, UNIQUE + ' INCLUDE (value)')}
+                );''')
+            cursor.execute('CREATE INDEX ON %s (channel_id);', [AsIs(table)])
+        manager.apply_index_profile(table, profile)
+
+    def benchmark(self, table, profile, options):
+        '''
+        Load the table in batches, then time the two kinds of reads we do:
+        "metric IN, channel IN, starttime range" (monitors, archives, the
+        API) and a plain starttime range (exports)
+        '''
+        n_metrics, n_channels = options['metrics'], options['channels']
+        series = n_metrics * n_channels
+        hours = max(options['rows'] // series, 1)
+
+        started = time.monotonic()
+        with connection.cursor() as cursor:
+            for first in range(0, options['rows'], options['batch']):
+                last = min(first + options['batch'], options['rows']) - 1
+                cursor.execute(f'''
+                    INSERT INTO {table}
+                        (metric_id, channel_id, value, starttime, endtime)
+                    SELECT n %% %(metrics)s, (n / %(metrics)s) %% %(channels)s,
+                           random(),
+                           %(start)s + (n / %(series)s) * interval '1 hour',
+                           %(start)s + (n / %(series)s + 1) * interval '1 hour'
+                    FROM generate_series(%(first)s, %(last)s) n
+                    ON CONFLICT (metric_id, channel_id, starttime)
+                    DO UPDATE SET value = EXCLUDED.value;''', {
+                    'metrics': n_metrics, 'channels': n_channels,
+                    'series': series, 'start': self.START,
+                    'first': first, 'last': last})
+        ingest_time = time.monotonic() - started
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s;', [AsIs(table)])
+            cursor.execute('SELECT pg_indexes_size(%s::regclass);', [table])
+            index_size = cursor.fetchone()[0]
+
+        # same seed for every profile, so they all run the same queries
+        rand = random.Random(0)
+        lookups, ranges = [], []
+        with connection.cursor() as cursor:
+            for _ in range(options['reads']):
+                metrics = rand.sample(range(n_metrics), min(3, n_metrics))
+                channels = rand.sample(range(n_channels), min(10, n_channels))
+                start = self.START + timedelta(hours=rand.randrange(hours))
+                end = start + timedelta(hours=6)
+
+                t0 = time.monotonic()
+                cursor.execute(f'''
+                    SELECT metric_id, channel_id, avg(value), count(*)
+                    FROM {table}
+                    WHERE metric_id = ANY(%s) AND channel_id = ANY(%s)
+                      AND starttime >= %s AND starttime < %s
+                    GROUP BY metric_id, channel_id;''',
+                               [metrics, channels, start, end])
+                cursor.fetchall()
+                lookups.append(time.monotonic() - t0)
+
+                t0 = time.monotonic()
+                cursor.execute(f'''
+                    SELECT count(*) FROM {table}
+                    WHERE starttime >= %s AND starttime < %s;''',
+                               [start, end])
+                cursor.fetchall()
+                ranges.append(time.monotonic() - t0)
+
+        return {
+            'profile': profile,
+            'ingest_rate': options['rows'] / max(ingest_time, 1e-6),
+            'index_size': index_size,
+            'lookup_ms': statistics.median(lookups) * 1000 if lookups else 0,
+            'range_ms': statistics.median(ranges) * 1000 if ranges else 0,
+        }
@@ -1,11 +1,34 @@
-from django.core.management.base import BaseCommand
-from measurement.models import Monitor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from measurement.evaluation import (EVALUATE_ALARMS_LOCK, advisory_lock,
+                                    evaluate_monitors, explain_analyze,
+                                    prune_evaluations)
+from measurement.models import Monitor, MonitorEvaluation
 
+from collections import Counter
+from contextlib import nullcontext
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import json
 import pytz
 
 
+# columns of the profile table: (key, heading, width, format spec)
+PROFILE_COLUMNS = [
+    ('monitor', 'monitor', 8, ''),
+    ('status', 'status', 9, ''),
+    ('duration', 'total s', 9, '.3f'),
+    ('sql_time', 'sql s', 9, '.3f'),
+    ('python_time', 'python s', 9, '.3f'),
+    ('queries', 'queries', 8, ''),
+    ('rows', 'rows', 8, ''),
+    ('aggregate_sql_time', 'agg sql s', 10, '.3f'),
+    ('aggregate_rows', 'agg rows', 9, ''),
+]
+PROFILE_SORTS = ['duration', 'sql_time', 'python_time', 'queries', 'rows',
+                 'aggregate_sql_time', 'aggregate_rows']
+
+
 class Command(BaseCommand):
     """
     Command to loop through all alarms and evaluate if they should be turned
@@ -21,6 +44,30 @@ class Command(BaseCommand):
                             help='Alarms to check should contain these\
                                   metrics',
                             default=[])
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of monitor batches evaluated at \
+                                  once, each with its own db connection')
+        parser.add_argument('--deadline', type=int,
+                            default=settings.MONITOR_EVALUATION_DEADLINE,
+                            help='Seconds after which monitors not yet \
+                                  evaluated are skipped, 0 for no deadline')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Evaluate without saving anything, creating \
+                                  alerts or sending email')
+        parser.add_argument('--profile', action='store_true',
+                            help='Report the queries, sql and python time \
+                                  and rows of each monitor evaluated')
+        parser.add_argument('--sort', choices=PROFILE_SORTS,
+                            default='duration',
+                            help='Profile column to sort by, descending')
+        parser.add_argument('--top', type=int, default=0,
+                            help='Only report the first monitors of the \
+                                  profile, 0 for all')
+        parser.add_argument('--explain', type=int, default=0,
+                            help='EXPLAIN ANALYZE the slowest query of this \
+                                  many of the slowest monitors')
+        parser.add_argument('--format', choices=['table', 'json'],
+                            default='table', help='Format of the profile')
 
     def handle(self, *args, **options):
         '''method called by manager'''
@@ -40,6 +87,95 @@ class Command(BaseCommand):
         if len(metrics) != 0:
             monitors = monitors.filter(metric__name__in=metrics)
 
-        # Evaluate each alarm
-        for monitor in monitors:
-            monitor.evaluate_alarm(endtime=endtime)
+        dry_run = options['dry_run']
+        profiles = {} if options['profile'] else None
+        # a dry run doesn't write, so it can run alongside a real one
+        lock = nullcontext(True) if dry_run else \
+            advisory_lock(EVALUATE_ALARMS_LOCK)
+        with lock as acquired:
+            if not acquired:
+                self.stdout.write(
+                    'Another evaluate_alarms is running, skipping this run')
+                return
+
+            # Evaluate each alarm, monitors sharing a metric and window get
+            # their aggregates from a single query
+            evaluations = evaluate_monitors(
+                monitors, endtime, workers=options['workers'],
+                deadline=options['deadline'] or None, dry_run=dry_run,
+                profiles=profiles)
+
+        if not dry_run:
+            prune_evaluations(endtime)
+
+        if profiles is not None:
+            self.write_profile(evaluations, profiles, options)
+        if options['format'] != 'json' and options['verbosity'] >= 1:
+            self.write_summary(evaluations, dry_run)
+        errors = [evaluation for evaluation in evaluations
+                  if evaluation.status == MonitorEvaluation.Status.ERROR]
+        if errors:
+            raise CommandError('\n'.join(
+                f'Monitor {evaluation.monitor_id}: {evaluation.error}'
+                for evaluation in errors))
+
+    def write_summary(self, evaluations, dry_run):
+        statuses = Counter(evaluation.status for evaluation in evaluations)
+        slowest = max(evaluations, key=lambda e: e.duration, default=None)
+        summary = ', '.join(f'{count} {status}'
+                            for status, count in sorted(statuses.items()))
+        self.stdout.write(
+            f'Evaluated {len(evaluations)} monitor(s): {summary}')
+        if slowest:
+            self.stdout.write(
+                f'Slowest: monitor {slowest.monitor_id} '
+                f'{slowest.duration:.2f}s, {slowest.query_count} queries')
+        if dry_run:
+            self.stdout.write('Dry run, nothing was saved')
+
+    def write_profile(self, evaluations, profiles, options):
+        '''
+        Report the profile of each monitor evaluated, as a table or json,
+        with the plans of the slowest queries
+        '''
+        rows = []
+        for evaluation in evaluations:
+            profile = profiles.get(evaluation.monitor_id)
+            if profile is None:
+                continue
+            rows.append({
+                'monitor': evaluation.monitor_id,
+                'name': evaluation.monitor.name,
+                'status': evaluation.status,
+                'duration': evaluation.duration,
+                'python_time': evaluation.duration - profile['sql_time'],
+                **profile,
+            })
+        rows.sort(key=lambda row: row[options['sort']], reverse=True)
+        if options['top']:
+            rows = rows[:options['top']]
+
+        slowest = sorted(rows, key=lambda row: row['duration'], reverse=True)
+        for row in slowest[:options['explain']]:
+            query = row['slowest_query']
+            if query:
+                row['explain'] = explain_analyze(query['sql'],
+                                                 query['params'])
+
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(rows, indent=2, default=str))
+            return
+        self.stdout.write(' '.join(
+            f'{heading:>{width}}'
+            for _, heading, width, _ in PROFILE_COLUMNS))
+        for row in rows:
+            self.stdout.write(' '.join(
+                f'{row[key]:>{width}{spec}}'
+                for key, _, width, spec in PROFILE_COLUMNS))
+        for row in rows:
+            if 'explain' in row:
+                query = row['slowest_query']
+                plan = '\n'.join(row['explain'])
+                self.stdout.write(
+                    f'\nMonitor {row["monitor"]}, slowest query '
+                    f'{query["duration"]:.3f}s:\n{query["sql"]}\n{plan}')
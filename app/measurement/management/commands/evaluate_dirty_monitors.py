@@ -0,0 +1,98 @@
+'''
+Evaluate the monitors of series that have been ingested since they were last
+evaluated (see measurement.ingest). Needs
+settings.MONITOR_INCREMENTAL_EVALUATION, so ingest marks series as dirty.
+
+Run a single pass:
+$: ./mg.sh 'evaluate_dirty_monitors'
+
+Run as a long lived process, checking for dirty series every 30 seconds:
+$: ./mg.sh 'evaluate_dirty_monitors --loop --interval=30 --workers=4'
+'''
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from measurement.evaluation import EVALUATE_DIRTY_LOCK, advisory_lock
+from measurement.ingest import evaluate_dirty
+from measurement.models import MonitorEvaluation
+
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Re-evaluate monitors whose measurements changed
+    '''
+    help = 'Evaluate monitors with newly ingested measurements'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--debounce',
+            type=int,
+            default=settings.MONITOR_INCREMENTAL_DEBOUNCE,
+            help="Seconds a series must be quiet before it is evaluated"
+        )
+        parser.add_argument(
+            '--max_delay',
+            type=int,
+            default=settings.MONITOR_INCREMENTAL_MAX_DELAY,
+            help="Seconds after which a series is evaluated even if it is "
+                 "still being written"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of monitor batches evaluated at once"
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help="Keep checking for dirty series until interrupted"
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=30,
+            help="Seconds between checks with --loop"
+        )
+
+    def handle(self, *args, **options):
+        if not settings.MONITOR_INCREMENTAL_EVALUATION:
+            self.stdout.write('Incremental evaluation is off '
+                              '(SQUAC_MONITOR_INCREMENTAL_EVALUATION)')
+            return
+
+        with advisory_lock(EVALUATE_DIRTY_LOCK) as acquired:
+            if not acquired:
+                self.stdout.write(
+                    'Another evaluate_dirty_monitors is running, exiting')
+                return
+            while True:
+                self.evaluate(options)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+    def evaluate(self, options):
+        try:
+            evaluations = evaluate_dirty(
+                options['debounce'], options['max_delay'],
+                workers=options['workers'])
+        except Exception as e:
+            if not options['loop']:
+                raise
+            # keep the loop alive, e.g. across a db restart
+            self.stderr.write(f'Evaluation failed: {e}')
+            connection.close_if_unusable_or_obsolete()
+            return
+        if not evaluations:
+            return
+        errors = [evaluation for evaluation in evaluations
+                  if evaluation.status == MonitorEvaluation.Status.ERROR]
+        self.stdout.write(f'Evaluated {len(evaluations)} monitor(s), '
+                          f'{len(errors)} error(s)')
+        for evaluation in errors:
+            self.stderr.write(
+                f'Monitor {evaluation.monitor_id}: {evaluation.error}')
@@ -0,0 +1,98 @@
+'''
+Evaluate the monitors that are due, each at the rate of its metric (see
+measurement.scheduler). Replaces running evaluate_alarms every hour.
+
+Run a single tick, e.g. every minute from cron:
+$: ./mg.sh 'evaluate_due_monitors --workers=4'
+
+Run as a long lived process, ticking every 60 seconds:
+$: ./mg.sh 'evaluate_due_monitors --loop --interval=60 --workers=4'
+'''
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from measurement.evaluation import (EVALUATE_ALARMS_LOCK, advisory_lock,
+                                    prune_evaluations)
+from measurement.models import MonitorEvaluation
+from measurement.scheduler import evaluate_due
+
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Evaluate monitors whose next evaluation is due
+    '''
+    help = 'Evaluate monitors that are due at their metric\'s sample rate'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of monitor batches evaluated at once"
+        )
+        parser.add_argument(
+            '--deadline',
+            type=int,
+            default=settings.MONITOR_EVALUATION_DEADLINE,
+            help="Seconds after which monitors not yet evaluated are left "
+                 "due for the next tick, 0 for no deadline"
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=0,
+            help="Most monitors evaluated per tick, most overdue first, "
+                 "0 for all due"
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help="Keep ticking until interrupted"
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=60,
+            help="Seconds between ticks with --loop"
+        )
+
+    def handle(self, *args, **options):
+        # shares the lock of evaluate_alarms, so the two don't overlap
+        with advisory_lock(EVALUATE_ALARMS_LOCK) as acquired:
+            if not acquired:
+                self.stdout.write(
+                    'Another monitor evaluation is running, skipping')
+                return
+            while True:
+                self.evaluate(options)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+    def evaluate(self, options):
+        try:
+            evaluations = evaluate_due(
+                workers=options['workers'],
+                deadline=options['deadline'] or None,
+                limit=options['limit'] or None)
+            # evaluations are recorded every tick, keep the retained days
+            prune_evaluations()
+        except Exception as e:
+            if not options['loop']:
+                raise
+            # keep the loop alive, e.g. across a db restart
+            self.stderr.write(f'Evaluation failed: {e}')
+            connection.close_if_unusable_or_obsolete()
+            return
+        if not evaluations:
+            return
+        errors = [evaluation for evaluation in evaluations
+                  if evaluation.status == MonitorEvaluation.Status.ERROR]
+        self.stdout.write(f'Evaluated {len(evaluations)} monitor(s), '
+                          f'{len(errors)} error(s)')
+        for evaluation in errors:
+            self.stderr.write(
+                f'Monitor {evaluation.monitor_id}: {evaluation.error}')
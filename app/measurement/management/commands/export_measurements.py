@@ -0,0 +1,127 @@
+'''
+Export measurements to a storage backend, one file per day and metric with a
+manifest per day (see measurement.export). Unlike s3_query_export this works
+against any postgres database and storage.
+
+Export last week to the default storage (settings.MEASUREMENT_EXPORT_STORAGE):
+$: ./mg.sh 'export_measurements'
+
+Export a date range (inclusive) to a local directory with 8 workers:
+$: ./mg.sh 'export_measurements --start_date=2021-03-01
+            --end_date=2021-03-07 --storage=/tmp/exports --workers=8'
+
+Export single metrics, as parquet (requires pyarrow):
+$: ./mg.sh 'export_measurements --metric=12 --metric=13 --format=parquet'
+
+Skip files that already exist (default is overwrite):
+$: ./mg.sh 'export_measurements --no_overwrite'
+'''
+from django.core.management.base import BaseCommand, CommandError
+
+from measurement.export import FORMATS, ExportError, export_days
+from measurement.storage import StorageError, get_storage
+
+from datetime import datetime, timedelta
+import pytz
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Export measurements per day and metric to a storage backend
+    '''
+    help = 'Export measurements to local or s3 storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+            default=(datetime.now(tz=pytz.utc) - timedelta(days=7)).date(),
+            help="First day to export (inclusive, format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--end_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+            default=(datetime.now(tz=pytz.utc) - timedelta(days=1)).date(),
+            help="Last day to export (inclusive, format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--metric',
+            action='append',
+            type=int,
+            default=[],
+            help="Export a specific metric, by id (default: all metrics)"
+        )
+        parser.add_argument(
+            '--storage',
+            help=("Directory or s3://bucket/prefix to export to (default: "
+                  "settings.MEASUREMENT_EXPORT_STORAGE)")
+        )
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            default='npz',
+            help="File format (default: npz)"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of day/metric files to export at once (default: 4)"
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=10000,
+            help="Rows fetched from the db at a time"
+        )
+        parser.add_argument(
+            '--no_overwrite',
+            action='store_true',
+            help="Don't overwrite existing files"
+        )
+
+    def handle(self, *args, **options):
+        '''method called by manager'''
+        try:
+            storage = get_storage(options['storage'])
+        except StorageError as e:
+            raise CommandError(str(e))
+
+        start_date, end_date = options['start_date'], options['end_date']
+        days = [start_date + timedelta(days=n)
+                for n in range((end_date - start_date).days + 1)]
+        self.stdout.write(
+            f"Exporting {start_date} to {end_date} to {storage}")
+
+        def report(task, entry, error):
+            prefix = f'{task.day} metric {task.metric}'
+            if error is not None:
+                self.stderr.write(f'{prefix} failed: {error}')
+            elif entry is None:
+                self.stdout.write(f'{prefix} exists, skipped')
+            else:
+                self.stdout.write(
+                    f"{prefix}: {entry['rows']} rows, {entry['bytes']} bytes "
+                    f"in {entry['seconds']:.1f}s")
+
+        started = time.monotonic()
+        try:
+            exported, errors = export_days(
+                storage, days, metrics=options['metric'],
+                fmt=options['format'], workers=max(options['workers'], 1),
+                overwrite=not options['no_overwrite'],
+                chunk_size=options['chunk_size'], report=report)
+        except (ExportError, StorageError) as e:
+            raise CommandError(str(e))
+
+        elapsed = time.monotonic() - started
+        rows = sum(entry['rows'] for entry in exported)
+        self.stdout.write(
+            f'Exported {len(exported)} file(s), {rows} rows in '
+            f'{elapsed:.1f}s ({rows / max(elapsed, 1e-6):.0f} rows/s)')
+        if errors:
+            raise CommandError(
+                'Export failed for: ' + ', '.join(
+                    f'{task.day} metric {task.metric}'
+                    for task, _ in errors))
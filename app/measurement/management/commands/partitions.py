@@ -0,0 +1,200 @@
+'''
+Manage the daily partitions of measurement_measurement, or with
+--table=alert the monthly partitions of measurement_alert
+
+Show partitions with their size and estimated rows, and any gaps:
+$: ./mg.sh 'partitions status'
+
+Create alert partitions 3 months ahead:
+$: ./mg.sh 'partitions create --table=alert --horizon=3'
+
+Create partitions 15 days ahead and fill gaps:
+$: ./mg.sh 'partitions create --horizon=15'
+
+Detach and drop partitions older than 400 days, if they have been archived
+and exported (defaults to settings.MEASUREMENT_RETENTION_DAYS, or
+settings.ALERT_RETENTION_DAYS for alerts, whose partitions are kept while
+they hold the latest alert of a trigger in alarm):
+$: ./mg.sh 'partitions retire --retention=400'
+
+Move partitions to the index profile for their age (see
+settings.MEASUREMENT_INDEX_POLICY), --dry_run only lists the changes:
+$: ./mg.sh 'partitions indexes --dry_run'
+
+Refresh planner statistics after a bulk load:
+$: ./mg.sh 'partitions analyze --start_date=2021-03-01 --end_date=2021-03-07'
+'''
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from measurement.partitions import PARTITIONED_TABLES, PartitionError
+
+from datetime import datetime, timedelta
+import pytz
+
+
+def format_size(size):
+    ''' bytes to a human readable string '''
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class Command(BaseCommand):
+    '''
+    Partition lifecycle for measurement_measurement and measurement_alert:
+    status, create, retire, indexes and analyze
+    '''
+    help = 'Manage measurement and alert table partitions'
+
+    RETENTION_SETTINGS = {
+        'measurement': 'MEASUREMENT_RETENTION_DAYS',
+        'alert': 'ALERT_RETENTION_DAYS',
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action',
+            choices=['status', 'create', 'retire', 'indexes', 'analyze'],
+            help='What to do with the partitions'
+        )
+        parser.add_argument(
+            '--table',
+            choices=list(PARTITIONED_TABLES),
+            default='measurement',
+            help='Which partitioned table to manage'
+        )
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            default=15,
+            help=("create: number of partitions (days, or months for alerts) "
+                  "ahead to create")
+        )
+        parser.add_argument(
+            '--retention',
+            type=int,
+            help=("retire: partitions older than this many days are detached "
+                  "and dropped. 0 keeps everything. Defaults to the table's "
+                  "retention setting")
+        )
+        parser.add_argument(
+            '--detach_only',
+            action='store_true',
+            help="retire: detach partitions but don't drop them"
+        )
+        parser.add_argument(
+            '--skip_verify',
+            action='store_true',
+            help="retire: don't check archives and exports first"
+        )
+        parser.add_argument(
+            '--dry_run',
+            action='store_true',
+            help="indexes: only list the indexes that would change"
+        )
+        parser.add_argument(
+            '--partition',
+            action='append',
+            default=[],
+            help='analyze: name of a partition to analyze'
+        )
+        parser.add_argument(
+            '--start_date',
+            type=lambda s: pytz.utc.localize(datetime.strptime(s, "%Y-%m-%d")),
+            help="analyze: first day to analyze (format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--end_date',
+            type=lambda s: pytz.utc.localize(datetime.strptime(s, "%Y-%m-%d")),
+            help="analyze: last day to analyze, inclusive"
+        )
+
+    def handle(self, *args, **options):
+        '''method called by manager'''
+        manager = PARTITIONED_TABLES[options['table']]()
+        if options['retention'] is None:
+            options['retention'] = getattr(
+                settings, self.RETENTION_SETTINGS[options['table']])
+        try:
+            getattr(self, f"handle_{options['action']}")(manager, options)
+        except PartitionError as e:
+            raise CommandError(str(e))
+
+    def handle_status(self, manager, options):
+        if not manager.is_partitioned():
+            self.stdout.write(f'{manager.table} is not partitioned')
+            return
+
+        partitions = manager.list_partitions()
+        for p in partitions:
+            self.stdout.write(
+                f"{p.name:<40} {p.start.strftime('%Y-%m-%d')} "
+                f"{format_size(p.size):>10} {p.rows:>14,} rows "
+                f"{manager.profile_for(p) or ''}")
+
+        total_size = sum(p.size for p in partitions)
+        total_rows = sum(p.rows for p in partitions)
+        self.stdout.write(
+            f'{len(partitions)} partitions, {format_size(total_size)}, '
+            f'~{total_rows:,} rows')
+
+        if partitions:
+            gaps = manager.missing_periods(partitions[-1].start,
+                                           since=manager.fill_start())
+            if gaps:
+                self.stdout.write('Missing partitions: ' + ', '.join(
+                    manager.partition_name(gap) for gap in gaps))
+
+    def handle_create(self, manager, options):
+        created, errors = manager.ensure_horizon(options['horizon'])
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        if errors:
+            raise CommandError('\n'.join(errors))
+
+    def handle_retire(self, manager, options):
+        if options['retention'] <= 0:
+            self.stdout.write('No retention set, nothing to retire')
+            return
+
+        retired, skipped = manager.retire(
+            timedelta(days=options['retention']),
+            drop=not options['detach_only'],
+            verify=not options['skip_verify'])
+
+        action = 'Detached' if options['detach_only'] else 'Dropped'
+        for partition in retired:
+            self.stdout.write(f'{action} {partition.name}')
+        for partition, reasons in skipped:
+            self.stderr.write(
+                f"Kept {partition.name}: {'; '.join(reasons)}")
+
+    def handle_indexes(self, manager, options):
+        changes = manager.apply_index_policy(dry_run=options['dry_run'])
+        prefix = 'Would apply' if options['dry_run'] else 'Applied'
+        for partition, profile, created, dropped in changes:
+            self.stdout.write(
+                f"{prefix} {profile} to {partition.name}: "
+                f"created {', '.join(created) or 'none'}, "
+                f"dropped {', '.join(dropped) or 'none'}")
+        if not changes:
+            self.stdout.write('All partitions match the index policy')
+
+    def handle_analyze(self, manager, options):
+        if options['partition']:
+            partitions = manager.find(options['partition'])
+        else:
+            # default to the partitions of the last two days, the ones
+            # receiving most of the new data
+            now = datetime.now(tz=pytz.UTC)
+            start = options['start_date'] or now - timedelta(days=1)
+            end = (options['end_date'] or now) + timedelta(days=1)
+            partitions = manager.containing(manager.truncate(start),
+                                            manager.truncate(end))
+
+        manager.analyze(partitions)
+        for partition in partitions:
+            self.stdout.write(f'Analyzed {partition.name}')
@@ -0,0 +1,106 @@
+'''
+Replay a monitor over a past range without creating alerts, to see when its
+triggers, or candidate triggers, would have fired (see measurement.replay).
+
+Replay monitor 12's triggers over January:
+$: ./mg.sh 'replay_monitor 12 --start_date=2023-01-01
+            --end_date=2023-02-01'
+
+Try candidate triggers, as json, every 30 minutes:
+$: ./mg.sh 'replay_monitor 12 --start_date=2023-01-01
+            --end_date=2023-02-01 --step=1800
+            --trigger={"val1": 5, "num_channels": 3}'
+'''
+from django.core.management.base import BaseCommand, CommandError
+
+from measurement.models import Monitor, Trigger
+from measurement.replay import ReplayError, replay
+from measurement.serializers import TriggerDefinitionSerializer
+
+from datetime import datetime, timedelta
+import json
+import pytz
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Replay a monitor over past measurements
+    '''
+    help = 'Show when monitor triggers would have fired over a past range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('monitor', type=int, help="Id of the monitor")
+        parser.add_argument(
+            '--start_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").replace(
+                tzinfo=pytz.UTC),
+            required=True,
+            help="First evaluation time (format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--end_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").replace(
+                tzinfo=pytz.UTC),
+            required=True,
+            help="Last evaluation time (format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--step',
+            type=int,
+            default=3600,
+            help="Seconds between evaluations"
+        )
+        parser.add_argument(
+            '--trigger',
+            action='append',
+            type=json.loads,
+            default=[],
+            help="A candidate trigger as json, e.g. "
+                 "'{\"val1\": 5, \"num_channels\": 3}' "
+                 "(default: the monitor's triggers)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            monitor = Monitor.objects.select_related('metric').get(
+                pk=options['monitor'])
+        except Monitor.DoesNotExist:
+            raise CommandError(f"Monitor {options['monitor']} not found")
+
+        triggers = None
+        if options['trigger']:
+            serializer = TriggerDefinitionSerializer(
+                data=options['trigger'], many=True)
+            if not serializer.is_valid():
+                raise CommandError(f'Invalid trigger: {serializer.errors}')
+            triggers = [Trigger(monitor=monitor, **definition)
+                        for definition in serializer.validated_data]
+
+        started = time.monotonic()
+        try:
+            result = replay(monitor, options['start_date'],
+                            options['end_date'], triggers=triggers,
+                            step=timedelta(seconds=options['step']))
+        except ReplayError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Replayed {monitor} over {result['channels']} channel(s) in "
+            f"{time.monotonic() - started:.2f}s")
+        for trigger in result['triggers']:
+            values = [trigger['val1'], trigger['val2']]
+            self.stdout.write(
+                f"Trigger {trigger['trigger'] or '(candidate)'} "
+                f"{trigger['value_operator']} "
+                f"{' '.join(str(v) for v in values if v is not None)}, "
+                f"{trigger['num_channels_operator']} "
+                f"{trigger['num_channels'] or ''}: "
+                f"in alarm {trigger['in_alarm_steps']} step(s), "
+                f"{trigger['alerts']} alert(s)")
+            for step in trigger['timeline']:
+                if step['fired']:
+                    in_out = 'IN' if step['in_alarm'] else 'OUT OF'
+                    self.stdout.write(
+                        f"  {step['endtime']:%Y-%m-%d %H:%M} {in_out} alarm, "
+                        f"{step['breaching_channels']} breaching")
@@ -0,0 +1,133 @@
+'''
+Load measurements exported by export_measurements back into the database,
+e.g. to recover a dropped partition or to seed staging. Partitions are created
+as needed, and each day is loaded into a staging table with parallel COPY
+workers before being merged in (see measurement.restore).
+
+Restore a date range (inclusive) from the default storage
+(settings.MEASUREMENT_EXPORT_STORAGE):
+$: ./mg.sh 'restore_measurements --start_date=2021-03-01
+            --end_date=2021-03-07'
+
+Restore single metrics from a local directory with 8 workers:
+$: ./mg.sh 'restore_measurements --start_date=2021-03-01
+            --end_date=2021-03-01 --storage=/tmp/exports --metric=12
+            --workers=8'
+
+Swap loaded days in as whole partitions when their partition is empty:
+$: ./mg.sh 'restore_measurements --start_date=2021-03-01
+            --end_date=2021-03-07 --swap'
+'''
+from django.core.management.base import BaseCommand, CommandError
+
+from measurement.export import ExportError
+from measurement.partitions import PartitionError, measurement_partitions
+from measurement.restore import restore_days
+from measurement.storage import StorageError, get_storage
+
+from datetime import datetime, timedelta
+import time
+
+
+class Command(BaseCommand):
+    '''
+    Restore exported measurement files
+    '''
+    help = 'Restore exported measurements into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+            required=True,
+            help="First day to restore (inclusive, format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--end_date',
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+            required=True,
+            help="Last day to restore (inclusive, format: YYYY-MM-DD)"
+        )
+        parser.add_argument(
+            '--metric',
+            action='append',
+            type=int,
+            default=[],
+            help="Restore a specific metric, by id (default: all metrics)"
+        )
+        parser.add_argument(
+            '--storage',
+            help=("Directory or s3://bucket/prefix to restore from "
+                  "(default: settings.MEASUREMENT_EXPORT_STORAGE)")
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of files to COPY at once (default: 4)"
+        )
+        parser.add_argument(
+            '--swap',
+            action='store_true',
+            help=("Attach a loaded day as its partition if that partition "
+                  "is empty, instead of merging it")
+        )
+        parser.add_argument(
+            '--skip_verify',
+            action='store_true',
+            help="Don't check file checksums and row counts"
+        )
+
+    def handle(self, *args, **options):
+        '''method called by manager'''
+        try:
+            storage = get_storage(options['storage'])
+        except StorageError as e:
+            raise CommandError(str(e))
+
+        start_date, end_date = options['start_date'], options['end_date']
+        days = [start_date + timedelta(days=n)
+                for n in range((end_date - start_date).days + 1)]
+        self.stdout.write(
+            f"Restoring {start_date} to {end_date} from {storage}")
+
+        def describe(task):
+            # tasks without a metric are days that failed to merge
+            if task.metric is None:
+                return f'{task.day}'
+            return f'{task.day} metric {task.metric}'
+
+        def report(task, rows, seconds, error):
+            prefix = describe(task)
+            if error is not None:
+                self.stderr.write(f'{prefix} failed: {error}')
+            else:
+                self.stdout.write(
+                    f'{prefix}: {rows} rows in {seconds:.1f}s '
+                    f'({rows / max(seconds, 1e-6):.0f} rows/s)')
+
+        started = time.monotonic()
+        try:
+            results, errors = restore_days(
+                storage, measurement_partitions(), days,
+                metrics=options['metric'], workers=max(options['workers'], 1),
+                swap=options['swap'], verify=not options['skip_verify'],
+                report=report)
+        except (ExportError, PartitionError, StorageError) as e:
+            raise CommandError(str(e))
+
+        for result in results:
+            action = 'swapped in' if result.swapped else 'merged'
+            self.stdout.write(
+                f'{result.day}: {result.rows} rows loaded, '
+                f'{result.merged} {action}')
+
+        elapsed = time.monotonic() - started
+        rows = sum(result.rows for result in results)
+        self.stdout.write(
+            f'Restored {len(results)} day(s), {rows} rows in {elapsed:.1f}s '
+            f'({rows / max(elapsed, 1e-6):.0f} rows/s)')
+        if errors:
+            raise CommandError(
+                'Restore failed for: ' + ', '.join(
+                    describe(task) for task, _ in errors))
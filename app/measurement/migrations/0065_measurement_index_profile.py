@@ -0,0 +1,93 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+CONSTRAINT = 'unique on starttime with value'
+COLUMNS = '(metric_id, channel_id, starttime) INCLUDE (value)'
+
+
+def add_unique_constraint(apps, schema_editor):
+    '''
+    Add the covering unique constraint. The index of each partition is built
+    concurrently and made its constraint first, so adding the constraint to
+    the partitioned table only attaches them instead of building them all
+    while holding its lock. Can be run again after an interruption
+    '''
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            '''SELECT c.relname FROM pg_inherits i
+               JOIN pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = 'measurement_measurement'::regclass
+                 AND NOT EXISTS (
+                     SELECT 1 FROM pg_constraint
+                     WHERE conrelid = c.oid AND contype = 'u'
+                       AND conname = c.relname || '_uniq_value')
+               ORDER BY c.relname;''')
+        for partition, in cursor.fetchall():
+            index = f'{partition}_uniq_value'
+            # left invalid by an interrupted build
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index};')
+            cursor.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {index} '
+                           f'ON {partition} {COLUMNS};')
+            cursor.execute(f'ALTER TABLE {partition} ADD CONSTRAINT {index} '
+                           f'UNIQUE USING INDEX {index};')
+        cursor.execute(f'ALTER TABLE measurement_measurement '
+                       f'ADD CONSTRAINT "{CONSTRAINT}" UNIQUE {COLUMNS};')
+
+
+def drop_unique_constraint(apps, schema_editor):
+    ''' dropping it from the partitioned table drops it from partitions '''
+    schema_editor.execute(f'ALTER TABLE measurement_measurement '
+                          f'DROP CONSTRAINT "{CONSTRAINT}";')
+
+
+class Migration(migrations.Migration):
+
+    # indexes are built concurrently, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('nslc', '0021_alter_group_auto_exclude_channels_and_more'),
+        ('measurement', '0064_merge_20250912_2012'),
+    ]
+
+    # the covering constraint is added before the old one is dropped so
+    # upserts always have an arbiter index. The channel_id index of the
+    # foreign key stays, for channel deletes and channel only filters
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_unique_constraint,
+                                     drop_unique_constraint),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='measurement',
+                    constraint=models.UniqueConstraint(fields=('metric', 'channel', 'starttime'), include=('value',), name=CONSTRAINT),
+                ),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='measurement',
+            name='unique on starttime',
+        ),
+        migrations.RemoveIndex(
+            model_name='measurement',
+            name='measurement_startti_7d7fa1_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='measurement',
+            name='measurement_metric__d34887_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='measurement',
+            name='measurement_channel_e743cf_idx',
+        ),
+        migrations.AlterField(
+            model_name='measurement',
+            name='metric',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='measurements', to='measurement.metric'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0065_measurement_index_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorEvaluation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endtime', models.DateTimeField()),
+                ('started_at', models.DateTimeField()),
+                ('duration', models.FloatField(default=0)),
+                ('aggregate_duration', models.FloatField(default=0)),
+                ('query_count', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('ok', 'Ok'), ('error', 'Error'), ('skipped', 'Skipped')], default='ok', max_length=8)),
+                ('error', models.TextField(blank=True, default='')),
+                ('monitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='evaluations', to='measurement.monitor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['monitor', '-started_at'], name='measurement_monitor_d8ba55_idx'), models.Index(fields=['-started_at'], name='measurement_started_b80d24_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nslc', '0021_alter_group_auto_exclude_channels_and_more'),
+        ('measurement', '0066_monitorevaluation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtySeries',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_marked_at', models.DateTimeField()),
+                ('last_marked_at', models.DateTimeField()),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='nslc.channel')),
+                ('metric', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='measurement.metric')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dirtyseries',
+            constraint=models.UniqueConstraint(fields=('metric', 'channel'), name='unique dirty series'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0067_dirtyseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorState',
+            fields=[
+                ('monitor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to='measurement.monitor')),
+                ('evaluated_at', models.DateTimeField()),
+                ('starttime', models.DateTimeField()),
+                ('endtime', models.DateTimeField()),
+                ('watermark', models.DateTimeField(null=True)),
+                ('first_starttime', models.DateTimeField(null=True)),
+                ('channel_values', models.JSONField(default=list)),
+                ('in_alarm', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='last_ingested_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='monitorevaluation',
+            name='status',
+            field=models.CharField(choices=[('ok', 'Ok'), ('error', 'Error'), ('skipped', 'Skipped'), ('unchanged', 'Unchanged'), ('cached', 'Cached')], default='ok', max_length=16),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0068_monitor_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trigger',
+            name='latest_alert',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='measurement.alert'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['trigger', '-timestamp'], name='measurement_trigger_7ed4e0_idx'),
+        ),
+        # backfill from existing alerts
+        migrations.RunSQL(
+            '''
+            UPDATE measurement_trigger SET latest_alert_id = (
+                SELECT id FROM measurement_alert
+                WHERE measurement_alert.trigger_id = measurement_trigger.id
+                ORDER BY timestamp DESC, id DESC
+                LIMIT 1
+            );
+            ''',
+            migrations.RunSQL.noop
+        ),
+    ]
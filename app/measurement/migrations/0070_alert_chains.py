@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0069_trigger_latest_alert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='added_channels',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='removed_channels',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='snapshot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='measurement.alert'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Compacts alert history into chains, separate from 0070 so the new
+# columns' constraints and indexes are in place first
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import F, Subquery
+import pytz
+
+
+def compact_alerts(apps, schema_editor):
+    '''
+    Keep only the alerts where a trigger went in or out of alarm or its
+    breaching channels changed, as chains of changes within a month (see
+    Trigger.create_alert)
+    '''
+    Alert = apps.get_model('measurement', 'Alert')
+    Trigger = apps.get_model('measurement', 'Trigger')
+    for trigger_id in Trigger.objects.values_list('id', flat=True):
+        redundant, changed = [], []
+        previous, previous_channels, chain = None, {}, 0
+        snapshot = snapshot_month = None
+        alerts = Alert.objects.filter(trigger_id=trigger_id).order_by(
+            'timestamp', 'id')
+        for alert in alerts.iterator():
+            channels = {channel['channel_id']: channel
+                        for channel in alert.breaching_channels or []}
+            if previous and alert.in_alarm == previous.in_alarm \
+                    and channels.keys() == previous_channels.keys():
+                redundant.append(alert.id)
+                continue
+            month = alert.timestamp.astimezone(pytz.UTC).replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0)
+            if snapshot is None or chain >= settings.ALERT_SNAPSHOT_EVERY \
+                    or month != snapshot_month:
+                snapshot, snapshot_month, chain = alert, month, 0
+            else:
+                alert.snapshot_id = snapshot.id
+                alert.added_channels = [
+                    channel for channel_id, channel in channels.items()
+                    if channel_id not in previous_channels]
+                alert.removed_channels = [
+                    channel for channel_id, channel in previous_channels.items()
+                    if channel_id not in channels]
+                if previous.snapshot_id:
+                    previous.breaching_channels = None
+                changed.append(alert)
+                chain += 1
+            previous, previous_channels = alert, channels
+
+        Alert.objects.bulk_update(
+            changed, ['snapshot', 'added_channels', 'removed_channels',
+                      'breaching_channels'], batch_size=1000)
+        for start in range(0, len(redundant), 1000):
+            Alert.objects.filter(id__in=redundant[start:start + 1000]).delete()
+        Trigger.objects.filter(pk=trigger_id).update(latest_alert=Subquery(
+            Alert.objects.filter(trigger_id=trigger_id).order_by(
+                '-timestamp', '-id').values('id')[:1]))
+
+
+def expand_alerts(apps, schema_editor):
+    '''
+    Give every alert all of its breaching channels again. Alerts removed by
+    compact_alerts don't come back
+    '''
+    Alert = apps.get_model('measurement', 'Alert')
+    channels, changed = {}, []
+    alerts = Alert.objects.order_by(
+        F('snapshot').asc(nulls_first=True), 'timestamp', 'id')
+    for alert in alerts.iterator():
+        if alert.snapshot_id is None:
+            channels[alert.id] = {channel['channel_id']: channel
+                                  for channel in alert.breaching_channels
+                                  or []}
+            continue
+        current = channels.setdefault(alert.snapshot_id, {})
+        for channel in alert.removed_channels or []:
+            current.pop(channel['channel_id'], None)
+        for channel in alert.added_channels or []:
+            current[channel['channel_id']] = channel
+        alert.breaching_channels = sorted(
+            current.values(), key=lambda channel: channel['channel'])
+        alert.snapshot_id = None
+        changed.append(alert)
+    Alert.objects.bulk_update(changed, ['breaching_channels', 'snapshot'],
+                              batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0070_alert_chains'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_alerts, expand_alerts),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0071_compact_alerts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='alert',
+            name='snapshot',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='measurement.alert'),
+        ),
+        migrations.AlterField(
+            model_name='trigger',
+            name='latest_alert',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='measurement.alert'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(condition=models.Q(('in_alarm', True)), fields=['user', '-timestamp'], name='alert_user_in_alarm_idx'),
+        ),
+    ]
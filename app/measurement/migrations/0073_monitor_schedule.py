@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0072_alert_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorSchedule',
+            fields=[
+                ('monitor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='schedule', serialize=False, to='measurement.monitor')),
+                ('next_due', models.DateTimeField(db_index=True)),
+                ('last_endtime', models.DateTimeField()),
+                ('scheduled_at', models.DateTimeField()),
+            ],
+        ),
+    ]
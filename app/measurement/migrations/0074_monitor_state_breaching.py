@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0073_monitor_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monitorstate',
+            name='breaching',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='monitorstate',
+            name='duration',
+            field=models.FloatField(default=0),
+        ),
+    ]
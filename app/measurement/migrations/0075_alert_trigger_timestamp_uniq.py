@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0074_monitor_state_breaching'),
+    ]
+
+    operations = [
+        # spread alerts of a trigger sharing a timestamp a microsecond apart,
+        # in id order, so chains and latest alerts stay as they are
+        migrations.RunSQL(
+            '''
+            UPDATE measurement_alert SET timestamp = duplicate.timestamp
+            FROM (
+                SELECT id, timestamp + (row_number() OVER (
+                    PARTITION BY trigger_id, timestamp ORDER BY id
+                ) - 1) * interval '1 microsecond' AS timestamp
+                FROM measurement_alert
+            ) AS duplicate
+            WHERE measurement_alert.id = duplicate.id
+              AND measurement_alert.timestamp <> duplicate.timestamp;
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.AddConstraint(
+            model_name='alert',
+            constraint=models.UniqueConstraint(fields=('trigger', 'timestamp'), name='alert_trigger_timestamp_uniq'),
+        ),
+    ]
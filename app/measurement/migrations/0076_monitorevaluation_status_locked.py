@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('measurement', '0075_alert_trigger_timestamp_uniq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='monitorevaluation',
+            name='status',
+            field=models.CharField(choices=[('ok', 'Ok'), ('error', 'Error'), ('skipped', 'Skipped'), ('unchanged', 'Unchanged'), ('cached', 'Cached'), ('locked', 'Locked')], default='ok', max_length=16),
+        ),
+    ]
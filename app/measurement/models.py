@@ -1,18 +1,21 @@
-from django.db import models
-from django.db.models import (Avg, Count, Max, Min, Sum, F, Value,
-                              IntegerField, FloatField)
-from django.db.models.functions import Abs
+from django.db import connection, models
+from django.db.models import (Avg, BooleanField, Count, ExpressionWrapper,
+                              Max, Min, Sum, F, OuterRef, Q, Subquery, Window)
+from django.db.models.functions import Abs, RowNumber, TruncDay
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 
+from core.mail import queue_mail
 from measurement.aggregates.percentile import Percentile
 from nslc.models import Channel, Group
 
+from collections import defaultdict
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from functools import reduce
+import numpy as np
 import pytz
 import operator
 from measurement.fields import EmailListArrayField
@@ -54,6 +57,9 @@ class Metric(MeasurementBase):
     default_maxval = models.FloatField(blank=True, null=True)
     reference_url = models.CharField(max_length=255)
     sample_rate = models.IntegerField(default=3600)
+    # when measurements of this metric were last ingested, see
+    # measurement.ingest. Null when unknown
+    last_ingested_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         indexes = [
@@ -63,10 +69,15 @@ class Metric(MeasurementBase):
 
 class Measurement(MeasurementBase):
     '''describes the observable metrics'''
+    # metric lookups are served by the unique constraint, which starts with
+    # metric_id. channel keeps its own index for channel deletes and channel
+    # only filters. Other indexes are added per partition (see
+    # measurement.partitions)
     metric = models.ForeignKey(
         Metric,
         on_delete=models.CASCADE,
-        related_name='measurements'
+        related_name='measurements',
+        db_index=False
     )
     channel = models.ForeignKey(
         Channel,
@@ -78,16 +89,13 @@ class Measurement(MeasurementBase):
     endtime = models.DateTimeField()
 
     class Meta:
-        indexes = [
-            # index in desc order (newest first)
-            models.Index(fields=['-starttime']),
-            models.Index(fields=['metric']),
-            models.Index(fields=['channel']),
-        ]
         constraints = [
+            # covers value so "metric IN, channel IN, starttime range" reads
+            # can be index only scans
             models.UniqueConstraint(
                 fields=["metric", "channel", "starttime"],
-                name="unique on starttime"
+                include=["value"],
+                name="unique on starttime with value"
             ),
         ]
 
@@ -147,6 +155,17 @@ class Monitor(MeasurementBase):
     name = models.CharField(max_length=255, default='')
     do_daily_digest = models.BooleanField(default=False)
 
+    # LASTN looks back this many sample periods per value, but no more
+    # than LASTN_MAX_GAPS beyond the interval_count periods themselves
+    LASTN_WINDOW_FACTOR = 2
+    LASTN_MAX_GAPS = timedelta(weeks=1)
+    # longest time between scheduled evaluations, in seconds
+    DAY = 24 * 60 * 60
+    # stats that day archives combine into exactly (up to float rounding).
+    # minabs isn't, for days with values either side of zero, nor are the
+    # percentiles
+    ARCHIVE_STATS = {'count', 'sum', 'avg', 'min', 'max', 'maxabs'}
+
     def calc_interval_seconds(self):
         '''Return the number of seconds in the alarm interval'''
         seconds = self.interval_count
@@ -162,51 +181,60 @@ class Monitor(MeasurementBase):
 
         return seconds
 
+    def calc_starttime(self, endtime):
+        '''
+        Return the start of the window of measurements to aggregate. LASTN
+        isn't time based, so look back far enough for the last
+        interval_count samples at the metric's sample rate, allowing for gaps
+        of up to as long again, or LASTN_MAX_GAPS
+        '''
+        if self.interval_type == self.IntervalType.LASTN:
+            samples = timedelta(seconds=max(self.metric.sample_rate, 1)) * \
+                self.interval_count
+            gaps = min(samples * (self.LASTN_WINDOW_FACTOR - 1),
+                       self.LASTN_MAX_GAPS)
+            return endtime - samples - gaps
+        return endtime - timedelta(seconds=self.calc_interval_seconds())
+
+    def evaluation_period(self):
+        '''
+        Seconds between scheduled evaluations (see measurement.scheduler).
+        The aggregates only change when a measurement enters the window,
+        every sample_rate, or leaves it, so the shorter of the two. Metrics
+        without a sample rate are evaluated hourly
+        '''
+        endtime = datetime.now(tz=pytz.UTC)
+        window = (endtime - self.calc_starttime(endtime)).total_seconds()
+        sample_rate = self.metric.sample_rate
+        if sample_rate <= 0:
+            sample_rate = 60 * 60
+        period = min(sample_rate, window or self.DAY)
+        return int(min(max(period, settings.MONITOR_SCHEDULE_MIN_PERIOD),
+                       self.DAY))
+
     def agg_measurements(self, endtime=None):
         '''
         Gather all measurements for the alarm and calculate aggregate values
+        for each channel of the group
         '''
         if not endtime:
             endtime = datetime.now(tz=pytz.UTC)
-        group = self.channel_group
-        metric = self.metric
-        q_data = Measurement.objects.none()
-
-        # q_list is returned to the caller
-        q_list = []
-
-        # Get a QuerySet containing only measurements for the correct time
-        # period and metric for this alarm
-        if self.interval_type == self.IntervalType.LASTN:
-            # 10/27/23 CWU: Temporarily disable LASTN evaluation since it was
-            # taking too many db resources
-            return q_list
-
-            # Special case that isn't time-based
-            # Restrict time window to reduce query time
-            starttime = endtime - timedelta(weeks=1)
-            measurement_ids = []
-            for channel in group.channels.all():
-                measurements = metric.measurements.filter(
-                    starttime__range=(starttime, endtime),
-                    channel=channel
-                ).order_by(
-                    '-starttime')[:self.interval_count]
-                measurement_ids += list(
-                    measurements.values_list('id', flat=True)
-                )
-
-            q_data = Measurement.objects.filter(id__in=measurement_ids)
-        else:
-            seconds = self.calc_interval_seconds()
-            starttime = endtime - timedelta(seconds=seconds)
-            q_data = metric.measurements.filter(
-                starttime__range=(starttime, endtime),
-                channel__in=group.channels.all()
-            )
-
-        # Now calculate the aggregate values for each channel
-        q_data = q_data.values('channel').annotate(
+        channel_ids = list(Group.channels.through.objects.filter(
+            group_id=self.channel_group_id).values_list(
+            'channel_id', flat=True))
+        last_n = (self.interval_count
+                  if self.interval_type == self.IntervalType.LASTN else None)
+        values = self.aggregate_channels(
+            self.metric_id, channel_ids, self.calc_starttime(endtime),
+            endtime, last_n=last_n, stats={self.stat})
+
+        # Channels without measurements get empty values
+        return self.fill_channel_values(channel_ids, values)
+
+    @staticmethod
+    def aggregates():
+        '''The aggregate for each Stat, by name'''
+        return dict(
             count=Count('value'),
             sum=Sum('value'),
             avg=Avg('value'),
@@ -219,112 +247,370 @@ class Monitor(MeasurementBase):
             p95=Percentile('value', percentile=0.95)
         )
 
-        # Get default values if there are no measurements
-        q_default = group.channels.values(channel=F('id')).annotate(
-            count=Value(0, output_field=IntegerField()),
-            sum=Value(None, output_field=FloatField()),
-            avg=Value(None, output_field=FloatField()),
-            max=Value(None, output_field=FloatField()),
-            min=Value(None, output_field=FloatField()),
-            maxabs=Value(None, output_field=FloatField()),
-            minabs=Value(None, output_field=FloatField()),
-            median=Value(None, output_field=FloatField()),
-            p90=Value(None, output_field=FloatField()),
-            p95=Value(None, output_field=FloatField())
+    @classmethod
+    def aggregate_channels(cls, metric_id, channel_ids, starttime, endtime,
+                           last_n=None, stats=None):
+        '''
+        Calculate aggregate values of a metric for many channels at once.
+        With last_n, only the last_n most recent measurements of each channel
+        in the window are used. When only stats are needed and they can be
+        combined from day archives, settled days of the window are read from
+        ArchiveDay (see aggregate_archived). Returns {channel id: values} for
+        the channels that have measurements
+        '''
+        if not channel_ids:
+            return {}
+        if not last_n and stats and set(stats) <= cls.ARCHIVE_STATS:
+            values = cls.aggregate_archived(metric_id, channel_ids,
+                                            starttime, endtime)
+            if values is not None:
+                return values
+        q_data = cls.window_measurements(metric_id, channel_ids, starttime,
+                                         endtime, last_n)
+
+        # first_starttime tells which measurements leave the window as it
+        # moves, see MonitorState
+        q_data = q_data.values('channel').annotate(
+            first_starttime=Min('starttime'), **cls.aggregates())
+        return {obj['channel']: obj for obj in q_data}
+
+    @staticmethod
+    def window_measurements(metric_id, channel_ids, starttime, endtime,
+                            last_n=None):
+        '''
+        The measurements of a metric for channel_ids between starttime and
+        endtime, only the last_n most recent of each channel with last_n
+        '''
+        q_data = Measurement.objects.filter(
+            metric_id=metric_id,
+            starttime__range=(starttime, endtime),
+            channel__in=channel_ids
         )
+        if last_n:
+            # Rank each channel's measurements newest first, all in one
+            # query. The outer filter is kept so partitions are pruned
+            ranked = q_data.annotate(row_number=Window(
+                RowNumber(),
+                partition_by=F('channel'),
+                order_by=F('starttime').desc()
+            )).filter(row_number__lte=last_n)
+            q_data = q_data.filter(id__in=ranked.values('id'))
+        return q_data
+
+    def can_filter_breaches(self):
+        '''
+        Whether the database can find the breaching channels itself (see
+        aggregate_breaching): channels without measurements have no row, so
+        not when a trigger breaches at a count of 0
+        '''
+        triggers = self.triggers.all()
+        if not triggers:
+            return False
+        if self.stat != self.Stat.COUNT:
+            return True
+        return not any(trigger.breaching_mask(np.zeros(1))[0]
+                       for trigger in triggers)
 
-        # Combine querysets in case of zero measurements. Kludgy but
-        # shouldn't strain the db as much?
-        q_dict = {obj['channel']: obj for obj in q_data}
-        for chan_default in q_default:
-            if chan_default['channel'] not in q_dict:
-                q_list.append(chan_default)
-            else:
-                q_list.append(q_dict[chan_default['channel']])
+    def aggregate_breaching(self, channel_ids, starttime, endtime):
+        '''
+        The breaching channels of each trigger as {trigger id: channels, as
+        from Trigger.get_breaching_channels}, with the triggers' conditions
+        evaluated by the database: the stat of each channel is only
+        returned when it breaches a trigger (HAVING), with a flag for each
+        trigger and the channel's NSLC
+        '''
+        triggers = list(self.triggers.all())
+        last_n = (self.interval_count
+                  if self.interval_type == self.IntervalType.LASTN else None)
+        flags = {
+            f'breaches_{trigger.id}': ExpressionWrapper(
+                trigger.breach_q('value'), output_field=BooleanField())
+            for trigger in triggers
+        }
+        rows = self.window_measurements(
+            self.metric_id, channel_ids, starttime, endtime, last_n).values(
+            'channel', 'channel__network_id', 'channel__station_code',
+            'channel__loc', 'channel__code').annotate(
+            value=self.aggregates()[self.stat]).annotate(**flags).filter(
+            reduce(operator.or_, [trigger.breach_q('value')
+                                  for trigger in triggers]))
+
+        breaches = {trigger.id: [] for trigger in triggers}
+        for row in rows:
+            nslc = '.'.join((row['channel__network_id'],
+                             row['channel__station_code'],
+                             row['channel__loc'],
+                             row['channel__code'])).upper()
+            channel = {'channel': nslc, 'channel_id': row['channel'],
+                       self.stat: row['value'], 'value': row['value']}
+            for trigger in triggers:
+                if row[f'breaches_{trigger.id}']:
+                    breaches[trigger.id].append(channel)
+        for channels in breaches.values():
+            channels.sort(key=lambda channel: channel['channel'])
+        return breaches
+
+    @staticmethod
+    def archived_days(metric_id, starttime, endtime):
+        '''
+        The days fully inside starttime-endtime whose day archives of the
+        metric were all written at least MONITOR_ARCHIVE_SETTLE_HOURS after
+        the day ended, so they include measurements ingested late
+        '''
+        first = starttime + relativedelta(
+            hour=0, minute=0, second=0, microsecond=0)
+        if first < starttime:
+            first += timedelta(days=1)
+        last = endtime - relativedelta(
+            hour=0, minute=0, second=0, microsecond=0)
+        if last <= first:
+            return []
+        settle = timedelta(days=1,
+                           hours=settings.MONITOR_ARCHIVE_SETTLE_HOURS)
+        written = ArchiveDay.objects.filter(
+            metric_id=metric_id, starttime__gte=first,
+            starttime__lt=last).annotate(
+            day=TruncDay('starttime', tzinfo=pytz.UTC)).values(
+            'day').annotate(written=Min('updated_at'))
+        return sorted(row['day'] for row in written
+                      if row['written'] >= row['day'] + settle)
+
+    @classmethod
+    def aggregate_archived(cls, metric_id, channel_ids, starttime, endtime):
+        '''
+        aggregate_channels for ARCHIVE_STATS, combining the day archives of
+        archived_days with the raw measurements of the rest of the window.
+        A channel without an archive of an archived day, e.g. left out of a
+        partial backfill, has that day read from its measurements. Other
+        stats are None. Returns None when no day of the window is archived
+        '''
+        days = cls.archived_days(metric_id, starttime, endtime)
+        if not days:
+            return None
+        one_day = timedelta(days=1)
+
+        archived = ArchiveDay.objects.filter(
+            reduce(operator.or_, [
+                Q(starttime__gte=day, starttime__lt=day + one_day)
+                for day in days]),
+            metric_id=metric_id, channel__in=channel_ids).values_list(
+            'channel', 'starttime', 'num_samps', 'mean', 'min', 'max')
+        rows = []
+        covered = defaultdict(set)
+        for channel, start, num_samps, mean, low, high in archived:
+            covered[start.astimezone(pytz.UTC) - relativedelta(
+                hour=0, minute=0, second=0, microsecond=0)].add(channel)
+            rows.append({
+                'channel': channel, 'first_starttime': start,
+                'count': num_samps, 'sum': mean * num_samps,
+                'min': low, 'max': high, 'maxabs': max(abs(low), abs(high))})
+
+        # the window minus the archived days, where every channel is read
+        # from measurements, and the archived days of the channels without
+        # an archive. The last range ends at endtime inclusive like the raw
+        # query. Consecutive days missing the same channels share a range
+        ranges = []
+        start = starttime
+        for day in days:
+            if start < day:
+                ranges.append([start, day, None])
+            missing = sorted(set(channel_ids) - covered[day])
+            if missing:
+                if ranges and ranges[-1][1] == day \
+                        and ranges[-1][2] == missing:
+                    ranges[-1][1] = day + one_day
+                else:
+                    ranges.append([day, day + one_day, missing])
+            start = day + one_day
+        raw_ranges = [Q(starttime__gte=start, starttime__lte=endtime)]
+        for start, end, missing in ranges:
+            q = Q(starttime__gte=start, starttime__lt=end)
+            raw_ranges.append(q & Q(channel__in=missing) if missing else q)
+
+        aggregates = cls.aggregates()
+        raw = Measurement.objects.filter(
+            reduce(operator.or_, raw_ranges), metric_id=metric_id,
+            channel__in=channel_ids).values('channel').annotate(
+            first_starttime=Min('starttime'),
+            **{stat: aggregates[stat] for stat in cls.ARCHIVE_STATS})
+
+        values = {}
+        empty = dict.fromkeys(aggregates, None)
+        for row in list(raw) + rows:
+            value = values.setdefault(row['channel'], dict(
+                empty, channel=row['channel'], count=0, sum=0.0))
+            value['count'] += row['count']
+            value['sum'] += row['sum'] or 0.0
+            for key, pick in (('min', min), ('max', max), ('maxabs', max),
+                              ('first_starttime', min)):
+                if row[key] is not None:
+                    value[key] = row[key] if value.get(key) is None else \
+                        pick(value[key], row[key])
+        for value in values.values():
+            value['avg'] = value['sum'] / value['count'] \
+                if value['count'] else None
+        return values
+
+    @classmethod
+    def fill_channel_values(cls, channel_ids, values):
+        '''
+        Return the channel values (as from agg_measurements) for channel_ids
+        from values calculated by aggregate_channels, with empty values for
+        channels that had no measurements
+        '''
+        empty = dict.fromkeys(cls.aggregates(), None)
+        empty['count'] = 0
+        return [values.get(channel_id, dict(empty, channel=channel_id))
+                for channel_id in channel_ids]
 
-        return q_list
+    def stat_values(self, channel_values):
+        '''
+        Return the stat of each channel value as an array, NaN where there
+        were no measurements
+        '''
+        return np.array([channel_value[self.stat]
+                         for channel_value in channel_values], dtype=float)
 
     def evaluate_alarm(self,
-                       endtime=None):
+                       endtime=None,
+                       channel_values=None,
+                       nslcs=None,
+                       total_channels=None,
+                       digest=True,
+                       breaches=None,
+                       outbox=None):
         '''
         Higher-level function that determines alarm state and calls other
         functions to create alerts if necessary. Default is to start on the
         hour regardless of when it is called (truncate down).
+
+        channel_values, a {channel id: str(channel)} cache and the number of
+        channels in the group can be passed in when they were already
+        calculated for several monitors at once (see measurement.evaluation).
+        Or breaches, the breaching channels of each trigger as from
+        aggregate_breaching. Without digest, the daily digest is left to the
+        caller. outbox is passed on to queue_mail for alert emails
         '''
         if not endtime:
             endtime = datetime.now(tz=pytz.UTC) - relativedelta(
                 minute=0, second=0, microsecond=0)
 
         # Get aggregate values for each channel. Returns a list(QuerySet)
-        channel_values = self.agg_measurements(endtime)
+        if channel_values is None and breaches is None:
+            channel_values = self.agg_measurements(endtime)
 
         # Get Triggers for this alarm. Returns a QuerySet
         triggers = self.triggers.all()
 
+        # Shared by the triggers so each channel is only looked up once
+        if nslcs is None:
+            nslcs = {}
+        ALL = Trigger.NumChannelsOperator.ALL
+        if total_channels is None and any(
+                trigger.num_channels_operator == ALL for trigger in triggers):
+            total_channels = self.channel_group.channels.count()
+
+        # Triggers work on the same array of values, as boolean masks
+        if breaches is None:
+            values = self.stat_values(channel_values)
+        any_in_alarm = False
         for trigger in triggers:
-            breaching_channels = trigger.get_breaching_channels(channel_values)
-            in_alarm = trigger.in_alarm_state(breaching_channels)
-            trigger.evaluate_alert(in_alarm, breaching_channels, endtime)
+            if breaches is None:
+                breaching_channels = trigger.get_breaching_channels(
+                    channel_values, nslcs, values)
+            else:
+                breaching_channels = breaches[trigger.id]
+            in_alarm = trigger.in_alarm_state(breaching_channels,
+                                              total_channels)
+            trigger.evaluate_alert(in_alarm, breaching_channels, endtime,
+                                   outbox=outbox)
+            any_in_alarm = any_in_alarm or in_alarm
 
         # Set the digest to be evaluated at this time. Should it be a field?
         digesttime = datetime.now(tz=pytz.UTC) - relativedelta(
             hour=0, minute=0, second=0, microsecond=0)
         endtimecheck = endtime - relativedelta(
             minute=0, second=0, microsecond=0)
-        if self.do_daily_digest and endtimecheck == digesttime:
+        if digest and self.do_daily_digest and endtimecheck == digesttime:
             self.check_daily_digest(digesttime)
+        return any_in_alarm
+
+    def digest_due(self, endtime):
+        '''Whether evaluating at endtime sends the daily digest'''
+        digesttime = datetime.now(tz=pytz.UTC) - relativedelta(
+            hour=0, minute=0, second=0, microsecond=0)
+        return self.do_daily_digest and endtime - relativedelta(
+            minute=0, second=0, microsecond=0) == digesttime
 
     def check_daily_digest(self,
                            digesttime=None):
+        Monitor.send_daily_digests([self], digesttime)
+
+    @classmethod
+    def send_daily_digests(cls, monitors, digesttime=None):
+        '''
+        Send the daily digests of monitors for the day before digesttime.
+        The trigger contexts of every monitor come from one query, and
+        monitors whose digests go to the same recipients share one email
+        '''
         if not digesttime:
             digesttime = datetime.now(tz=pytz.UTC)
-
-        # Get the date string for yesterday
-        yesterday_str = (
-            digesttime - relativedelta(days=1)).strftime("%Y-%m-%d")
-
-        triggers = self.triggers.all()
-        # Get trigger contexts - information about the previous day
-        trigger_contexts = []
-        for trigger in triggers:
-            trigger_contexts.append(
-                trigger.get_daily_trigger_digest(digesttime))
-
-        n_in_alert = sum([1 for res in trigger_contexts if res['in_alarm']])
-        if n_in_alert == 0:
-            # No alerts, no need to send digest
-            return
-
-        # Get emails for triggers that were in alarm
-        emails = []
-        for i, trigger in enumerate(triggers):
-            if trigger_contexts[i]['in_alarm']:
-                emails += [email for email in trigger.emails]
-
-        if not emails:
-            # There is noone specified to send to
-            return
-
-        context = get_monitor_context(self)
-        context['yesterday'] = digesttime - relativedelta(days=1)
-        context['n_in_alert'] = n_in_alert
-        context['trigger_contexts'] = trigger_contexts
-
-        # render email text
-        email_html_message = render_to_string(
-            'email/monitor_daily_digest.html', context)
-        email_plaintext_message = render_to_string(
-            'email/monitor_daily_digest.txt', context)
-
-        subject = f"SQUAC daily digest for '{str(self)}'"
-        subject += f", {yesterday_str}"
-        send_mail(subject,
-                  email_plaintext_message,
-                  settings.EMAIL_NO_REPLY,
-                  [email for email in emails],
-                  fail_silently=False,
-                  html_message=email_html_message
-                  )
+        yesterday = digesttime - relativedelta(days=1)
+
+        triggers = {monitor.id: list(monitor.triggers.all())
+                    for monitor in monitors}
+        trigger_contexts = Trigger.get_daily_trigger_digests(
+            [trigger for group in triggers.values() for trigger in group],
+            digesttime)
+
+        # {recipients: monitor contexts}
+        digests = defaultdict(list)
+        for monitor in monitors:
+            contexts = [trigger_contexts[trigger.id]
+                        for trigger in triggers[monitor.id]]
+            # Get emails for triggers that were in alarm
+            emails = {
+                email for trigger, context in zip(triggers[monitor.id],
+                                                  contexts)
+                if context['in_alarm'] for email in trigger.emails or []
+            }
+            n_in_alert = sum(1 for context in contexts if context['in_alarm'])
+            if n_in_alert == 0 or not emails:
+                # No alerts or noone specified to send to
+                continue
+            context = get_monitor_context(monitor)
+            context['monitor'] = str(monitor)
+            context['n_in_alert'] = n_in_alert
+            context['trigger_contexts'] = contexts
+            digests[tuple(sorted(emails))].append(context)
+
+        for recipients, monitor_contexts in digests.items():
+            context = {
+                'now': datetime.now(tz=pytz.UTC),
+                'remote_host': remote_host(),
+                'yesterday': yesterday,
+                'monitors': monitor_contexts,
+            }
+
+            # render email text
+            email_html_message = render_to_string(
+                'email/monitor_daily_digest.html', context)
+            email_plaintext_message = render_to_string(
+                'email/monitor_daily_digest.txt', context)
+
+            if len(monitor_contexts) == 1:
+                subject = ("SQUAC daily digest for "
+                           f"'{monitor_contexts[0]['monitor']}'")
+            else:
+                subject = ("SQUAC daily digest for "
+                           f"{len(monitor_contexts)} monitors")
+            subject += f", {yesterday.strftime('%Y-%m-%d')}"
+            queue_mail(subject,
+                       email_plaintext_message,
+                       settings.EMAIL_NO_REPLY,
+                       list(recipients),
+                       html_message=email_html_message
+                       )
 
     def __str__(self):
         if not self.name:
@@ -408,6 +694,16 @@ class Trigger(MeasurementBase):
         default=NumChannelsOperator.GREATER_THAN
     )
     alert_on_out_of_alarm = models.BooleanField(default=False)
+    # most recent alert, kept up to date by Alert.save so it can be read
+    # without querying alerts. No db constraint, alerts can be partitioned
+    latest_alert = models.ForeignKey(
+        'Alert',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        db_constraint=False
+    )
 
     emails = EmailListArrayField(models.EmailField(
         null=True, blank=True), null=True, blank=True)
@@ -431,24 +727,79 @@ class Trigger(MeasurementBase):
         else:
             return self.OPERATOR[self.value_operator](val, self.val1)
 
+    # lookups of the ValueOperators comparing to val1
+    LOOKUPS = {
+        '==': 'exact',
+        '<': 'lt',
+        '<=': 'lte',
+        '>': 'gt',
+        '>=': 'gte'
+    }
+
+    def breach_q(self, field):
+        '''
+        is_breaching as a condition on field, e.g. an aggregate annotation.
+        NULL never breaches
+        '''
+        if self.value_operator == self.ValueOperator.OUTSIDE_OF:
+            return Q(**{f'{field}__lt': self.val1}) | \
+                Q(**{f'{field}__gt': self.val2})
+        elif self.value_operator == self.ValueOperator.WITHIN:
+            return Q(**{f'{field}__gt': self.val1,
+                        f'{field}__lt': self.val2})
+        lookup = self.LOOKUPS[self.value_operator]
+        return Q(**{f'{field}__{lookup}': self.val1})
+
+    def breaching_mask(self, values):
+        '''
+        Vectorized is_breaching. values is an array of the monitor's stat
+        for each channel, NaN where there were no measurements (which never
+        breach). Returns a boolean array
+        '''
+        # comparisons with NaN are False, which is what we want
+        if self.value_operator == self.ValueOperator.OUTSIDE_OF:
+            return (values < self.val1) | (values > self.val2)
+        elif self.value_operator == self.ValueOperator.WITHIN:
+            return (values > self.val1) & (values < self.val2)
+        else:
+            return self.OPERATOR[self.value_operator](values, self.val1)
+
     # channel_values is a list of dicts
-    def get_breaching_channels(self, channel_values):
-        '''Return all channels that are breaching this Trigger'''
+    def get_breaching_channels(self, channel_values, nslcs=None,
+                               values=None):
+        '''
+        Return all channels that are breaching this Trigger.
+
+        nslcs is a {channel id: str(channel)} cache. Ids missing from it are
+        looked up in one query and added, so a cache shared between triggers
+        (or preloaded) saves queries. values is the array of the stat for
+        channel_values (see Monitor.stat_values), computed if not given
+        '''
+        if nslcs is None:
+            nslcs = {}
+        if values is None:
+            values = self.monitor.stat_values(channel_values)
+        breaching = [channel_values[i]
+                     for i in np.flatnonzero(self.breaching_mask(values))]
+        missing = {channel_value['channel'] for channel_value in breaching
+                   if channel_value['channel'] not in nslcs}
+        if missing:
+            nslcs.update(Channel.nslc_map(missing))
+
+        stat = self.monitor.stat
         breaching_channels = []
-        for channel_value in channel_values:
-            if self.is_breaching(channel_value):
-                channel = Channel.objects.filter(id=channel_value['channel'])
-                # Should just be one channel in the filter queryset
-                if len(channel) != 1:
-                    continue
-
-                value = channel_value[self.monitor.stat]
-                breaching_channels.append({
-                    'channel': str(channel[0]),
-                    'channel_id': channel_value['channel'],
-                    self.monitor.stat: value,
-                    "value": value
-                })
+        for channel_value in breaching:
+            # Skip channels that don't exist (anymore)
+            if channel_value['channel'] not in nslcs:
+                continue
+
+            value = channel_value[stat]
+            breaching_channels.append({
+                'channel': nslcs[channel_value['channel']],
+                'channel_id': channel_value['channel'],
+                stat: value,
+                "value": value
+            })
 
         # Sort the channels for simplicity later
         breaching_channels = sorted(
@@ -469,12 +820,14 @@ class Trigger(MeasurementBase):
         removed = []
         alert = self.get_latest_alert(reftime)
         if alert:
-            previous_ids = {x['channel_id'] for x in alert.breaching_channels}
+            Alert.fill_breaching_channels([alert])
+            previous = alert.breaching_channels or []
+            previous_ids = {x['channel_id'] for x in previous}
             current_ids = {x['channel_id'] for x in breaching_channels}
             for chan in breaching_channels:
                 if chan['channel_id'] not in previous_ids:
                     added.append(chan)
-            for chan in alert.breaching_channels:
+            for chan in previous:
                 if chan['channel_id'] not in current_ids:
                     removed.append(chan)
         else:
@@ -486,27 +839,41 @@ class Trigger(MeasurementBase):
     # breaching_channels is a list of dicts from
     # trigger.get_breaching_channels()
     def in_alarm_state(self,
-                       breaching_channels):
+                       breaching_channels,
+                       total_channels=None):
         '''
         Determine if Trigger is in or out of alarm based on breaching_channels
-        and num_channels_operator.
+        and num_channels_operator. total_channels is the number of channels
+        in the monitor's channel group, counted if not given.
+        '''
+        return self.in_alarm_count(len(breaching_channels), total_channels)
+
+    def in_alarm_count(self, n_breaching, total_channels=None):
+        '''
+        in_alarm_state from the number of breaching channels, which can be
+        an array of counts (see measurement.replay)
         '''
         if self.num_channels_operator == self.NumChannelsOperator.ANY:
             # This is a special case. evaluate_alert() will perform further
             # logic checks. Will always be "in_alarm" if there are more than
             # zero breaching channels
-            return len(breaching_channels) > 0
+            return n_breaching > 0
         elif self.num_channels_operator == self.NumChannelsOperator.ALL:
-            total_channels = self.monitor.channel_group.channels.count()
-            return len(breaching_channels) == total_channels
+            if total_channels is None:
+                total_channels = self.monitor.channel_group.channels.count()
+            return n_breaching == total_channels
         else:
             # Otherwise just compare the breaching_channels to the
             # num_channels_operator (>, ==, <)
             op = self.OPERATOR[self.num_channels_operator]
-            return op(len(breaching_channels), self.num_channels)
+            return op(n_breaching, self.num_channels)
 
     def get_latest_alert(self, reftime=None):
         '''Return the most recent alert for this Trigger'''
+        latest = self.latest_alert
+        if latest and (not reftime or latest.timestamp <= reftime):
+            return latest
+
         if not reftime:
             reftime = datetime.now(tz=pytz.UTC)
 
@@ -517,6 +884,13 @@ class Trigger(MeasurementBase):
                      in_alarm,
                      breaching_channels=[],
                      timestamp=None):
+        '''
+        Create an alert. It is stored as the channels added and removed
+        since the trigger's latest alert, in that alert's chain, unless it
+        isn't the latest, is in another month or the chain already has
+        ALERT_SNAPSHOT_EVERY alerts, then it starts a new chain as a snapshot.
+        Returns None if the trigger already has an alert at timestamp
+        '''
         if not timestamp:
             timestamp = datetime.now(tz=pytz.UTC)
 
@@ -525,31 +899,54 @@ class Trigger(MeasurementBase):
                           in_alarm=in_alarm,
                           user=self.user,
                           breaching_channels=breaching_channels)
-        new_alert.save()
+        previous = self.get_latest_alert()
+        month = alert_month(timestamp)
+        if previous and previous.timestamp < timestamp \
+                and alert_month(previous.timestamp) == month:
+            snapshot_id = previous.snapshot_id or previous.id
+            chain = Alert.objects.filter(
+                snapshot_id=snapshot_id, timestamp__gte=month).count()
+            if chain < settings.ALERT_SNAPSHOT_EVERY:
+                added, removed = self.get_breaching_change(
+                    breaching_channels, timestamp)
+                new_alert.snapshot_id = snapshot_id
+                new_alert.added_channels = added
+                new_alert.removed_channels = removed
+        if not new_alert.insert():
+            # another evaluation already created it
+            return None
+
+        if new_alert.snapshot_id and previous.snapshot_id:
+            # only the last alert of a chain keeps its full channels
+            Alert.objects.filter(pk=previous.pk).update(
+                breaching_channels=None)
         return new_alert
 
     def evaluate_alert(self,
                        in_alarm,
                        breaching_channels=[],
-                       reftime=None):
+                       reftime=None,
+                       outbox=None):
         '''
         Determine what to do with alerts given that this Trigger is in
-        or out of spec
+        or out of spec. Alerts are only created when the trigger goes in or
+        out of alarm, or its breaching channels change while in alarm.
+        outbox is passed on to queue_mail
         '''
         if not reftime:
             reftime = datetime.now(tz=pytz.UTC)
         alert = self.get_latest_alert(reftime=reftime)
+        added, removed = self.get_breaching_change(
+            breaching_channels, reftime)
         create_new = False
         send_new = False
 
-        # Create alert whenever in alarm or when exiting alarm state
         if in_alarm:
-            # always create an alert when in alarm
-            create_new = True
-
             # if last alert does not exist or was not in alarm, send new one
             if not alert or not alert.in_alarm:
-                send_new = True
+                create_new, send_new = True, True
+            elif added or removed:
+                create_new = True
         else:
             # Not in alarm state, is there an alert to cancel?
             # If so, create new one saying in_alarm = False
@@ -558,8 +955,6 @@ class Trigger(MeasurementBase):
 
         if self.num_channels_operator == self.NumChannelsOperator.ANY:
             # Special treatment for num_channels_operator == ANY
-            added, removed = self.get_breaching_change(
-                breaching_channels, reftime)
             if added:
                 # Always send new alert if new channels are added
                 send_new = True
@@ -572,11 +967,15 @@ class Trigger(MeasurementBase):
             send_new = False
 
         if create_new:
-            alert = self.create_alert(in_alarm,
-                                      breaching_channels=breaching_channels,
-                                      timestamp=reftime)
+            created = self.create_alert(
+                in_alarm, breaching_channels=breaching_channels,
+                timestamp=reftime)
+            # an alert replayed at the same time isn't sent again
+            if not created:
+                return self.alerts.get(timestamp=reftime)
             if send_new:
-                alert.send_alert()
+                created.send_alert(outbox=outbox)
+            alert = created
 
         return alert
 
@@ -643,57 +1042,118 @@ class Trigger(MeasurementBase):
         - Then summary of alerts for the day
         - Then breaching channels, including breaching since times
         """
-        # trigger_context will be returned and ultimately used in crafting the
-        # digest email
-        trigger_context = {
-            'in_alarm': False,
-            'trigger_description': self.get_text_description(verbose=False),
-            'unsubscribe_url': self.create_unsubscribe_url()
-        }
+        return Trigger.get_daily_trigger_digests([self], digesttime)[self.id]
 
-        # Use check time to ensure digesttime is 00:00, and the trigger will be
-        # evaluated for the day before
+    @classmethod
+    def get_daily_trigger_digests(cls, triggers, digesttime):
+        """
+        get_daily_trigger_digest of each of triggers, as {trigger id:
+        context}. The alerts of the day are summarized by one query: the
+        times of alerts in and out of alarm, and the last breaching time of
+        each channel, from the alerts' breaching_channels, sorted by NSLC.
+        Alerts are only created on changes, so triggers whose latest alert
+        before the day was in alarm were in alarm at its start, with that
+        alert's channels
+        """
+        # Use check time to ensure digesttime is 00:00, and the triggers
+        # will be evaluated for the day before
         checktime = digesttime - relativedelta(
             hour=0, minute=0, second=0, microsecond=0)
-        alerts = self.alerts.filter(
-            timestamp__gte=checktime - relativedelta(days=1),
-            timestamp__lte=checktime).order_by('timestamp')
-
-        # If there were no alerts today, return now.
-        if len(alerts) == 0:
-            return trigger_context
-
-        # There were alerts, so categorize them and generate a summary
-        in_alarm_times = [
-            alert.timestamp.strftime('%H:%M') for alert in alerts
-            if alert.in_alarm
-        ]
-        out_of_alarm_times = [
-            alert.timestamp.strftime('%H:%M') for alert in alerts
-            if not alert.in_alarm
-        ]
-
-        # Now add the list of breaching channels (first generate it)
-        channels_dict = {}
-        for alert in alerts:
-            for channel in alert.breaching_channels:
-                # Keep track of the most recent breaching time per channel
-                channels_dict[channel['channel']] = alert.timestamp
-
-        # Sort the channels by NSLC
-        channels_list = []
-        for channel_name in sorted(channels_dict.keys()):
-            channels_list.append({
-                'channel': channel_name,
-                'timestamp': channels_dict[channel_name]
-            })
-
-        trigger_context['in_alarm'] = True
-        trigger_context['in_alarm_times'] = in_alarm_times
-        trigger_context['out_of_alarm_times'] = out_of_alarm_times
-        trigger_context['breaching_channels'] = channels_list
-
-        return trigger_context
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''WITH day_alerts AS (
+                       SELECT trigger_id, timestamp, in_alarm,
+                              CASE WHEN snapshot_id IS NULL
+                              THEN breaching_channels
+                              ELSE added_channels END AS breaching_channels
+                       FROM measurement_alert
+                       WHERE trigger_id = ANY(%s)
+                         AND timestamp BETWEEN %s AND %s
+                   ), breaching AS (
+                       SELECT trigger_id, element ->> 'channel' AS channel,
+                              max(timestamp) AS timestamp
+                       FROM day_alerts, jsonb_array_elements(
+                           CASE jsonb_typeof(breaching_channels)
+                           WHEN 'array' THEN breaching_channels
+                           ELSE '[]' END) AS element
+                       WHERE element ? 'channel'
+                       GROUP BY trigger_id, element ->> 'channel'
+                   ), channels AS (
+                       SELECT trigger_id,
+                              array_agg(channel ORDER BY channel COLLATE "C")
+                                  AS channels,
+                              array_agg(timestamp ORDER BY channel COLLATE "C")
+                                  AS timestamps
+                       FROM breaching
+                       GROUP BY trigger_id
+                   ), times AS (
+                       SELECT trigger_id,
+                              array_agg(to_char(timestamp AT TIME ZONE 'UTC',
+                                                'HH24:MI') ORDER BY timestamp)
+                                  FILTER (WHERE in_alarm) AS in_alarm_times,
+                              array_agg(to_char(timestamp AT TIME ZONE 'UTC',
+                                                'HH24:MI') ORDER BY timestamp)
+                                  FILTER (WHERE NOT in_alarm)
+                                  AS out_of_alarm_times
+                       FROM day_alerts
+                       GROUP BY trigger_id
+                   )
+                   SELECT trigger_id, in_alarm_times, out_of_alarm_times,
+                          channels, timestamps
+                   FROM times LEFT JOIN channels USING (trigger_id);''',
+                [[trigger.id for trigger in triggers],
+                 checktime - relativedelta(days=1), checktime])
+            rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        starts = {alert.trigger_id: alert for alert in cls.start_alerts(
+            triggers, checktime - relativedelta(days=1)) if alert.in_alarm}
+
+        # trigger contexts are ultimately used in crafting the digest email
+        digests = {}
+        for trigger in triggers:
+            trigger_context = {
+                'in_alarm': False,
+                'trigger_description': trigger.get_text_description(
+                    verbose=False),
+                'unsubscribe_url': trigger.create_unsubscribe_url()
+            }
+            if trigger.id in rows or trigger.id in starts:
+                in_alarm_times, out_of_alarm_times, channels, timestamps = \
+                    rows.get(trigger.id, (None, None, None, None))
+                breaching = dict(zip(channels or [], timestamps or []))
+                start = starts.get(trigger.id)
+                if start:
+                    # still breaching since before the day
+                    for channel in start.breaching_channels or []:
+                        breaching.setdefault(channel['channel'],
+                                             start.timestamp)
+                trigger_context['in_alarm'] = True
+                trigger_context['in_alarm_times'] = in_alarm_times or []
+                trigger_context['out_of_alarm_times'] = \
+                    out_of_alarm_times or []
+                trigger_context['breaching_channels'] = [
+                    {'channel': channel, 'timestamp': breaching[channel]}
+                    for channel in sorted(breaching)
+                ]
+            digests[trigger.id] = trigger_context
+        return digests
+
+    @classmethod
+    def start_alerts(cls, triggers, starttime):
+        '''
+        The latest alert of each of triggers before starttime, with all of
+        its breaching_channels
+        '''
+        # one index lookup per trigger, rather than every older alert
+        alerts = list(Alert.objects.raw(
+            '''SELECT alert.* FROM unnest(%s) AS trigger(id)
+               CROSS JOIN LATERAL (
+                   SELECT * FROM measurement_alert
+                   WHERE trigger_id = trigger.id AND timestamp < %s
+                   ORDER BY timestamp DESC, id DESC
+                   LIMIT 1
+               ) AS alert;''',
+            [[trigger.id for trigger in triggers], starttime]))
+        return Alert.fill_breaching_channels(alerts)
 
     def create_unsubscribe_url(self):
         ''' creates a link to the unsubscribe url for given trigger'''
@@ -750,6 +1210,24 @@ class Trigger(MeasurementBase):
                 _('num_channels must be defined when using'
                   f' {self.num_channels_operator}'))
 
+    @classmethod
+    def reset_alerts(cls, triggers, timestamp=None):
+        '''
+        create_alert(False) for many triggers at once: one insert of reset
+        alerts, each starting a new chain, and one update of the triggers'
+        latest_alert
+        '''
+        if not timestamp:
+            timestamp = datetime.now(tz=pytz.UTC)
+        alerts = Alert.objects.bulk_create([
+            Alert(trigger=trigger, timestamp=timestamp, in_alarm=False,
+                  user=trigger.user, breaching_channels=[])
+            for trigger in triggers])
+        for trigger, alert in zip(triggers, alerts):
+            trigger.latest_alert = alert
+        cls.objects.bulk_update(triggers, ['latest_alert'])
+        return alerts
+
     def save(self, *args, **kwargs):
         """
         Do regular save except also validate fields. This doesn't happen
@@ -777,8 +1255,24 @@ class Alert(MeasurementBase):
     timestamp = models.DateTimeField()
     in_alarm = models.BooleanField(default=True)
     breaching_channels = models.JSONField(null=True)
+    # Alerts of a trigger are stored as chains (see Trigger.create_alert):
+    # a snapshot alert with all of its breaching_channels, then alerts with
+    # only the channels added and removed since the previous one. The last
+    # alert of a chain also keeps all of its breaching_channels. Chains stay
+    # within a month, so monthly alert partitions can be dropped whole
+    snapshot = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+',
+        db_constraint=False
+    )
+    added_channels = models.JSONField(null=True, blank=True)
+    removed_channels = models.JSONField(null=True, blank=True)
 
-    def send_alert(self):
+    def send_alert(self, outbox=None):
+        ''' email the alert, queued in the outbox if outbox (queue_mail) '''
         if not self.trigger.emails:
             # There is noone specified to send to
             return False
@@ -787,11 +1281,15 @@ class Alert(MeasurementBase):
         added, removed = None, None
         if operator.eq(self.trigger.num_channels_operator,
                        Trigger.NumChannelsOperator.ANY):
-            # Use one second before as reftime just to make sure this alert
-            # itself isn't used as the latest alert
-            added, removed = self.trigger.get_breaching_change(
-                self.breaching_channels,
-                self.timestamp - timedelta(seconds=1))
+            if self.snapshot_id:
+                # stored as the change from the previous alert
+                added, removed = self.added_channels, self.removed_channels
+            else:
+                # Use one second before as reftime just to make sure this
+                # alert itself isn't used as the latest alert
+                added, removed = self.trigger.get_breaching_change(
+                    self.breaching_channels,
+                    self.timestamp - timedelta(seconds=1))
 
         # could send just trigger to simplify this, but then the
         # HTML is more complex
@@ -814,20 +1312,119 @@ class Alert(MeasurementBase):
         email_plaintext_message = render_to_string(
             'email/alert_email.txt', context)
 
-        send_mail(subject,
-                  email_plaintext_message,
-                  settings.EMAIL_NO_REPLY,
-                  [email for email in self.trigger.emails],
-                  fail_silently=False,
-                  html_message=email_html_message
-                  )
+        queue_mail(subject,
+                   email_plaintext_message,
+                   settings.EMAIL_NO_REPLY,
+                   [email for email in self.trigger.emails],
+                   html_message=email_html_message,
+                   outbox=outbox
+                   )
+
+        return True
+
+    @classmethod
+    def fill_breaching_channels(cls, alerts):
+        '''
+        Set the breaching_channels of alerts stored as changes from their
+        chains, with one query. Returns alerts
+        '''
+        missing = {alert.id: alert for alert in alerts
+                   if alert.breaching_channels is None and alert.snapshot_id}
+        if not missing:
+            return alerts
+        snapshot_ids = {alert.snapshot_id for alert in missing.values()}
+        timestamps = [alert.timestamp for alert in missing.values()]
+        chains = cls.objects.filter(
+            Q(pk__in=snapshot_ids) | Q(snapshot_id__in=snapshot_ids),
+            timestamp__gte=alert_month(min(timestamps)),
+            timestamp__lte=max(timestamps)
+        ).order_by(F('snapshot').asc(nulls_first=True), 'timestamp',
+                   'id').values_list('id', 'snapshot_id',
+                                     'breaching_channels', 'added_channels',
+                                     'removed_channels')
+
+        # {snapshot id: {channel id: channel}} as the chains are replayed
+        channels = {}
+        for alert_id, snapshot_id, breaching, added, removed in chains:
+            if snapshot_id is None:
+                channels[alert_id] = {channel['channel_id']: channel
+                                      for channel in breaching or []}
+                continue
+            current = channels.setdefault(snapshot_id, {})
+            for channel in removed or []:
+                current.pop(channel['channel_id'], None)
+            for channel in added or []:
+                current[channel['channel_id']] = channel
+            if alert_id in missing:
+                missing[alert_id].breaching_channels = sorted(
+                    current.values(), key=lambda channel: channel['channel'])
+        return alerts
 
+    def save(self, *args, **kwargs):
+        '''Save, then keep the trigger's latest_alert up to date'''
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        self.update_latest(adding)
+
+    def insert(self):
+        '''
+        Insert the alert unless its trigger already has one at its timestamp
+        (ON CONFLICT DO NOTHING), e.g. from a concurrent evaluation, then
+        keep the trigger's latest_alert up to date. Returns whether the alert
+        was inserted
+        '''
+        fields = [field for field in self._meta.concrete_fields
+                  if not field.primary_key]
+        values = [field.get_db_prep_save(field.pre_save(self, True),
+                                         connection)
+                  for field in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''INSERT INTO {self._meta.db_table}
+                        ({', '.join(field.column for field in fields)})
+                    VALUES ({', '.join(['%s'] * len(fields))})
+                    ON CONFLICT (trigger_id, timestamp) DO NOTHING
+                    RETURNING id;''', values)
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        self.pk = row[0]
+        self._state.adding = False
+        self._state.db = connection.alias
+        self.update_latest(True)
         return True
 
+    def update_latest(self, adding):
+        '''Point the trigger's latest_alert at the latest of its alerts'''
+        triggers = Trigger.objects.filter(pk=self.trigger_id)
+        if adding:
+            # unless a later alert exists
+            not_later = Q(latest_alert__timestamp__lte=self.timestamp)
+            updated = triggers.filter(
+                not_later | Q(latest_alert__isnull=True)).update(
+                latest_alert=self)
+            if updated and Alert.trigger.is_cached(self):
+                self.trigger.latest_alert = self
+        else:
+            triggers.update(latest_alert=Subquery(
+                Alert.objects.filter(trigger=OuterRef('pk')).order_by(
+                    '-timestamp', '-id').values('id')[:1]))
+            if Alert.trigger.is_cached(self):
+                self.trigger.refresh_from_db(fields=['latest_alert'])
+
     class Meta:
         indexes = [
             # index in desc order (newest first)
             models.Index(fields=['-timestamp']),
+            models.Index(fields=['trigger', '-timestamp']),
+            models.Index(fields=['user', '-timestamp'],
+                         condition=Q(in_alarm=True),
+                         name='alert_user_in_alarm_idx'),
+        ]
+        constraints = [
+            # evaluations of a trigger at the same time make a single alert
+            models.UniqueConstraint(fields=['trigger', 'timestamp'],
+                                    name='alert_trigger_timestamp_uniq'),
         ]
 
     def __str__(self):
@@ -837,6 +1434,216 @@ class Alert(MeasurementBase):
                 )
 
 
+class MonitorEvaluation(models.Model):
+    '''Timing and outcome of one evaluation of a monitor'''
+
+    class Status(models.TextChoices):
+        OK = 'ok', _('Ok')
+        ERROR = 'error', _('Error')
+        # not evaluated because the run's deadline passed
+        SKIPPED = 'skipped', _('Skipped')
+        # not evaluated, inputs and outcome same as the last evaluation
+        UNCHANGED = 'unchanged', _('Unchanged')
+        # evaluated with the aggregates of the last evaluation
+        CACHED = 'cached', _('Cached')
+        # not evaluated, another process was evaluating the monitor
+        LOCKED = 'locked', _('Locked')
+
+    monitor = models.ForeignKey(
+        Monitor,
+        on_delete=models.CASCADE,
+        related_name='evaluations'
+    )
+    # endtime of the evaluated window
+    endtime = models.DateTimeField()
+    started_at = models.DateTimeField()
+    # seconds spent evaluating this monitor's triggers
+    duration = models.FloatField(default=0)
+    # seconds spent on the aggregate query, shared with the monitors that
+    # have the same metric and window
+    aggregate_duration = models.FloatField(default=0)
+    query_count = models.IntegerField(default=0)
+    status = models.CharField(
+        max_length=16,
+        choices=Status.choices,
+        default=Status.OK
+    )
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['monitor', '-started_at']),
+            models.Index(fields=['-started_at']),
+        ]
+
+    def __str__(self):
+        return (f"{str(self.monitor)} at {self.endtime}: {self.status} "
+                f"in {self.duration:.3f}s, {self.query_count} queries")
+
+
+class MonitorState(models.Model):
+    '''
+    What a monitor was last evaluated against, so that evaluations whose
+    inputs haven't changed can be skipped or reuse the aggregates
+    '''
+    monitor = models.OneToOneField(
+        Monitor,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='state'
+    )
+    evaluated_at = models.DateTimeField()
+    starttime = models.DateTimeField()
+    endtime = models.DateTimeField()
+    # the metric's last_ingested_at when the aggregates were calculated
+    watermark = models.DateTimeField(null=True)
+    # earliest measurement aggregated, null if there were none
+    first_starttime = models.DateTimeField(null=True)
+    # aggregate values of each channel of the group, as from
+    # Monitor.agg_measurements
+    channel_values = models.JSONField(default=list)
+    # whether any trigger was in alarm
+    in_alarm = models.BooleanField(default=False)
+    # {trigger id: ids of the channels breaching it}
+    breaching = models.JSONField(default=dict)
+    # seconds the evaluation took
+    duration = models.FloatField(default=0)
+
+    def __str__(self):
+        return f"{str(self.monitor)} at {self.endtime}"
+
+    @staticmethod
+    def breaching_channels(monitor, channel_values):
+        '''
+        The breaching field for channel_values: each trigger's mask over the
+        monitor's stat, as channel ids
+        '''
+        values = monitor.stat_values(channel_values)
+        return {
+            str(trigger.id): [channel_values[i]['channel'] for i in
+                              np.flatnonzero(trigger.breaching_mask(values))]
+            for trigger in monitor.triggers.all()
+        }
+
+    def status(self):
+        '''
+        The monitor's stat and breached triggers for each channel as of
+        this evaluation, with the triggers' current alarm state. stale when
+        the monitor changed since, values of a stat it didn't have are None
+        '''
+        stat = self.monitor.stat
+        channel_ids = [value['channel'] for value in self.channel_values]
+        nslcs = Channel.nslc_map(channel_ids)
+        breached = defaultdict(list)
+        for trigger_id, breaching in self.breaching.items():
+            for channel_id in breaching:
+                breached[channel_id].append(int(trigger_id))
+        triggers = []
+        for trigger in self.monitor.triggers.all():
+            alert = trigger.latest_alert
+            triggers.append({
+                'id': trigger.id,
+                'in_alarm': bool(alert and alert.in_alarm),
+                'breaching_channels': len(
+                    self.breaching.get(str(trigger.id), [])),
+            })
+        return {
+            'monitor': self.monitor_id,
+            'stat': stat,
+            'evaluated_at': self.evaluated_at,
+            'starttime': self.starttime,
+            'endtime': self.endtime,
+            'duration': self.duration,
+            'in_alarm': self.in_alarm,
+            'stale': self.monitor.updated_at > self.evaluated_at,
+            'triggers': triggers,
+            'channels': [
+                {'channel': value['channel'],
+                 'nslc': nslcs.get(value['channel']),
+                 'value': value.get(stat),
+                 'breaching_triggers': sorted(breached[value['channel']])}
+                for value in self.channel_values
+            ],
+        }
+
+    def unchanged(self, monitor, starttime, endtime, channel_ids):
+        '''
+        Whether monitor would aggregate the same measurements over
+        starttime-endtime as it did for this state: nothing was ingested for
+        the metric since (the watermark hadn't just moved when it was
+        evaluated, see ingest.touch_metrics), nothing ingested before was
+        past the previous
+        endtime (measurements aren't from the future), no measurement left
+        the window and the group has the same channels
+        '''
+        watermark = monitor.metric.last_ingested_at
+        if watermark is None or watermark != self.watermark:
+            return False
+        # ingests soon after the watermark moved don't move it again
+        resolution = timedelta(seconds=settings.MONITOR_WATERMARK_RESOLUTION)
+        if self.evaluated_at < watermark + resolution:
+            return False
+        if watermark > self.endtime or endtime < self.endtime:
+            return False
+        if starttime < self.starttime:
+            return False
+        if self.first_starttime and starttime > self.first_starttime:
+            return False
+        channels = [value['channel'] for value in self.channel_values]
+        return channels == list(channel_ids)
+
+
+class MonitorSchedule(models.Model):
+    '''
+    When a monitor is next due to be evaluated, see measurement.scheduler
+    '''
+    monitor = models.OneToOneField(
+        Monitor,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='schedule'
+    )
+    next_due = models.DateTimeField(db_index=True)
+    # endtime of the last scheduled evaluation
+    last_endtime = models.DateTimeField()
+    # when next_due was set, changes to the monitor or metric after it make
+    # the monitor due at once
+    scheduled_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{str(self.monitor)} due at {self.next_due}"
+
+
+class DirtySeries(models.Model):
+    '''
+    A metric and channel with measurements ingested since the monitors using
+    them were last evaluated, see measurement.ingest
+    '''
+    metric = models.ForeignKey(
+        Metric,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    channel = models.ForeignKey(
+        Channel,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    first_marked_at = models.DateTimeField()
+    last_marked_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["metric", "channel"],
+                name="unique dirty series"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Metric: {self.metric_id} Channel: {self.channel_id}"
+
+
 class ArchiveBase(models.Model):
     """An archive-summary of measurements"""
     class Meta:
@@ -916,6 +1723,12 @@ def remote_host():
     return remote_host
 
 
+def alert_month(timestamp):
+    '''start of the (UTC) month of timestamp, that of its alert partition'''
+    return timestamp.astimezone(pytz.UTC).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
 def get_monitor_context(monitor):
     """ Monitor context for emails that is shared """
     host = remote_host()
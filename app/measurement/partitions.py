@@ -0,0 +1,529 @@
+'''
+Lifecycle management for tables that are range partitioned on a timestamp
+column, i.e. measurement_measurement, which is partitioned by day (see
+sql/measurement.sql), and measurement_alert, partitioned by month (see
+sql/alert.sql).
+
+A PartitionManager can list the partitions of its table along with their
+size and row estimates, create partitions ahead of time (filling any gaps),
+verify that an old partition has been archived and exported, then detach and
+drop it. It can also ANALYZE partitions after bulk loads.
+
+Partitions can also carry their own indexes on top of what they inherit from
+the parent table: an index policy picks an index profile by partition age
+(e.g. btree while a partition is receiving data, BRIN once it is cold).
+'''
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.db.utils import DatabaseError
+from psycopg2.extensions import AsIs
+
+from measurement.export import read_manifest
+from measurement.models import Alert, ArchiveDay, Trigger
+from measurement.storage import StorageError, get_storage
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from dateutil import parser as dateparser
+from dateutil.relativedelta import relativedelta
+import boto3
+import botocore
+import pytz
+import re
+
+
+Partition = namedtuple(
+    'Partition', ['name', 'start', 'end', 'size', 'rows'])
+''' a single partition. start is inclusive and end exclusive '''
+
+
+class PartitionError(Exception):
+    ''' Raised when a partition operation can't be done on this table '''
+    pass
+
+
+MEASUREMENT_INDEX_PROFILES = {
+    # reads are almost always "metric IN, channel IN, starttime range",
+    # which the unique (metric, channel, starttime) INCLUDE (value)
+    # constraint inherited from the parent already covers. Every partition
+    # also inherits the channel_id index
+    'hot': {},
+    # once a partition stops changing, a tiny BRIN serves the starttime
+    # range scans done by exports and archiving. It doesn't save space: the
+    # covering unique btree is inherited by every partition, hot or cold,
+    # as it is the arbiter of ingest upserts
+    'cold': {
+        'starttime_brin': 'USING brin (starttime)',
+    },
+    # the btree indexes every partition used to inherit besides channel_id,
+    # to compare against
+    'legacy': {
+        'starttime_idx': 'USING btree (starttime DESC)',
+        'metric_idx': 'USING btree (metric_id)',
+    },
+}
+''' index profiles for measurement partitions: {suffix: definition} '''
+
+
+class PartitionManager:
+    '''
+    Manage the partitions of a table partitioned by range on a timestamp.
+    Partitions cover one interval (day or month) and are named
+    {table}_YYYY_MM_DD (day) or {table}_YYYY_MM (month)
+    '''
+
+    INTERVALS = {
+        'day': relativedelta(days=1),
+        'month': relativedelta(months=1),
+    }
+
+    NAME_FORMATS = {
+        'day': '%Y_%m_%d',
+        'month': '%Y_%m',
+    }
+
+    BOUND_PATTERN = re.compile(r"FROM \('(.+)'\) TO \('(.+)'\)")
+
+    def __init__(self, table, interval='day', verifier=None,
+                 index_profiles=None, index_policy=None, on_retire=None,
+                 fill_gaps=True, retention=None):
+        if interval not in self.INTERVALS:
+            raise ValueError(f'Invalid partition interval: {interval}')
+        self.table = table
+        self.interval = interval
+        # verifier is called with a Partition before it is retired and
+        # returns a list of reasons it isn't safe to retire (empty if it is)
+        self.verifier = verifier
+        # on_retire is called with the list of retired partitions, after
+        # they were detached (and dropped)
+        self.on_retire = on_retire
+        # without fill_gaps, only partitions from now on are created, for
+        # tables whose retention can leave old partitions between gaps
+        self.fill_gaps = fill_gaps
+        # gaps older than retention (timedelta) aren't filled, they would
+        # only be retired again, e.g. around a partition not yet exported
+        self.retention = retention
+        # index_profiles maps a profile name to the indexes it puts on a
+        # partition as {suffix: definition}, index_policy is a list of
+        # (minimum age in days, profile name)
+        self.index_profiles = index_profiles or {}
+        self.index_policy = sorted(index_policy or [])
+        for age, profile in self.index_policy:
+            if profile not in self.index_profiles:
+                raise ValueError(f'Unknown index profile: {profile}')
+
+    def truncate(self, time):
+        ''' return the start of the interval containing time '''
+        time = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.interval == 'month':
+            time = time.replace(day=1)
+        return time
+
+    def partition_name(self, start):
+        suffix = start.strftime(self.NAME_FORMATS[self.interval])
+        return f'{self.table}_{suffix}'
+
+    def is_partitioned(self):
+        ''' check whether the table actually is partitioned '''
+        sql = '''
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = %s;
+            '''
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.table])
+            return cursor.fetchone() is not None
+
+    def check_partitioned(self):
+        if not self.is_partitioned():
+            raise PartitionError(f'{self.table} is not a partitioned table')
+
+    def list_partitions(self):
+        '''
+        Return the partitions of the table sorted by start time, with size
+        (bytes, including indexes) and estimated row count. A default
+        partition, if any, is not included
+        '''
+        sql = '''
+            SELECT c.relname,
+                   pg_get_expr(c.relpartbound, c.oid),
+                   pg_total_relation_size(c.oid),
+                   c.reltuples::bigint
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s;
+            '''
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.table])
+            rows = cursor.fetchall()
+
+        partitions = []
+        for name, bound, size, n_rows in rows:
+            match = self.BOUND_PATTERN.search(bound or '')
+            if not match:
+                continue
+            partitions.append(Partition(
+                name=name,
+                start=dateparser.parse(match.group(1)).astimezone(pytz.UTC),
+                end=dateparser.parse(match.group(2)).astimezone(pytz.UTC),
+                size=size,
+                # reltuples is -1 for tables that were never analyzed
+                rows=max(n_rows, 0)
+            ))
+        return sorted(partitions, key=lambda p: p.start)
+
+    def create_partition(self, start):
+        ''' create the partition for the interval starting at start '''
+        start = self.truncate(start)
+        end = start + self.INTERVALS[self.interval]
+        name = self.partition_name(start)
+        with transaction.atomic(), connection.cursor() as cursor:
+            # NOTE: AsIS required for formating table names
+            cursor.execute(
+                '''CREATE TABLE %s PARTITION OF %s
+                   FOR VALUES FROM (%s) TO (%s);''',
+                [AsIs(name), AsIs(self.table), start, end])
+            cursor.execute(
+                'GRANT ALL PRIVILEGES ON TABLE %s TO %s;',
+                [AsIs(name), AsIs(settings.DATABASES['default']['USER'])])
+            profile = self.profile_for(Partition(name, start, end, 0, 0))
+            if profile:
+                self.apply_index_profile(name, profile)
+        return name
+
+    def missing_periods(self, until, since=None):
+        '''
+        Return the start of every interval up to and including until that
+        isn't covered by a partition. Starts at since, or at the first
+        existing partition, so gaps in the middle are found too
+        '''
+        partitions = self.list_partitions()
+        until = self.truncate(until)
+        if since is None:
+            if not partitions:
+                since = until
+            else:
+                since = partitions[0].start
+        current = self.truncate(since)
+
+        missing = []
+        while current <= until:
+            end = current + self.INTERVALS[self.interval]
+            # a period is covered if any partition overlaps it. Partial
+            # overlaps can't be created either, so skip them as well
+            if not any(p.start < end and p.end > current
+                       for p in partitions):
+                missing.append(current)
+            current = end
+        return missing
+
+    def fill_start(self, now=None):
+        '''
+        Where missing partitions are filled from: the first partition (now
+        without fill_gaps, or if there are none), but not before retention
+        '''
+        if not now:
+            now = datetime.now(tz=pytz.UTC)
+        now = self.truncate(now)
+        partitions = self.list_partitions()
+        since = partitions[0].start if partitions and self.fill_gaps else now
+        if self.retention:
+            since = max(since, self.truncate(now - self.retention))
+        return since
+
+    def ensure_horizon(self, count, now=None):
+        '''
+        Make sure partitions exist from the first partition (or now without
+        fill_gaps) up until count intervals past now, filling gaps along the
+        way, though not before retention. Returns lists of the created
+        partition names and of errors
+        '''
+        self.check_partitioned()
+        if not now:
+            now = datetime.now(tz=pytz.UTC)
+        now = self.truncate(now)
+        until = now + self.INTERVALS[self.interval] * count
+
+        created, errors = [], []
+        for start in self.missing_periods(until, since=self.fill_start(now)):
+            try:
+                created.append(self.create_partition(start))
+            except DatabaseError as e:
+                errors.append(str(e))
+        return created, errors
+
+    def expired_partitions(self, retention, now=None):
+        '''
+        Return partitions whose data is entirely older than retention
+        (timedelta or relativedelta)
+        '''
+        if not now:
+            now = datetime.now(tz=pytz.UTC)
+        cutoff = self.truncate(now - retention)
+        return [p for p in self.list_partitions() if p.end <= cutoff]
+
+    def verify(self, partition):
+        ''' return reasons the partition can't be retired, if any '''
+        if self.verifier is None:
+            return []
+        return self.verifier(partition)
+
+    def detach(self, partition):
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s;',
+                           [AsIs(self.table), AsIs(partition.name)])
+
+    def drop(self, partition):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE %s;', [AsIs(partition.name)])
+
+    def swap(self, partition, table_name):
+        '''
+        Replace partition with table_name, a table with the same columns
+        holding the data of the partition's interval
+        '''
+        self.check_partitioned()
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.detach(partition)
+            self.drop(partition)
+            cursor.execute('ALTER TABLE %s RENAME TO %s;',
+                           [AsIs(table_name), AsIs(partition.name)])
+            cursor.execute(
+                '''ALTER TABLE %s ATTACH PARTITION %s
+                   FOR VALUES FROM (%s) TO (%s);''',
+                [AsIs(self.table), AsIs(partition.name), partition.start,
+                 partition.end])
+            cursor.execute(
+                'GRANT ALL PRIVILEGES ON TABLE %s TO %s;',
+                [AsIs(partition.name),
+                 AsIs(settings.DATABASES['default']['USER'])])
+            profile = self.profile_for(partition)
+            if profile:
+                self.apply_index_profile(partition.name, profile)
+
+    def retire(self, retention, now=None, drop=True, verify=True):
+        '''
+        Detach (and drop) every expired partition that passes verification.
+        Returns a list of (partition, reasons) for those that were skipped
+        and a list of the partitions that were retired
+        '''
+        self.check_partitioned()
+        retired, skipped = [], []
+        for partition in self.expired_partitions(retention, now=now):
+            reasons = self.verify(partition) if verify else []
+            if reasons:
+                skipped.append((partition, reasons))
+                continue
+            with transaction.atomic():
+                self.detach(partition)
+                if drop:
+                    self.drop(partition)
+            retired.append(partition)
+        if retired and self.on_retire:
+            self.on_retire(retired)
+        return retired, skipped
+
+    def analyze(self, partitions):
+        ''' refresh planner statistics for the given partitions '''
+        with connection.cursor() as cursor:
+            for partition in partitions:
+                cursor.execute('ANALYZE %s;', [AsIs(partition.name)])
+
+    def profile_for(self, partition, now=None):
+        '''
+        Return the index profile for the partition given its age, the number
+        of whole days since its end. None if there is no index policy
+        '''
+        if not self.index_policy:
+            return None
+        if not now:
+            now = datetime.now(tz=pytz.UTC)
+        age = (now - partition.end).days
+        profile = self.index_policy[0][1]
+        for min_age, name in self.index_policy:
+            if age >= min_age:
+                profile = name
+        return profile
+
+    def index_names(self, table_name):
+        ''' return the names of all indexes on a table '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT indexname FROM pg_indexes WHERE tablename = %s;',
+                [table_name])
+            return {row[0] for row in cursor.fetchall()}
+
+    def apply_index_profile(self, table_name, profile, dry_run=False):
+        '''
+        Create the indexes of profile on table_name (a partition) and drop
+        the ones other profiles would have created. Indexes inherited from
+        the parent are never touched. Returns the created and dropped names
+        '''
+        wanted = {f'{table_name}_{suffix}': definition for suffix, definition
+                  in self.index_profiles[profile].items()}
+        managed = {f'{table_name}_{suffix}'
+                   for indexes in self.index_profiles.values()
+                   for suffix in indexes}
+        existing = self.index_names(table_name)
+        created = sorted(set(wanted) - existing)
+        dropped = sorted((existing & managed) - set(wanted))
+        if dry_run:
+            return created, dropped
+
+        with connection.cursor() as cursor:
+            for name in created:
+                cursor.execute('CREATE INDEX %s ON %s %s;', [
+                    AsIs(name), AsIs(table_name), AsIs(wanted[name])])
+            for name in dropped:
+                cursor.execute('DROP INDEX %s;', [AsIs(name)])
+        return created, dropped
+
+    def apply_index_policy(self, now=None, dry_run=False):
+        '''
+        Bring every partition in line with the index profile for its age.
+        Returns a list of (partition, profile, created, dropped) for the
+        partitions that changed
+        '''
+        self.check_partitioned()
+        if not self.index_policy:
+            raise PartitionError(f'No index policy for {self.table}')
+        changes = []
+        for partition in self.list_partitions():
+            profile = self.profile_for(partition, now=now)
+            with transaction.atomic():
+                created, dropped = self.apply_index_profile(
+                    partition.name, profile, dry_run=dry_run)
+            if created or dropped:
+                changes.append((partition, profile, created, dropped))
+        return changes
+
+    def find(self, names):
+        ''' return partitions matching the given names '''
+        partitions = {p.name: p for p in self.list_partitions()}
+        missing = [name for name in names if name not in partitions]
+        if missing:
+            raise PartitionError(
+                f'Unknown partition(s) of {self.table}: {", ".join(missing)}')
+        return [partitions[name] for name in names]
+
+    def containing(self, starttime, endtime):
+        ''' return partitions overlapping [starttime, endtime) '''
+        return [p for p in self.list_partitions()
+                if p.start < endtime and p.end > starttime]
+
+
+def partition_metrics(partition):
+    ''' return ids of metrics that have measurements in the partition '''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT DISTINCT metric_id FROM %s;',
+                       [AsIs(partition.name)])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def exported_metrics(day):
+    '''
+    Return ids of metrics exported for the given day, either listed in the
+    day's manifest by export_measurements or exported to s3 by
+    s3_query_export, with files named raw/YYYY/mm/YYYY_mm_dd_metric_{id}.csv
+    '''
+    metrics = set()
+    try:
+        manifest = read_manifest(get_storage(), day)
+    except StorageError:
+        manifest = None
+    if manifest:
+        metrics |= {entry['metric'] for entry in manifest['files']}
+
+    prefix = f"raw/{day.strftime('%Y/%m/%Y_%m_%d')}_metric_"
+    try:
+        s3 = boto3.resource('s3')
+        bucket = s3.Bucket(settings.SQUAC_MEASUREMENTS_BUCKET)
+        for obj in bucket.objects.filter(Prefix=prefix):
+            metric = obj.key[len(prefix):].split('.')[0]
+            if metric.isdigit():
+                metrics.add(int(metric))
+    except (botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError):
+        pass
+    return metrics
+
+
+def verify_measurement_partition(partition):
+    '''
+    A measurement partition may only be retired once every metric in it has
+    a day archive and has been exported
+    '''
+    metrics = partition_metrics(partition)
+    if not metrics:
+        return []
+
+    reasons = []
+    archived = set(ArchiveDay.objects.filter(
+        starttime__gte=partition.start,
+        starttime__lt=partition.end).values_list(
+        'metric_id', flat=True).distinct())
+    if metrics - archived:
+        reasons.append('no day archive for metric(s) ' + ', '.join(
+            str(m) for m in sorted(metrics - archived)))
+
+    exported = set()
+    day = partition.start
+    while day < partition.end:
+        exported |= exported_metrics(day)
+        day += timedelta(days=1)
+    if metrics - exported:
+        reasons.append('no export for metric(s) ' + ', '.join(
+            str(m) for m in sorted(metrics - exported)))
+    return reasons
+
+
+def measurement_partitions():
+    ''' PartitionManager for the daily measurement partitions '''
+    retention = settings.MEASUREMENT_RETENTION_DAYS
+    return PartitionManager('measurement_measurement', 'day',
+                            verifier=verify_measurement_partition,
+                            index_profiles=MEASUREMENT_INDEX_PROFILES,
+                            index_policy=settings.MEASUREMENT_INDEX_POLICY,
+                            retention=timedelta(days=retention)
+                            if retention > 0 else None)
+
+
+def verify_alert_partition(partition):
+    '''
+    An alert partition may be retired unless it holds the latest alert of a
+    trigger that is still in alarm, which later evaluations compare against
+    '''
+    triggers = Trigger.objects.filter(
+        latest_alert__timestamp__gte=partition.start,
+        latest_alert__timestamp__lt=partition.end,
+        latest_alert__in_alarm=True).values_list('id', flat=True)
+    if not triggers:
+        return []
+    return ['latest alert of trigger(s) ' + ', '.join(
+        str(trigger) for trigger in sorted(triggers)) + ' still in alarm']
+
+
+def clear_retired_alerts(partitions):
+    '''
+    Forget the latest alert of triggers whose latest alert was in a retired
+    partition. latest_alert has no db constraint to do it
+    '''
+    Trigger.objects.filter(latest_alert__isnull=False).exclude(Exists(
+        Alert.objects.filter(pk=OuterRef('latest_alert_id')))).update(
+        latest_alert=None)
+
+
+def alert_partitions():
+    ''' PartitionManager for the monthly alert partitions '''
+    return PartitionManager('measurement_alert', 'month',
+                            verifier=verify_alert_partition,
+                            on_retire=clear_retired_alerts, fill_gaps=False)
+
+
+PARTITIONED_TABLES = {
+    'measurement': measurement_partitions,
+    'alert': alert_partitions,
+}
+''' PartitionManager factories, by table, for the partitions command '''
@@ -0,0 +1,241 @@
+'''
+Replay a monitor over a historical range without writing alerts, e.g. to
+tune trigger values before saving them.
+
+The measurements of the monitor's metric and channels over the whole range
+are read with one query, as arrays sorted by channel then starttime. The
+window of every (step, channel) is located with one searchsorted over a
+combined (channel, time) key, so counts, sums and averages of every step
+come from prefix sums, and the other stats from one segmented numpy
+reduction per step. Triggers are then masks over the resulting
+(steps x channels) array of the monitor's stat.
+'''
+from django.db import connection
+
+from nslc.models import Group
+
+from datetime import datetime, timedelta
+import numpy as np
+import pytz
+
+
+# a quarter of hourly steps
+MAX_STEPS = 24 * 93
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+PERCENTILES = {'median': 0.5, 'p90': 0.90, 'p95': 0.95}
+
+
+class ReplayError(Exception):
+    ''' Raised when a replay can't be run '''
+    pass
+
+
+def epoch_us(time):
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+
+def replay_steps(starttime, endtime, step):
+    ''' endtimes from starttime to endtime (inclusive) every step '''
+    if endtime < starttime:
+        raise ReplayError('endtime is before starttime')
+    n_steps = (endtime - starttime) // step + 1
+    if n_steps > MAX_STEPS:
+        raise ReplayError(
+            f'{n_steps} steps, at most {MAX_STEPS} can be replayed at once')
+    return [starttime + i * step for i in range(n_steps)]
+
+
+def fetch_series(metric_id, channel_ids, starttime, endtime):
+    '''
+    Return the measurements of a metric for channel_ids (sorted) between
+    starttime and endtime as arrays: index of the channel in channel_ids,
+    starttime in epoch microseconds and value, sorted by channel then
+    starttime
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            '''SELECT channel_id,
+                      (EXTRACT(EPOCH FROM starttime) * 1000000)::bigint,
+                      value
+               FROM measurement_measurement
+               WHERE metric_id = %s AND channel_id = ANY(%s)
+                 AND starttime BETWEEN %s AND %s
+               ORDER BY channel_id, starttime;''',
+            [metric_id, list(channel_ids), starttime, endtime])
+        rows = cursor.fetchall()
+    channels, times, values = (list(column) for column in zip(*rows)) \
+        if rows else ([], [], [])
+    return (np.searchsorted(np.array(channel_ids, dtype=np.int64),
+                            np.array(channels, dtype=np.int64)),
+            np.array(times, dtype=np.int64),
+            np.array(values, dtype=float))
+
+
+def window_bounds(channels, times, n_channels, ends, window, last_n=None):
+    '''
+    Return (lo, hi) arrays of shape (steps, channels): the measurements of
+    channel c in the window ending at ends[s] are [lo[s, c], hi[s, c]) of
+    the sorted arrays. ends and window are in microseconds. With last_n,
+    only the last_n measurements of each window are kept
+    '''
+    base = ends[0] - window
+    width = int(ends[-1] - base) + 1
+    if n_channels * width >= np.iinfo(np.int64).max:
+        raise ReplayError('Range too long to replay for this many channels')
+    keys = channels * width + (times - base)
+    offsets = np.arange(n_channels, dtype=np.int64)[np.newaxis, :] * width
+    hi = np.searchsorted(keys, offsets + (ends - base)[:, np.newaxis],
+                         side='right')
+    lo = np.searchsorted(keys, offsets + (ends - window - base)[:, np.newaxis],
+                         side='left')
+    if last_n:
+        lo = np.maximum(lo, hi - last_n)
+    return lo, hi
+
+
+def segment_stat(values, lo, hi, stat):
+    '''
+    The stat of values over the disjoint, ordered segments [lo[i], hi[i]),
+    NaN for empty segments
+    '''
+    result = np.full(len(lo), np.nan)
+    nonempty = hi > lo
+    if not nonempty.any():
+        return result
+    lo, hi = lo[nonempty], hi[nonempty]
+
+    if stat in PERCENTILES:
+        # gather the segments, sort within each, and interpolate like
+        # percentile_cont
+        counts = hi - lo
+        starts = np.cumsum(counts) - counts
+        segments = np.repeat(np.arange(len(lo)), counts)
+        shifts = np.repeat(starts - lo, counts)
+        gathered = values[np.arange(counts.sum()) - shifts]
+        ordered = gathered[np.lexsort((gathered, segments))]
+        position = PERCENTILES[stat] * (counts - 1)
+        below = np.floor(position).astype(int)
+        above = np.minimum(below + 1, counts - 1)
+        fraction = position - below
+        low = ordered[starts + below] * (1 - fraction)
+        result[nonempty] = low + ordered[starts + above] * fraction
+        return result
+
+    data = np.abs(values) if stat in ('minabs', 'maxabs') else values
+    ufunc = np.minimum if stat in ('min', 'minabs') else np.maximum
+    # reduce over [lo0, hi0), [hi0, lo1), [lo1, hi1)... keeping every other.
+    # The extra element keeps a final hi == len(values) in range
+    indices = np.empty(2 * len(lo), dtype=np.int64)
+    indices[0::2], indices[1::2] = lo, hi
+    result[nonempty] = ufunc.reduceat(np.append(data, 0), indices)[0::2]
+    return result
+
+
+def step_values(values, lo, hi, stat):
+    '''
+    The stat of each (step, channel) window, as Monitor.stat_values would
+    give for each step: NaN where there were no measurements, except count
+    '''
+    counts = hi - lo
+    if stat == 'count':
+        return counts.astype(float)
+    if stat in ('sum', 'avg'):
+        sums = np.concatenate([[0.], np.cumsum(values)])
+        result = sums[hi] - sums[lo]
+        if stat == 'avg':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = result / counts
+    else:
+        result = np.array([segment_stat(values, lo[s], hi[s], stat)
+                           for s in range(len(lo))]).reshape(lo.shape)
+    result[counts == 0] = np.nan
+    return result
+
+
+def replay_values(monitor, ends):
+    '''
+    Return the sorted channel ids of the monitor's group and the
+    (steps x channels) array of the monitor's stat at each of ends
+    '''
+    channel_ids = sorted(Group.channels.through.objects.filter(
+        group_id=monitor.channel_group_id).values_list(
+        'channel_id', flat=True))
+    window = ends[0] - monitor.calc_starttime(ends[0])
+    channels, times, values = fetch_series(
+        monitor.metric_id, channel_ids, ends[0] - window, ends[-1])
+    last_n = (monitor.interval_count
+              if monitor.interval_type == monitor.IntervalType.LASTN
+              else None)
+    lo, hi = window_bounds(
+        channels, times, len(channel_ids),
+        np.array([epoch_us(end) for end in ends], dtype=np.int64),
+        window // timedelta(microseconds=1), last_n)
+    return channel_ids, step_values(values, lo, hi, monitor.stat)
+
+
+def replay_trigger(trigger, values, total_channels):
+    '''
+    Apply trigger to the (steps x channels) values. Returns arrays of
+    whether it is in alarm, its number of breaching channels and whether an
+    alert would be sent, at each step. The trigger is assumed out of alarm
+    before the first step
+    '''
+    mask = trigger.breaching_mask(values)
+    breaching = mask.sum(axis=1)
+    in_alarm = np.asarray(trigger.in_alarm_count(breaching, total_channels),
+                          dtype=bool)
+
+    previous = np.concatenate([[False], in_alarm[:-1]])
+    fired = in_alarm & ~previous
+    if trigger.alert_on_out_of_alarm:
+        fired |= previous & ~in_alarm
+    if trigger.num_channels_operator == trigger.NumChannelsOperator.ANY:
+        previous_mask = np.vstack([np.zeros_like(mask[:1]), mask[:-1]])
+        fired |= (mask & ~previous_mask).any(axis=1)
+        if trigger.alert_on_out_of_alarm:
+            fired |= (previous_mask & ~mask).any(axis=1)
+    return in_alarm, breaching, fired
+
+
+def replay(monitor, starttime, endtime, triggers=None,
+           step=timedelta(hours=1)):
+    '''
+    Evaluate monitor at every step from starttime to endtime with triggers
+    (unsaved Triggers, default the monitor's own) without writing anything.
+    Returns the would have fired timeline of each trigger
+    '''
+    ends = replay_steps(starttime, endtime, step)
+    channel_ids, values = replay_values(monitor, ends)
+    if triggers is None:
+        triggers = list(monitor.triggers.all())
+
+    results = []
+    for trigger in triggers:
+        in_alarm, breaching, fired = replay_trigger(
+            trigger, values, len(channel_ids))
+        results.append({
+            'trigger': trigger.id,
+            'val1': trigger.val1,
+            'val2': trigger.val2,
+            'value_operator': trigger.value_operator,
+            'num_channels': trigger.num_channels,
+            'num_channels_operator': trigger.num_channels_operator,
+            'alert_on_out_of_alarm': trigger.alert_on_out_of_alarm,
+            'in_alarm_steps': int(in_alarm.sum()),
+            'alerts': int(fired.sum()),
+            'timeline': [
+                {'endtime': end, 'in_alarm': bool(alarm),
+                 'breaching_channels': int(count), 'fired': bool(fire)}
+                for end, alarm, count, fire in zip(
+                    ends, in_alarm, breaching, fired)
+            ],
+        })
+    return {
+        'monitor': monitor.id,
+        'starttime': starttime,
+        'endtime': endtime,
+        'step': int(step.total_seconds()),
+        'channels': len(channel_ids),
+        'triggers': results,
+    }
@@ -0,0 +1,256 @@
+'''
+Load files written by export_measurements (see measurement.export) back into
+measurement_measurement.
+
+Files of a day are copied into an unlogged staging table by a pool of worker
+threads, each with its own db connection, using COPY. Once every file of the
+day is loaded the staging table is merged into the measurement table, or, if
+the day's partition is empty, swapped in as the partition. A day that can't
+be merged or swapped in is rolled back and reported, and the others go on.
+'''
+from django.db import DatabaseError, connection, transaction
+from psycopg2.extensions import AsIs
+
+from measurement.export import (ExportTask, day_range, read_file,
+                                read_manifest)
+from measurement.ingest import touch_metrics
+from measurement.partitions import Partition
+
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import io
+import numpy as np
+import time
+
+
+DayResult = namedtuple('DayResult', ['day', 'rows', 'merged', 'swapped'])
+''' outcome of restoring a day: rows loaded and merged (new) rows '''
+
+
+def staging_name(manager, day):
+    start, _ = day_range(day)
+    return f'restore_{manager.partition_name(start)}'
+
+
+def create_staging(manager, day):
+    ''' (re)create the empty staging table for day, without indexes '''
+    name = staging_name(manager, day)
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s;', [AsIs(name)])
+        cursor.execute(
+            'CREATE UNLOGGED TABLE %s (LIKE %s INCLUDING DEFAULTS);',
+            [AsIs(name), AsIs(manager.table)])
+    return name
+
+
+def drop_staging(manager, day):
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s;',
+                       [AsIs(staging_name(manager, day))])
+
+
+def copy_buffer(data):
+    ''' format a dict of arrays as COPY text '''
+    columns = []
+    for array in data.values():
+        if array.dtype.kind == 'M':
+            columns.append(np.datetime_as_string(
+                array, unit='us', timezone='UTC').tolist())
+        else:
+            columns.append([repr(value) for value in array.tolist()])
+    buffer = io.StringIO()
+    for row in zip(*columns):
+        buffer.write('\t'.join(row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_file(storage, entry, table, verify=True):
+    ''' COPY the file of a manifest entry into table, returns its rows '''
+    data = read_file(storage, entry, verify=verify)
+    rows = len(data['id']) if 'id' in data else 0
+    if not rows:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(data)}) FROM STDIN",
+            copy_buffer(data))
+    return rows
+
+
+def merge_staging(manager, day):
+    '''
+    Insert the staged rows of day that aren't in the measurement table
+    yet, then move the id sequence past the restored ids. Returns the
+    number of rows inserted
+    '''
+    staging = staging_name(manager, day)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT column_name FROM information_schema.columns '
+            'WHERE table_name = %s ORDER BY ordinal_position;', [staging])
+        columns = ', '.join(row[0] for row in cursor.fetchall())
+        cursor.execute(
+            f'''INSERT INTO {manager.table} ({columns})
+                SELECT {columns} FROM {staging}
+                ON CONFLICT DO NOTHING;''')
+        merged = cursor.rowcount
+        bump_sequence(manager.table, staging)
+    return merged
+
+
+def bump_sequence(table, source):
+    ''' move the id sequence of table past the ids restored from source '''
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id');", [table])
+        sequence = cursor.fetchone()[0]
+        if sequence:
+            cursor.execute(
+                f'''SELECT setval(%s, max_id)
+                    FROM (SELECT max(id) AS max_id FROM {source}) restored
+                    WHERE max_id > (SELECT last_value FROM {sequence});''',
+                [sequence])
+
+
+def swap_staging(manager, day):
+    '''
+    Replace the empty partition of day with the staging table. Returns the
+    number of rows swapped in
+    '''
+    start, end = day_range(day)
+    staging = staging_name(manager, day)
+    partition = Partition(manager.partition_name(start), start, end, 0, 0)
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE %s SET LOGGED;', [AsIs(staging)])
+        cursor.execute('SELECT count(*) FROM %s;', [AsIs(staging)])
+        rows = cursor.fetchone()[0]
+    manager.swap(partition, staging)
+    bump_sequence(manager.table, partition.name)
+    manager.analyze([partition])
+    return rows
+
+
+def is_empty(table):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT NOT EXISTS (SELECT 1 FROM %s);', [AsIs(table)])
+        return cursor.fetchone()[0]
+
+
+def run_copy(storage, entry, table, verify, close_connection):
+    started = time.monotonic()
+    try:
+        rows = copy_file(storage, entry, table, verify=verify)
+    finally:
+        if close_connection:
+            connection.close()
+    return rows, time.monotonic() - started
+
+
+def restore_days(storage, manager, days, metrics=None, workers=1, swap=False,
+                 verify=True, report=None):
+    '''
+    Restore the exported files of days. Partitions are created as needed if
+    the table is partitioned. With swap, a staging table replaces its
+    partition when that partition is empty instead of being merged.
+
+    report, if given, is called with (task, rows, seconds, error) as each
+    file is loaded. Returns a DayResult per restored day and a list of
+    (task, error) for the files that failed; days with failures aren't merged.
+    Days that fail to merge or swap in are in the list too, with a task of
+    metric None
+    '''
+    partitioned = manager.is_partitioned()
+    tasks = []
+    for day in days:
+        manifest = read_manifest(storage, day)
+        if not manifest:
+            continue
+        for entry in manifest['files']:
+            if not metrics or entry['metric'] in metrics:
+                tasks.append((ExportTask(day, entry['metric']), entry))
+
+    loaded_days = sorted({task.day for task, _ in tasks})
+    for day in loaded_days:
+        start, _ = day_range(day)
+        if partitioned and manager.missing_periods(start, since=start):
+            manager.create_partition(start)
+        create_staging(manager, day)
+
+    remaining = Counter(task.day for task, _ in tasks)
+    rows = defaultdict(int)
+    failed_days = set()
+    results, errors = [], []
+
+    def finish(task, result=None, error=None):
+        if error is not None:
+            errors.append((task, error))
+            failed_days.add(task.day)
+        else:
+            rows[task.day] += result[0]
+        if report:
+            report(task, *(result or (0, 0)), error)
+        remaining[task.day] -= 1
+        if remaining[task.day] == 0:
+            results.append(complete_day(task.day))
+
+    def complete_day(day):
+        try:
+            if day in failed_days:
+                return None
+            start, _ = day_range(day)
+            partition = manager.partition_name(start)
+            with transaction.atomic():
+                if swap and partitioned and is_empty(partition):
+                    result = DayResult(day, rows[day],
+                                       swap_staging(manager, day), True)
+                else:
+                    merged = merge_staging(manager, day)
+                    if partitioned:
+                        manager.analyze(
+                            [Partition(partition, None, None, 0, 0)])
+                    result = DayResult(day, rows[day], merged, False)
+                if result.merged:
+                    # monitors over these metrics have new inputs
+                    touch_metrics({task.metric for task, _ in tasks
+                                   if task.day == day})
+            return result
+        except DatabaseError as e:
+            task = ExportTask(day, None)
+            errors.append((task, e))
+            if report:
+                report(task, 0, 0, e)
+            return None
+        finally:
+            drop_staging(manager, day)
+
+    if workers <= 1:
+        for task, entry in tasks:
+            table = staging_name(manager, task.day)
+            try:
+                result = run_copy(storage, entry, table, verify, False)
+            except Exception as e:
+                finish(task, error=e)
+            else:
+                finish(task, result=result)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(run_copy, storage, entry,
+                                staging_name(manager, task.day), verify,
+                                True): task
+                for task, entry in tasks
+            }
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    finish(task, error=e)
+                else:
+                    finish(task, result=result)
+
+    if not partitioned and results:
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s;', [AsIs(manager.table)])
+    return [result for result in results if result], errors
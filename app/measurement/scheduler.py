@@ -0,0 +1,131 @@
+'''
+Evaluate monitors when they are due, rather than all of them every hour.
+
+A monitor's aggregates only change when a measurement enters or leaves its
+window, so it is evaluated every Monitor.evaluation_period: its metric's
+sample_rate, or its window if that is shorter, between
+settings.MONITOR_SCHEDULE_MIN_PERIOD and a day. Endtimes are multiples of the
+period since the epoch, so hourly monitors are still evaluated at the top of
+the hour and daily ones at midnight.
+
+When each monitor is next due is kept as its MonitorSchedule, so the queue
+survives restarts. Every tick evaluates the due monitors, most overdue first,
+batched by endtime, then moves each one to its next period. Monitors, metrics
+or triggers changed since a monitor was scheduled make it due at once, and
+monitors skipped at the deadline, or locked by another evaluation, stay due
+for the next tick. Daily digests are sent with the first successful
+evaluation of a monitor each day: a monitor that failed keeps its last
+endtime, so it still starts the day when it next succeeds.
+'''
+from django.db.models import Exists, F, OuterRef, Q
+
+from measurement.evaluation import evaluate_monitors, with_related
+from measurement.models import (Monitor, MonitorEvaluation, MonitorSchedule,
+                                Trigger)
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from functools import reduce
+import operator
+import pytz
+import time
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+# not evaluated this tick, so left due for the next one
+RETRIED = (MonitorEvaluation.Status.SKIPPED, MonitorEvaluation.Status.LOCKED)
+
+
+def aligned(when, period):
+    ''' the last multiple of period seconds since the epoch up to when '''
+    step = timedelta(seconds=period)
+    return EPOCH + (when - EPOCH) // step * step
+
+
+def due_monitors(now):
+    ''' Monitors due at now, most overdue (or never scheduled) first '''
+    scheduled_at = F('schedule__scheduled_at')
+    changed_triggers = Trigger.objects.filter(
+        monitor=OuterRef('pk'), updated_at__gt=OuterRef(
+            'schedule__scheduled_at'))
+    due = reduce(operator.or_, [
+        Q(schedule__isnull=True),
+        Q(schedule__next_due__lte=now),
+        Q(updated_at__gt=scheduled_at),
+        Q(metric__updated_at__gt=scheduled_at),
+        Exists(changed_triggers),
+    ])
+    return Monitor.objects.filter(due).order_by(
+        F('schedule__next_due').asc(nulls_first=True), 'id')
+
+
+def starts_day(monitor, endtime, period):
+    ''' Whether evaluating monitor at endtime is its first of the day '''
+    schedule = getattr(monitor, 'schedule', None)
+    previous = schedule.last_endtime if schedule else \
+        endtime - timedelta(seconds=period)
+    return previous < endtime - relativedelta(
+        hour=0, minute=0, second=0, microsecond=0)
+
+
+def evaluate_due(now=None, workers=1, deadline=None, limit=None):
+    '''
+    Evaluate up to limit monitors due at now, each at the end of its last
+    full period, and schedule their next evaluation. deadline is a number of
+    seconds after which monitors that haven't started are skipped. Returns
+    the saved MonitorEvaluations
+    '''
+    # changes are noticed against the clock, whatever now is evaluated
+    scheduled_at = datetime.now(tz=pytz.UTC)
+    now = now or scheduled_at
+    started = time.monotonic()
+    monitors = with_related(due_monitors(now)).select_related('schedule')
+    if limit:
+        monitors = monitors[:limit]
+
+    batches = defaultdict(list)
+    periods = {}
+    for monitor in monitors:
+        periods[monitor.id] = monitor.evaluation_period()
+        batches[aligned(now, periods[monitor.id])].append(monitor)
+
+    evaluations = []
+    schedules = []
+    digests = defaultdict(list)
+    for endtime, batch in sorted(batches.items()):
+        remaining = None if deadline is None else \
+            deadline - (time.monotonic() - started)
+        results = evaluate_monitors(batch, endtime, workers=workers,
+                                    deadline=remaining, digest=False)
+        evaluations += results
+        statuses = {evaluation.monitor_id: evaluation.status
+                    for evaluation in results}
+        for monitor in batch:
+            status = statuses.get(monitor.id)
+            if status in RETRIED:
+                continue
+            period = periods[monitor.id]
+            last_endtime = endtime
+            if status == MonitorEvaluation.Status.ERROR:
+                # errors aren't retried until the next period, but the
+                # day's digest waits for an evaluation that succeeds
+                schedule = getattr(monitor, 'schedule', None)
+                last_endtime = schedule.last_endtime if schedule else \
+                    endtime - timedelta(seconds=period)
+            elif monitor.do_daily_digest and starts_day(monitor, endtime,
+                                                        period):
+                digests[endtime - relativedelta(
+                    hour=0, minute=0, second=0, microsecond=0)].append(
+                    monitor)
+            schedules.append(MonitorSchedule(
+                monitor=monitor, last_endtime=last_endtime,
+                scheduled_at=scheduled_at,
+                next_due=endtime + timedelta(seconds=period)))
+
+    MonitorSchedule.objects.bulk_create(
+        schedules, update_conflicts=True, unique_fields=['monitor'],
+        update_fields=['next_due', 'last_endtime', 'scheduled_at'])
+    for digesttime, due in sorted(digests.items()):
+        Monitor.send_daily_digests(due, digesttime)
+    return evaluations
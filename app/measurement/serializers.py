@@ -1,12 +1,17 @@
 from rest_framework import serializers
+from rest_framework.validators import UniqueTogetherValidator
 from .models import (Metric, Measurement,
                      Alert, ArchiveHour, ArchiveDay, ArchiveWeek, Monitor,
                      Trigger, ArchiveMonth)
+from .ingest import record_ingest
 from nslc.models import Channel, Group
 from drf_yasg.utils import swagger_serializer_method
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
+from datetime import datetime
+import pytz
+
 
 class BulkMeasurementListSerializer(serializers.ListSerializer):
     '''serializer for bulk creating or updating measurements'''
@@ -18,6 +23,7 @@ class BulkMeasurementListSerializer(serializers.ListSerializer):
                          update_fields=["value", "user"],
                          unique_fields=["metric", "channel", "starttime"]
                          )
+        record_ingest(created)
         return created
 
 
@@ -49,6 +55,7 @@ class MeasurementSerializer(serializers.ModelSerializer):
                 'endtime': validated_data.get('endtime', None),
                 'user': validated_data.get('user', None)
             })
+        record_ingest([measurement])
         return measurement
 
     # @staticmethod
@@ -138,6 +145,9 @@ class AlertSerializer(serializers.ModelSerializer):
             'breaching_channels', 'created_at', 'updated_at', 'user'
         )
         read_only_fields = ('id', 'user')
+        # a trigger has at most one alert at a timestamp
+        validators = [UniqueTogetherValidator(
+            queryset=Alert.objects.all(), fields=['trigger', 'timestamp'])]
 
 
 class EmailListFieldSerializer(serializers.CharField):
@@ -288,6 +298,180 @@ class AlertDetailSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'user')
 
 
+class TriggerDefinitionSerializer(serializers.ModelSerializer):
+    '''a candidate trigger for a replay, not saved'''
+
+    class Meta:
+        model = Trigger
+        fields = (
+            'val1', 'val2', 'value_operator', 'num_channels',
+            'num_channels_operator', 'alert_on_out_of_alarm'
+        )
+
+    def validate(self, data):
+        try:
+            Trigger(**data).clean()
+        except ValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return data
+
+
+class BulkTriggerSerializer(TriggerDefinitionSerializer):
+    '''a trigger nested in a bulk monitor request, updated if it has an id'''
+    id = serializers.IntegerField(required=False)
+    emails = EmailListFieldSerializer(
+        max_length=100, required=False, allow_blank=True)
+
+    class Meta:
+        model = Trigger
+        fields = (
+            'id', 'val1', 'val2', 'value_operator', 'num_channels',
+            'num_channels_operator', 'alert_on_out_of_alarm', 'emails'
+        )
+
+    def validate_emails(self, value):
+        if value == '':
+            return None
+        return value
+
+
+class BulkMonitorListSerializer(serializers.ListSerializer):
+    '''
+    Create or update monitors and their nested triggers at once. Related
+    objects are checked with one query per model rather than per monitor,
+    and the monitors, triggers and reset alerts are written with bulk
+    queries. context['monitors'] is the queryset of monitors that can be
+    updated
+    '''
+    MONITOR_FIELDS = ['channel_group_id', 'metric_id', 'interval_type',
+                      'interval_count', 'stat', 'name', 'do_daily_digest']
+    TRIGGER_FIELDS = ['val1', 'val2', 'value_operator', 'num_channels',
+                      'num_channels_operator', 'alert_on_out_of_alarm',
+                      'emails']
+
+    def validate(self, data):
+        group_ids = set(Group.objects.filter(
+            id__in={item['channel_group'] for item in data}).values_list(
+            'id', flat=True))
+        metric_ids = set(Metric.objects.filter(
+            id__in={item['metric'] for item in data}).values_list(
+            'id', flat=True))
+        monitor_ids = [item['id'] for item in data if 'id' in item]
+        self.monitors = self.context['monitors'].filter(
+            id__in=monitor_ids).in_bulk()
+        trigger_ids = [trigger['id'] for item in data
+                       for trigger in item.get('triggers', [])
+                       if 'id' in trigger]
+        self.triggers = Trigger.objects.filter(
+            id__in=trigger_ids, monitor_id__in=self.monitors).in_bulk()
+
+        errors = []
+        if len(set(monitor_ids)) != len(monitor_ids):
+            errors.append('Monitors are listed more than once')
+        if len(set(trigger_ids)) != len(trigger_ids):
+            errors.append('Triggers are listed more than once')
+        for i, item in enumerate(data):
+            if item['channel_group'] not in group_ids:
+                errors.append(f"Monitor {i}: channel_group "
+                              f"{item['channel_group']} does not exist")
+            if item['metric'] not in metric_ids:
+                errors.append(
+                    f"Monitor {i}: metric {item['metric']} does not exist")
+            if 'id' in item and item['id'] not in self.monitors:
+                errors.append(f"Monitor {i}: monitor {item['id']} not found")
+            for trigger in item.get('triggers', []):
+                if 'id' not in trigger:
+                    continue
+                existing = self.triggers.get(trigger['id'])
+                if not existing or existing.monitor_id != item.get('id'):
+                    errors.append(f"Monitor {i}: trigger {trigger['id']} "
+                                  "is not one of its triggers")
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
+
+    def create(self, validated_data):
+        now = datetime.now(tz=pytz.UTC)
+        monitors, created, updated = [], [], []
+        for item in validated_data:
+            fields = {
+                'channel_group_id': item['channel_group'],
+                'metric_id': item['metric'],
+                **{field: item[field] for field in self.MONITOR_FIELDS
+                   if field in item},
+            }
+            if 'id' in item:
+                monitor = self.monitors[item['id']]
+                for field, value in fields.items():
+                    setattr(monitor, field, value)
+                monitor.updated_at = now
+                updated.append(monitor)
+            else:
+                monitor = Monitor(user=item['user'], **fields)
+                created.append(monitor)
+            monitors.append((monitor, item))
+        Monitor.objects.bulk_create(created)
+        Monitor.objects.bulk_update(
+            updated, self.MONITOR_FIELDS + ['updated_at'])
+
+        new_triggers, changed_triggers = [], []
+        for monitor, item in monitors:
+            for trigger_item in item.get('triggers', []):
+                fields = {field: trigger_item[field]
+                          for field in self.TRIGGER_FIELDS
+                          if field in trigger_item}
+                if 'id' in trigger_item:
+                    trigger = self.triggers[trigger_item['id']]
+                    for field, value in fields.items():
+                        setattr(trigger, field, value)
+                    trigger.updated_at = now
+                    changed_triggers.append(trigger)
+                else:
+                    new_triggers.append(Trigger(
+                        monitor=monitor, user=item['user'], **fields))
+        Trigger.objects.bulk_create(new_triggers)
+        Trigger.objects.bulk_update(
+            changed_triggers, self.TRIGGER_FIELDS + ['updated_at'])
+
+        # saving a monitor resets the alerts of all of its triggers
+        unchanged = Trigger.objects.filter(monitor__in=updated).exclude(
+            id__in=[trigger.id for trigger in changed_triggers])
+        reset = new_triggers + changed_triggers
+        Trigger.reset_alerts(reset + list(unchanged), now)
+        return [monitor for monitor, _ in monitors]
+
+
+class BulkMonitorSerializer(serializers.ModelSerializer):
+    '''
+    a monitor of a bulk request, with its triggers. Monitors with an id are
+    updated, as are their triggers with an id, other triggers are created
+    '''
+    id = serializers.IntegerField(required=False)
+    channel_group = serializers.IntegerField()
+    metric = serializers.IntegerField()
+    triggers = BulkTriggerSerializer(many=True, required=False)
+
+    class Meta:
+        model = Monitor
+        fields = (
+            'id', 'channel_group', 'metric', 'interval_type',
+            'interval_count', 'stat', 'name', 'do_daily_digest', 'triggers'
+        )
+        list_serializer_class = BulkMonitorListSerializer
+
+
+class ReplaySerializer(serializers.Serializer):
+    '''parameters of a monitor replay, see measurement.replay'''
+    starttime = serializers.DateTimeField()
+    endtime = serializers.DateTimeField()
+    step = serializers.IntegerField(
+        default=3600, min_value=60,
+        help_text="Seconds between evaluations")
+    triggers = TriggerDefinitionSerializer(
+        many=True, required=False,
+        help_text="Triggers to replay, default the monitor's triggers")
+
+
 class TriggerUnsubscribeSerializer(serializers.Serializer):
     email = serializers.EmailField(
         required=True, style={'placeholder': 'Email', 'autofocus': True},
@@ -0,0 +1,174 @@
+'''
+Storage backends for exported measurement files.
+
+A storage is addressed by url: a plain path or file:///path for a local
+directory, s3://bucket/prefix for an s3 bucket. Paths within a storage are
+relative and always use '/'.
+'''
+from django.conf import settings
+
+from urllib.parse import urlparse
+import abc
+import boto3
+import botocore
+import os
+import shutil
+import tempfile
+
+
+class StorageError(Exception):
+    ''' Raised when a storage can't be used or a file can't be found '''
+    pass
+
+
+class Storage(abc.ABC):
+    ''' interface of a storage backend '''
+
+    @abc.abstractmethod
+    def exists(self, path):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list(self, prefix=''):
+        ''' return the paths starting with prefix, sorted '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save(self, path, fileobj):
+        ''' save the content of a readable binary file object to path '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def open(self, path):
+        ''' return a readable binary file object, closed by the caller '''
+        raise NotImplementedError
+
+    def read(self, path):
+        with self.open(path) as f:
+            return f.read()
+
+    def write(self, path, data):
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            self.save(path, f)
+
+
+class LocalStorage(Storage):
+    ''' files in a local directory '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def __str__(self):
+        return self.root
+
+    def full_path(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def exists(self, path):
+        return os.path.isfile(self.full_path(path))
+
+    def list(self, prefix=''):
+        paths = []
+        for directory, _, files in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root)
+            for name in files:
+                path = name if relative == '.' else '/'.join(
+                    relative.split(os.sep) + [name])
+                if path.startswith(prefix) and not name.startswith('.'):
+                    paths.append(path)
+        return sorted(paths)
+
+    def save(self, path, fileobj):
+        full_path = self.full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # write next to the destination then rename, so readers never see a
+        # partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path),
+                                        prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open(self, path):
+        try:
+            return open(self.full_path(path), 'rb')
+        except FileNotFoundError:
+            raise StorageError(f'{path} not found in {self}')
+
+
+class S3Storage(Storage):
+    ''' objects in an s3 bucket, under an optional prefix '''
+
+    def __init__(self, bucket, prefix=''):
+        if not bucket:
+            raise StorageError('No s3 bucket configured')
+        self.bucket_name = bucket
+        self.prefix = prefix.strip('/')
+
+    def __str__(self):
+        return f's3://{self.bucket_name}/{self.prefix}'
+
+    @property
+    def bucket(self):
+        return boto3.resource('s3').Bucket(self.bucket_name)
+
+    def key(self, path):
+        return f'{self.prefix}/{path}' if self.prefix else path
+
+    def exists(self, path):
+        try:
+            return self.key(path) in {
+                obj.key for obj in self.bucket.objects.filter(
+                    Prefix=self.key(path))}
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            raise StorageError(str(e))
+
+    def list(self, prefix=''):
+        start = len(self.key(''))
+        try:
+            return sorted(obj.key[start:] for obj in
+                          self.bucket.objects.filter(Prefix=self.key(prefix)))
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            raise StorageError(str(e))
+
+    def save(self, path, fileobj):
+        try:
+            self.bucket.upload_fileobj(fileobj, self.key(path))
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            raise StorageError(str(e))
+
+    def open(self, path):
+        f = tempfile.TemporaryFile()
+        try:
+            self.bucket.download_fileobj(self.key(path), f)
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            f.close()
+            raise StorageError(f'{path}: {e}')
+        f.seek(0)
+        return f
+
+
+def get_storage(url=None):
+    '''
+    Return the storage for url, defaults to
+    settings.MEASUREMENT_EXPORT_STORAGE
+    '''
+    url = url or settings.MEASUREMENT_EXPORT_STORAGE
+    if not url:
+        raise StorageError('No export storage configured')
+    parsed = urlparse(url)
+    if parsed.scheme == 's3':
+        return S3Storage(parsed.netloc, parsed.path)
+    if parsed.scheme in ('', 'file'):
+        return LocalStorage(parsed.path)
+    raise StorageError(f'Unsupported storage: {url}')
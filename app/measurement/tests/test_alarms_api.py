@@ -1,12 +1,22 @@
 from unittest.mock import patch
 from django.core import mail
 from django.core.management import call_command
-from django.test import TestCase
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from measurement.models import (Monitor, Trigger, Alert, Measurement,
-                                Metric)
+from core.models import OutboxEmail
+from measurement.evaluation import (EVALUATE_ALARMS_LOCK, MONITOR_LOCK,
+                                    advisory_lock, evaluate_monitors,
+                                    prune_evaluations)
+from measurement.ingest import evaluate_dirty, touch_metrics
+from measurement.models import (DirtySeries, Monitor, MonitorEvaluation,
+                                MonitorSchedule, MonitorState, Trigger, Alert,
+                                Measurement, Metric)
+from measurement.scheduler import aligned, evaluate_due
 from nslc.models import Channel, Group, Network
 from organization.models import Organization
 
@@ -14,6 +24,8 @@ from rest_framework.test import APIClient
 from rest_framework import status
 
 from datetime import datetime
+from io import StringIO
+import json
 from dateutil.relativedelta import relativedelta
 import pytz
 from squac.test_mixins import sample_user
@@ -362,11 +374,71 @@ class PrivateAlarmAPITests(TestCase):
             breaching_channels=breaching_channels
         )
         n_alerts2 = trigger.alerts.count()
-        self.assertNotEqual(n_alerts1, n_alerts2)
+        # nothing changed, so no alert is created or sent
+        self.assertEqual(n_alerts1, n_alerts2)
         self.assertTrue(alert.in_alarm)
         # no alert sent if same channels are breaching as previous alert
         self.assertFalse(send_alert.called)
 
+    def test_alert_chains_stay_in_month(self):
+        '''A new month starts a new chain, as alerts are partitioned by it'''
+        ch1 = {"sum": 3, "channel": "UW:STA1:--:HNN", "channel_id": 1}
+        ch2 = {"sum": 3, "channel": "UW:STA2:--:HNN", "channel_id": 2}
+        end = datetime.now(tz=pytz.UTC).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0) \
+            + relativedelta(months=1)
+        first = self.trigger.evaluate_alert(
+            True, [ch1], end - relativedelta(hours=2))
+        second = self.trigger.evaluate_alert(
+            True, [ch1, ch2], end - relativedelta(hours=1))
+        third = self.trigger.evaluate_alert(True, [ch2], end)
+        self.assertEqual(first.snapshot_id or first.id, second.snapshot_id)
+        self.assertIsNone(third.snapshot_id)
+        self.assertEqual([ch2], third.breaching_channels)
+
+    def test_alerts_stored_as_changes(self):
+        '''Alerts keep the channels added and removed, read back in full'''
+        reftime = datetime.now(tz=pytz.UTC)
+        chans = [{"sum": 3, "channel": f"UW:STA{i}:--:HNN", "channel_id": i}
+                 for i in range(4)]
+        steps = [chans[:2], chans[:2], chans[1:3], chans[1:4], [],
+                 chans[:1]]
+        with self.settings(ALERT_SNAPSHOT_EVERY=2):
+            for hours, channels in enumerate(steps):
+                self.trigger.evaluate_alert(
+                    bool(channels), channels,
+                    reftime + relativedelta(hours=hours + 1))
+
+        # repeating the same channels didn't create an alert. The first
+        # follows the alert created when the trigger was saved
+        reset = self.trigger.alerts.filter(timestamp__lte=reftime).latest(
+            'timestamp')
+        alerts = list(self.trigger.alerts.filter(
+            timestamp__gt=reftime).order_by('timestamp'))
+        self.assertEqual(5, len(alerts))
+        self.assertEqual([reset.id, reset.id, None, alerts[2].id,
+                          alerts[2].id],
+                         [alert.snapshot_id for alert in alerts])
+        self.assertEqual([chans[2]], alerts[1].added_channels)
+        self.assertEqual([chans[0]], alerts[1].removed_channels)
+        # only snapshots and the last alert of a chain keep every channel
+        self.assertEqual([False, True, True, False, True],
+                         [alert.breaching_channels is not None
+                          for alert in alerts])
+
+        Alert.fill_breaching_channels(alerts)
+        self.assertEqual([chans[:2], chans[1:3], chans[1:4], [], chans[:1]],
+                         [alert.breaching_channels for alert in alerts])
+
+        url = reverse('measurement:alert-detail', args=[alerts[0].id])
+        res = self.client.get(url)
+        self.assertEqual(chans[:2], res.data['breaching_channels'])
+        res = self.client.get(reverse('measurement:alert-list'))
+        self.assertEqual(
+            [],
+            next(alert['breaching_channels'] for alert in res.data
+                 if alert['id'] == alerts[3].id))
+
     def test_evaluate_alarm(self):
         '''This is more like an integration test at the moment'''
         monitor = Monitor.objects.get(pk=1)
@@ -428,9 +500,558 @@ class PrivateAlarmAPITests(TestCase):
         '''Test evaluate_alarm command'''
         n_monitors = len(Monitor.objects.all())
         with patch('measurement.models.Monitor.evaluate_alarm') as ea:
-            call_command('evaluate_alarms')
+            call_command('evaluate_alarms', verbosity=0)
             self.assertEqual(n_monitors, ea.call_count)
 
+    def test_evaluate_monitors_batches_windows(self):
+        '''Monitors sharing a metric and window share one aggregate query'''
+        Monitor.objects.create(
+            channel_group=Group.objects.get(pk=2),
+            metric=Metric.objects.get(pk=1),
+            interval_type=Monitor.IntervalType.HOUR,
+            interval_count=2,
+            stat=Monitor.Stat.SUM,
+            user=self.user
+        )
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        with patch('measurement.models.Monitor.evaluate_alarm',
+                   autospec=True) as ea, \
+                patch.object(Monitor, 'aggregate_channels',
+                             wraps=Monitor.aggregate_channels) as agg:
+            evaluate_monitors(Monitor.objects.all(), endtime)
+        # (metric 1, 2 hours), (metric 2, 2 hours) and self.monitor's window
+        self.assertEqual(3, agg.call_count)
+        self.assertEqual(5, ea.call_count)
+
+        def by_channel(values):
+            return sorted(values, key=lambda value: value['channel'])
+        for call in ea.call_args_list:
+            monitor = call.args[0]
+            self.assertEqual(
+                by_channel(monitor.agg_measurements(endtime)),
+                by_channel(call.kwargs['channel_values']))
+
+    def test_evaluate_monitors(self):
+        '''Batched evaluation creates the same alerts as evaluate_alarm'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        evaluate_monitors(Monitor.objects.filter(pk=1), endtime)
+        self.assertEqual(2, Trigger.objects.get(pk=1).alerts.count())
+        self.assertEqual(14, Alert.objects.count())
+
+    def test_aggregate_breaching(self):
+        '''The database finds the same breaching channels as Python'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        monitor = Monitor.objects.get(pk=1)
+        channel_ids = sorted(monitor.channel_group.channels.values_list(
+            'id', flat=True))
+        channel_values = monitor.agg_measurements(endtime)
+        with self.assertNumQueries(2):
+            breaches = monitor.aggregate_breaching(
+                channel_ids, monitor.calc_starttime(endtime), endtime)
+        for trigger in monitor.triggers.all():
+            expected = trigger.get_breaching_channels(channel_values)
+            self.assertEqual(len(expected), len(breaches[trigger.id]))
+            for channel, breach in zip(expected, breaches[trigger.id]):
+                self.assertEqual(channel['channel'], breach['channel'])
+                self.assertAlmostEqual(channel['value'], breach['value'])
+        self.assertTrue(any(breaches.values()))
+
+        # channels without measurements count 0, but have no row
+        self.assertTrue(monitor.can_filter_breaches())
+        monitor.stat = Monitor.Stat.COUNT
+        trigger = monitor.triggers.all()[0]
+        trigger.value_operator = Trigger.ValueOperator.LESS_THAN
+        trigger.val1 = 1
+        self.assertFalse(monitor.can_filter_breaches())
+
+    def test_evaluate_monitors_filters_breaches(self):
+        '''Large groups are evaluated from their breaching channels only'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        with self.settings(MONITOR_SQL_BREACHES_MIN_CHANNELS=1), \
+                patch.object(Monitor, 'aggregate_channels') as agg:
+            evaluation, = evaluate_monitors(
+                Monitor.objects.filter(pk=1), endtime)
+        self.assertEqual(0, agg.call_count)
+        self.assertEqual(MonitorEvaluation.Status.OK, evaluation.status)
+        self.assertEqual(2, Trigger.objects.get(pk=1).alerts.count())
+        self.assertEqual(14, Alert.objects.count())
+        # only breaching channels are kept, and the state isn't reused
+        state = Monitor.objects.get(pk=1).state
+        self.assertIsNone(state.watermark)
+        breaching = set().union(*state.breaching.values())
+        self.assertEqual(sorted(breaching), [
+            value['channel'] for value in state.channel_values])
+
+    def test_evaluate_monitors_records_evaluations(self):
+        '''Each evaluation is recorded with its timing and outcome'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        evaluate_monitors(Monitor.objects.filter(pk=1), endtime)
+        evaluation = MonitorEvaluation.objects.get(monitor=1)
+        self.assertEqual(MonitorEvaluation.Status.OK, evaluation.status)
+        self.assertEqual(endtime, evaluation.endtime)
+        self.assertGreater(evaluation.query_count, 0)
+
+        with patch('measurement.models.Monitor.evaluate_alarm',
+                   side_effect=ValueError('broken')):
+            evaluations = evaluate_monitors(Monitor.objects.all(), endtime)
+        self.assertEqual({MonitorEvaluation.Status.ERROR},
+                         {evaluation.status for evaluation in evaluations})
+        self.assertEqual('broken', evaluations[0].error)
+
+    def test_evaluate_monitors_deadline(self):
+        '''Monitors not started before the deadline are skipped'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+            evaluations = evaluate_monitors(Monitor.objects.all(), endtime,
+                                            deadline=-1)
+        self.assertEqual(0, ea.call_count)
+        self.assertEqual(Monitor.objects.count(), len(evaluations))
+        self.assertEqual({MonitorEvaluation.Status.SKIPPED},
+                         {evaluation.status for evaluation in evaluations})
+
+    def test_evaluate_alarms_locked(self):
+        '''A run is skipped while another one holds the lock'''
+        # advisory locks are per session, so take it from another connection
+        other = connections.create_connection('default')
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s);',
+                               [EVALUATE_ALARMS_LOCK])
+            out = StringIO()
+            with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+                call_command('evaluate_alarms', stdout=out)
+            self.assertEqual(0, ea.call_count)
+            self.assertIn('skipping', out.getvalue())
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s);',
+                               [EVALUATE_ALARMS_LOCK])
+        finally:
+            other.close()
+
+        with advisory_lock(EVALUATE_ALARMS_LOCK) as acquired:
+            self.assertTrue(acquired)
+
+    def test_evaluate_alarms_errors(self):
+        '''The command fails when a monitor can't be evaluated'''
+        with patch('measurement.models.Monitor.evaluate_alarm',
+                   side_effect=ValueError('broken')):
+            with self.assertRaises(CommandError):
+                call_command('evaluate_alarms', stdout=StringIO())
+        self.assertEqual(Monitor.objects.count(),
+                         MonitorEvaluation.objects.count())
+
+    def test_evaluate_monitors_dry_run(self):
+        '''A dry run evaluates and profiles monitors, saving nothing'''
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        models = [Alert, MonitorEvaluation, MonitorState, OutboxEmail]
+        counts = [model.objects.count() for model in models]
+        profiles = {}
+        with self.settings(EMAIL_OUTBOX=False):
+            evaluations = evaluate_monitors(Monitor.objects.all(), endtime,
+                                            dry_run=True, profiles=profiles)
+        self.assertEqual(counts, [model.objects.count() for model in models])
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual({MonitorEvaluation.Status.OK},
+                         {evaluation.status for evaluation in evaluations})
+        self.assertEqual({evaluation.monitor_id for evaluation in evaluations},
+                         set(profiles))
+
+        evaluation = next(evaluation for evaluation in evaluations
+                          if evaluation.monitor_id == 1)
+        profile = profiles[1]
+        self.assertEqual(evaluation.query_count, profile['queries'])
+        self.assertLessEqual(profile['sql_time'], evaluation.duration)
+        self.assertGreater(profile['aggregate_queries'], 0)
+        self.assertGreater(profile['aggregate_rows'], 0)
+        self.assertIn('SELECT', profile['slowest_query']['sql'])
+
+        # the same evaluation for real creates alerts
+        evaluate_monitors(Monitor.objects.filter(pk=1), endtime)
+        self.assertEqual(14, Alert.objects.count())
+
+    def test_evaluate_alarms_profile(self):
+        '''evaluate_alarms --dry-run --profile reports each monitor'''
+        out = StringIO()
+        call_command('evaluate_alarms', '--dry-run', '--profile',
+                     '--format=json', '--explain=1', stdout=out)
+        rows = json.loads(out.getvalue())
+        self.assertEqual(Monitor.objects.count(), len(rows))
+        self.assertEqual(sorted(row['duration'] for row in rows)[::-1],
+                         [row['duration'] for row in rows])
+        self.assertIn('Execution Time', rows[0]['explain'][-1])
+        self.assertEqual(1, len([row for row in rows if 'explain' in row]))
+        self.assertFalse(MonitorEvaluation.objects.exists())
+
+        out = StringIO()
+        call_command('evaluate_alarms', '--dry-run', '--profile',
+                     '--sort=queries', '--top=2', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn('python s', lines[0])
+        self.assertEqual('Dry run, nothing was saved', lines[-1])
+
+    def test_evaluate_monitors_reuses_unchanged(self):
+        '''Monitors whose inputs haven't moved reuse their last evaluation'''
+        endtime = datetime(2019, 5, 5, 9, 0, 0, 0, tzinfo=pytz.UTC)
+        touch_metrics([self.metric.id], now=endtime - relativedelta(hours=1))
+        monitors = Monitor.objects.filter(pk=self.monitor.pk)
+
+        def evaluate(hours):
+            with patch.object(Monitor, 'aggregate_channels',
+                              wraps=Monitor.aggregate_channels) as agg:
+                evaluation, = evaluate_monitors(
+                    monitors, endtime + relativedelta(hours=hours))
+            return evaluation.status, agg.call_count
+
+        Status = MonitorEvaluation.Status
+        self.assertEqual((Status.OK, 1), evaluate(0))
+        self.assertEqual((Status.UNCHANGED, 0), evaluate(1))
+        self.assertEqual(endtime, self.monitor.state.endtime)
+
+        # triggers are evaluated again when they change
+        self.trigger.save()
+        self.assertEqual((Status.CACHED, 0), evaluate(2))
+
+        # new data
+        self.getTestMeasurement(self.metric, self.chan1, 3,
+                                relativedelta(hours=0))
+        touch_metrics([self.metric.id], now=endtime + relativedelta(hours=2))
+        self.assertEqual((Status.OK, 1), evaluate(3))
+        self.assertEqual((Status.UNCHANGED, 0), evaluate(4))
+        # the measurement left the window
+        self.assertEqual((Status.OK, 1), evaluate(24))
+
+    def test_touch_metrics_resolution(self):
+        '''The watermark moves at most once per resolution'''
+        now = timezone.now()
+        touch_metrics([self.metric.id], now=now)
+        touch_metrics([self.metric.id], now=now + relativedelta(seconds=30))
+        self.assertEqual(now, Metric.objects.get(
+            pk=self.metric.pk).last_ingested_at)
+        touch_metrics([self.metric.id], now=now + relativedelta(seconds=61))
+        self.assertEqual(now + relativedelta(seconds=61),
+                         Metric.objects.get(
+                             pk=self.metric.pk).last_ingested_at)
+
+        # an evaluation right after the watermark moved may have missed
+        # ingests that didn't move it, so it isn't reused
+        endtime = now + relativedelta(hours=1, minute=0, second=0,
+                                      microsecond=0)
+        monitors = Monitor.objects.filter(pk=self.monitor.pk)
+        touch_metrics([self.metric.id])
+        evaluate_monitors(monitors, endtime)
+        evaluation, = evaluate_monitors(monitors, endtime)
+        self.assertEqual(MonitorEvaluation.Status.OK, evaluation.status)
+        with self.settings(MONITOR_WATERMARK_RESOLUTION=0):
+            evaluation, = evaluate_monitors(monitors, endtime)
+        self.assertEqual(MonitorEvaluation.Status.UNCHANGED,
+                         evaluation.status)
+
+    def test_monitor_status(self):
+        '''The last evaluation's values and breaches are served as is'''
+        url = reverse('measurement:monitor-status', args=[self.monitor.id])
+        self.assertEqual(status.HTTP_404_NOT_FOUND,
+                         self.client.get(url).status_code)
+
+        self.getTestMeasurement(self.metric, self.chan1, 3,
+                                relativedelta(hours=0))
+        self.getTestMeasurement(self.metric, self.chan2, 7,
+                                relativedelta(hours=0))
+        endtime = datetime(2019, 5, 5, 9, 0, 0, 0, tzinfo=pytz.UTC)
+        evaluate_monitors(Monitor.objects.filter(pk=self.monitor.pk), endtime)
+        with self.assertNumQueries(4):
+            res = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, res.status_code)
+        self.assertEqual(endtime, res.data['endtime'])
+        self.assertGreater(res.data['duration'], 0)
+        self.assertEqual(
+            [{'id': self.trigger.id, 'in_alarm': False,
+              'breaching_channels': 1}], res.data['triggers'])
+        channels = {channel['channel']: channel
+                    for channel in res.data['channels']}
+        self.assertEqual(3, channels[self.chan1.id]['value'])
+        self.assertEqual('UW.CH1.--.EHZ', channels[self.chan1.id]['nslc'])
+        self.assertEqual([self.trigger.id],
+                         channels[self.chan1.id]['breaching_triggers'])
+        self.assertEqual([], channels[self.chan2.id]['breaching_triggers'])
+        self.assertFalse(res.data['stale'])
+
+        # until it is evaluated again, a changed monitor's status is stale,
+        # and values aggregated from archives don't have its new stat
+        state = MonitorState.objects.get(monitor=self.monitor)
+        state.channel_values = [
+            {key: value[key] for key in ['channel', 'sum']}
+            for value in state.channel_values]
+        state.save()
+        self.monitor.stat = Monitor.Stat.MEDIAN
+        self.monitor.save()
+        res = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, res.status_code)
+        self.assertTrue(res.data['stale'])
+        self.assertEqual({None}, {channel['value']
+                                  for channel in res.data['channels']})
+
+    def test_incremental_evaluation(self):
+        '''Ingest marks series dirty, only their monitors are evaluated'''
+        url = reverse('measurement:measurement-list')
+        starttime = datetime(2018, 2, 1, 4, 0, 0, 0, tzinfo=pytz.UTC)
+
+        def measurement(metric, channel, hours=0):
+            return {
+                'metric': metric, 'channel': channel, 'value': 1.0,
+                'starttime': starttime + relativedelta(hours=hours),
+                'endtime': starttime + relativedelta(hours=hours + 1)}
+
+        # off by default, the ingest watermark always moves
+        self.client.post(url, measurement(1, 1), format='json')
+        self.assertEqual(0, DirtySeries.objects.count())
+        self.assertIsNotNone(Metric.objects.get(pk=1).last_ingested_at)
+
+        with self.settings(MONITOR_INCREMENTAL_EVALUATION=True):
+            res = self.client.post(url, measurement(1, 1), format='json')
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            res = self.client.post(
+                url, [measurement(self.metric.id, self.chan1.id, hours)
+                      for hours in range(3)], format='json')
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(2, DirtySeries.objects.count())
+
+        now = datetime.now(tz=pytz.UTC)
+        with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+            # not quiet for long enough yet
+            self.assertEqual([], evaluate_dirty(debounce=60, now=now))
+            evaluations = evaluate_dirty(
+                debounce=60, now=now + relativedelta(minutes=2))
+        self.assertEqual(
+            {1, self.monitor.id},
+            {evaluation.monitor_id for evaluation in evaluations})
+        self.assertEqual(2, ea.call_count)
+        self.assertEqual(0, DirtySeries.objects.count())
+        # at the same endtimes as scheduled evaluations
+        for evaluation in evaluations:
+            self.assertEqual(
+                aligned(now + relativedelta(minutes=2),
+                        evaluation.monitor.evaluation_period()),
+                evaluation.endtime)
+
+    def test_evaluation_period(self):
+        '''Monitors are evaluated at their metric's sample rate'''
+        # no sample rate, hourly
+        self.assertEqual(3600, Monitor.objects.get(pk=1).evaluation_period())
+        self.metric.sample_rate = 1
+        self.assertEqual(60, self.monitor.evaluation_period())
+        self.metric.sample_rate = 2 * 24 * 3600
+        self.assertEqual(24 * 3600, self.monitor.evaluation_period())
+        # the window changes sooner than new measurements arrive
+        monitor = self.getTestMonitor(interval_count=10)
+        monitor.metric.sample_rate = 3600
+        self.assertEqual(600, monitor.evaluation_period())
+
+    def test_evaluate_due(self):
+        '''Only due monitors are evaluated, each at the end of its period'''
+        Monitor.objects.exclude(pk=self.monitor.pk).delete()
+        self.metric.sample_rate = 60
+        self.metric.save()
+        minute_monitor = self.getTestMonitor()
+        daily_metric = Metric.objects.create(
+            name='Daily metric', code='daily', unit='furlong',
+            sample_rate=24 * 3600, user=self.user, reference_url='pnsn.org')
+        daily_monitor = self.getTestMonitor(Monitor.IntervalType.DAY, 2)
+        daily_monitor.metric = daily_metric
+        daily_monitor.save()
+        now = datetime.now(tz=pytz.UTC).replace(hour=12, minute=30,
+                                                second=10, microsecond=0)
+
+        def evaluate(seconds):
+            with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+                evaluate_due(now + relativedelta(seconds=seconds))
+            return sorted(call.kwargs['endtime'] for call in ea.call_args_list)
+
+        minute = now.replace(second=0)
+        day = now.replace(hour=0, minute=0, second=0)
+        self.assertEqual([day, minute, minute], evaluate(0))
+        self.assertEqual([], evaluate(30))
+        self.assertEqual(minute + relativedelta(minutes=1),
+                         MonitorSchedule.objects.get(
+                             monitor=minute_monitor).next_due)
+        # a minute later only the minute monitors are due
+        self.assertEqual([minute + relativedelta(minutes=1)] * 2,
+                         evaluate(60))
+        # changing a monitor makes it due at once
+        daily_monitor.save()
+        self.assertEqual([day], evaluate(61))
+        self.assertEqual(day + relativedelta(days=1), MonitorSchedule.objects
+                         .get(monitor=daily_monitor).next_due)
+
+    def test_evaluate_due_sends_digest_once(self):
+        '''The daily digest goes out with the first evaluation of a day'''
+        Monitor.objects.exclude(pk=self.monitor.pk).delete()
+        self.metric.sample_rate = 60
+        self.metric.save()
+        self.monitor.interval_type = Monitor.IntervalType.MINUTE
+        self.monitor.do_daily_digest = True
+        self.monitor.save()
+        midnight = datetime.now(tz=pytz.UTC) - relativedelta(
+            hour=0, minute=0, second=0, microsecond=0)
+        with patch('measurement.models.Monitor.evaluate_alarm'), \
+                patch.object(Monitor, 'send_daily_digests') as digests:
+            evaluate_due(midnight - relativedelta(minutes=1))
+            for minute in range(3):
+                evaluate_due(midnight + relativedelta(minutes=minute))
+        digests.assert_called_once_with([self.monitor], midnight)
+
+    def test_evaluate_due_digest_after_error(self):
+        '''A monitor that failed gets its digest once it is evaluated'''
+        Monitor.objects.exclude(pk=self.monitor.pk).delete()
+        self.metric.sample_rate = 60
+        self.metric.save()
+        self.monitor.interval_type = Monitor.IntervalType.MINUTE
+        self.monitor.do_daily_digest = True
+        self.monitor.save()
+        midnight = datetime.now(tz=pytz.UTC) - relativedelta(
+            hour=0, minute=0, second=0, microsecond=0)
+        with patch.object(Monitor, 'send_daily_digests') as digests:
+            with patch('measurement.models.Monitor.evaluate_alarm',
+                       side_effect=ValueError('broken')):
+                evaluate_due(midnight - relativedelta(minutes=1))
+                evaluate_due(midnight)
+                # evaluate_monitors leaves it out of the digests too
+                evaluate_monitors([self.monitor], midnight)
+            self.assertEqual(0, digests.call_count)
+            with patch('measurement.models.Monitor.evaluate_alarm'):
+                evaluate_due(midnight + relativedelta(minutes=1))
+                evaluate_due(midnight + relativedelta(minutes=2))
+        digests.assert_called_once_with([self.monitor], midnight)
+
+    def test_evaluate_due_monitors_command(self):
+        '''The command evaluates due monitors once per tick'''
+        out = StringIO()
+        with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+            call_command('evaluate_due_monitors', stdout=out)
+            call_command('evaluate_due_monitors', stdout=out)
+        self.assertEqual(Monitor.objects.count(), ea.call_count)
+        self.assertEqual(Monitor.objects.count(),
+                         MonitorSchedule.objects.count())
+
+    def test_evaluate_due_monitors_prunes_evaluations(self):
+        '''Evaluations older than the retention are deleted every tick'''
+        now = timezone.now()
+        for days in [1, 29, 31, 60]:
+            MonitorEvaluation.objects.create(
+                monitor=self.monitor, endtime=now,
+                started_at=now - relativedelta(days=days))
+        with self.settings(MONITOR_EVALUATION_RETENTION_DAYS=30), \
+                patch('measurement.models.Monitor.evaluate_alarm'):
+            call_command('evaluate_due_monitors', stdout=StringIO())
+        self.assertEqual(
+            [1, 29],
+            sorted((now - started_at).days for started_at in
+                   MonitorEvaluation.objects.filter(
+                       started_at__lt=now).values_list(
+                       'started_at', flat=True)))
+
+        with self.settings(MONITOR_EVALUATION_RETENTION_DAYS=0):
+            self.assertEqual(0, prune_evaluations(now + relativedelta(
+                days=100)))
+
+    def test_latest_alert_kept_on_trigger(self):
+        '''Trigger.latest_alert follows the most recent alert'''
+        trigger = Trigger.objects.get(pk=self.trigger.pk)
+        # self.alert is older than the alert created by saving the trigger
+        self.assertEqual(trigger.alerts.order_by('timestamp').last(),
+                         trigger.latest_alert)
+        self.assertNotEqual(self.alert, trigger.latest_alert)
+
+        alert = trigger.create_alert(True)
+        self.assertEqual(alert, trigger.latest_alert)
+        trigger = Trigger.objects.select_related('latest_alert').get(
+            pk=trigger.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(alert, trigger.get_latest_alert())
+        # reftime before the latest alert
+        self.assertEqual(self.alert, trigger.get_latest_alert(
+            reftime=datetime(1980, 1, 1, tzinfo=pytz.UTC)))
+
+        # an older alert doesn't replace it
+        trigger.create_alert(False, timestamp=datetime(
+            1975, 1, 1, tzinfo=pytz.UTC))
+        self.assertEqual(alert, Trigger.objects.get(
+            pk=trigger.pk).latest_alert)
+
+        # an alert moved later does
+        self.alert.timestamp = alert.timestamp + relativedelta(days=1)
+        self.alert.save()
+        self.assertEqual(self.alert, Trigger.objects.get(
+            pk=trigger.pk).latest_alert)
+
+    @patch.object(Alert, 'send_alert')
+    def test_evaluate_alert_replayed(self, send_alert):
+        '''A replayed evaluation doesn't create or send its alert again'''
+        # after the reset alert created with the trigger
+        reftime = timezone.now() + relativedelta(hours=1)
+        # two runs that read the trigger before either created an alert
+        trigger, replay = [Trigger.objects.select_related(
+            'latest_alert').get(pk=self.trigger.pk) for _ in range(2)]
+        alert = trigger.evaluate_alert(True, reftime=reftime)
+        self.assertEqual(1, send_alert.call_count)
+
+        count = Alert.objects.count()
+        self.assertIsNone(replay.create_alert(True, timestamp=reftime))
+        self.assertEqual(alert, replay.evaluate_alert(True, reftime=reftime))
+        self.assertEqual(1, send_alert.call_count)
+        self.assertEqual(count, Alert.objects.count())
+        self.assertEqual(alert, Trigger.objects.get(
+            pk=trigger.pk).latest_alert)
+
+        url = reverse('measurement:alert-list')
+        res = self.client.post(url, {'trigger': trigger.id,
+                                     'timestamp': reftime, 'in_alarm': False})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, res.status_code)
+
+    def test_evaluate_monitors_locked(self):
+        '''Monitors another process is evaluating are skipped'''
+        endtime = datetime(2019, 5, 5, 9, 0, 0, 0, tzinfo=pytz.UTC)
+        monitors = Monitor.objects.filter(pk=self.monitor.pk)
+        other = connections.create_connection('default')
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s, %s);',
+                               [MONITOR_LOCK, self.monitor.id])
+            with patch('measurement.models.Monitor.evaluate_alarm') as ea:
+                evaluation, = evaluate_monitors(monitors, endtime)
+            self.assertEqual(0, ea.call_count)
+            self.assertEqual(MonitorEvaluation.Status.LOCKED,
+                             evaluation.status)
+            self.assertFalse(MonitorState.objects.filter(
+                monitor=self.monitor).exists())
+
+            # a dry run doesn't need the lock
+            evaluation, = evaluate_monitors(monitors, endtime, dry_run=True)
+            self.assertEqual(MonitorEvaluation.Status.OK, evaluation.status)
+        finally:
+            other.close()
+
+        # evaluated once the lock is released, against its latest alerts
+        Trigger.objects.get(pk=self.trigger.pk).create_alert(
+            True, timestamp=endtime)
+        evaluation, = evaluate_monitors(monitors, endtime)
+        self.assertEqual(MonitorEvaluation.Status.OK, evaluation.status)
+        self.assertEqual(endtime, self.monitor.state.endtime)
+
+    def test_monitor_list_queries(self):
+        '''Listing monitors doesn't query alerts per trigger'''
+        url = reverse('measurement:monitor-list')
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        for _ in range(3):
+            monitor = self.getTestMonitor()
+            for val1 in range(2):
+                Trigger.objects.create(monitor=monitor, val1=val1,
+                                       num_channels=1, user=self.user)
+        with CaptureQueriesContext(connection) as after:
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(before), len(after))
+
     def test_send_alert(self):
         self.alert.send_alert()
 
@@ -439,12 +1060,19 @@ class PrivateAlarmAPITests(TestCase):
         for email in self.alert.trigger.emails:
             self.assertTrue(email in mail.outbox[0].recipients())
 
+    def test_send_alert_outbox(self):
+        '''With the outbox, alert emails are queued rather than sent'''
+        with self.settings(EMAIL_OUTBOX=True):
+            self.alert.send_alert()
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual([self.user.email], OutboxEmail.objects.get().to)
+
     def test_evaluate_alarms_filter_metric(self):
         '''Test evaluate_alarm command'''
         n_monitors = len(Monitor.objects.all())
         n_test2_monitors = len(Monitor.objects.filter(metric__name='test2'))
         with patch('measurement.models.Monitor.evaluate_alarm') as ea:
-            call_command('evaluate_alarms', '--metric=test2')
+            call_command('evaluate_alarms', '--metric=test2', verbosity=0)
             self.assertEqual(n_test2_monitors, ea.call_count)
             self.assertTrue(n_test2_monitors < n_monitors)
 
@@ -514,6 +1142,9 @@ class PrivateAlarmAPITests(TestCase):
         self.assertNotEqual(n_alerts1, n_alerts2)
 
     def test_check_daily_digest_no_alerts(self):
+        # not in alarm before the day either
+        self.alert.in_alarm = False
+        self.alert.save()
         self.monitor.check_daily_digest()
 
         # was an email sent? If no alerts then it shouldn't be
@@ -559,3 +1190,122 @@ class PrivateAlarmAPITests(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         for email in self.trigger.emails:
             self.assertTrue(email in mail.outbox[0].recipients())
+
+        digest = self.trigger.get_daily_trigger_digest(
+            reftime + relativedelta(days=1))
+        self.assertTrue(digest['in_alarm'])
+        self.assertEqual(['04:00', '09:00'], digest['in_alarm_times'])
+        self.assertEqual(['07:00'], digest['out_of_alarm_times'])
+        self.assertEqual(
+            [('UW:STA1:--:HNN', reftime + relativedelta(hours=6)),
+             ('UW:STA2:--:HNN', reftime + relativedelta(hours=6)),
+             ('UW:STA3:--:HNN', reftime + relativedelta(hours=1))],
+            [(channel['channel'], channel['timestamp'])
+             for channel in digest['breaching_channels']])
+        self.assertIn('UW:STA3:--:HNN', mail.outbox[0].body)
+
+    def test_check_daily_digest_in_alarm_all_day(self):
+        '''A trigger in alarm since before the day is in its digest'''
+        reftime = datetime(2020, 1, 15, 0, 0, 0, 0, tzinfo=pytz.UTC)
+        ch1 = {"sum": 5, "channel": "UW:STA1:--:HNN", "channel_id": 1}
+        ch2 = {"sum": 10, "channel": "UW:STA2:--:HNN", "channel_id": 2}
+        since = reftime - relativedelta(days=3)
+        # without the reset alert of the trigger's creation, so the alerts
+        # below make one chain
+        self.trigger.alerts.exclude(pk=self.alert.pk).delete()
+        Trigger.objects.filter(pk=self.trigger.pk).update(
+            latest_alert=self.alert)
+        self.trigger.refresh_from_db()
+        self.trigger.create_alert(True, breaching_channels=[ch1],
+                                  timestamp=since)
+        # a later alert of the chain, before the day
+        self.trigger.create_alert(True, breaching_channels=[ch1, ch2],
+                                  timestamp=since + relativedelta(days=1))
+
+        digest = self.trigger.get_daily_trigger_digest(
+            reftime + relativedelta(days=1))
+        self.assertTrue(digest['in_alarm'])
+        self.assertEqual([], digest['in_alarm_times'])
+        self.assertEqual(
+            [('UW:STA1:--:HNN', since + relativedelta(days=1)),
+             ('UW:STA2:--:HNN', since + relativedelta(days=1))],
+            [(channel['channel'], channel['timestamp'])
+             for channel in digest['breaching_channels']])
+
+        self.monitor.check_daily_digest(
+            digesttime=reftime + relativedelta(days=1))
+        self.assertEqual(1, len(mail.outbox))
+        self.assertIn('UW:STA2:--:HNN', mail.outbox[0].body)
+
+        # the alert before the day only keeps its changes once the chain
+        # goes on during the day
+        self.trigger.create_alert(True, breaching_channels=[ch1],
+                                  timestamp=reftime + relativedelta(hours=6))
+        self.assertIsNone(self.trigger.alerts.get(
+            timestamp=since + relativedelta(days=1)).breaching_channels)
+        digest = self.trigger.get_daily_trigger_digest(
+            reftime + relativedelta(days=1))
+        self.assertEqual(['06:00'], digest['in_alarm_times'])
+        self.assertEqual(
+            ['UW:STA1:--:HNN', 'UW:STA2:--:HNN'],
+            [channel['channel'] for channel in digest['breaching_channels']])
+
+        # not after it went out of alarm
+        self.trigger.create_alert(False, timestamp=reftime + relativedelta(
+            hours=12))
+        digest = self.trigger.get_daily_trigger_digest(
+            reftime + relativedelta(days=2))
+        self.assertFalse(digest['in_alarm'])
+
+    def test_daily_digests_batched_by_recipients(self):
+        reftime = datetime(2020, 1, 2, 3, 0, 0, 0, tzinfo=pytz.UTC)
+        ch1 = {"sum": 5, "channel": "UW:STA1:--:HNN", "channel_id": 1}
+        monitors = [self.monitor]
+        for email in [self.user.email, 'other@pnsn.org']:
+            monitor = self.getTestMonitor()
+            trigger = Trigger.objects.create(
+                monitor=monitor, val1=1,
+                value_operator=Trigger.ValueOperator.GREATER_THAN,
+                num_channels=1, user=self.user, emails=[email])
+            trigger.create_alert(True, breaching_channels=[ch1],
+                                 timestamp=reftime)
+            monitors.append(monitor)
+        self.trigger.create_alert(True, breaching_channels=[ch1],
+                                  timestamp=reftime)
+
+        with CaptureQueriesContext(connection) as queries:
+            Monitor.send_daily_digests(
+                Monitor.objects.filter(
+                    id__in=[monitor.id for monitor in monitors]
+                ).select_related('metric', 'channel_group').prefetch_related(
+                    'triggers'),
+                reftime + relativedelta(days=1))
+
+        # the two monitors sent to the user share an email
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual([['other@pnsn.org'], [self.user.email]],
+                         sorted(email.recipients() for email in mail.outbox))
+        shared = next(email for email in mail.outbox
+                      if email.recipients() == [self.user.email])
+        self.assertIn('2 monitors', shared.subject)
+        self.assertIn('Self Monitor', shared.body)
+        self.assertIn('Test Monitor', shared.body)
+        digest_queries = [query for query in queries.captured_queries
+                          if 'jsonb_array_elements' in query['sql']]
+        self.assertEqual(1, len(digest_queries))
+
+
+class ParallelEvaluationTests(TransactionTestCase):
+    ''' worker threads use their own connections, so data must be committed '''
+    fixtures = ['alarms.json']
+
+    def test_evaluate_monitors_with_workers(self):
+        endtime = datetime(2018, 2, 1, 4, 35, 0, 0, tzinfo=pytz.UTC)
+        evaluations = evaluate_monitors(Monitor.objects.all(), endtime,
+                                        workers=3)
+        self.assertEqual(
+            sorted(Monitor.objects.values_list('id', flat=True)),
+            sorted(evaluation.monitor_id for evaluation in evaluations))
+        self.assertEqual({MonitorEvaluation.Status.OK},
+                         {evaluation.status for evaluation in evaluations})
+        self.assertEqual(2, Trigger.objects.get(pk=1).alerts.count())
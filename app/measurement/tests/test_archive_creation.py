@@ -1,6 +1,9 @@
 from django.contrib.auth import get_user_model
+from django.core.management.base import CommandError
+from django.test import TransactionTestCase
 from django.utils import timezone
 from io import StringIO
+from unittest.mock import patch
 from math import isnan, isfinite
 import numpy as np
 from django.core.management import call_command
@@ -304,6 +307,41 @@ class TestArchiveCreation(TestCase):
         if this_month:
             self.check_queryset_was_not_archived(this_month, 'month')
 
+    def test_backfill_retries_failed_periods(self):
+        """a period that fails is retried and reported, not skipped"""
+        test_time = datetime(2004, 3, 2, tzinfo=pytz.UTC)
+        m1 = self.make_measurements(test_time, self.metric)
+
+        real_call_command = call_command
+        calls = []
+
+        def flaky_call_command(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError('connection reset')
+            return real_call_command(*args, **kwargs)
+
+        out, err = StringIO(), StringIO()
+        with patch('measurement.management.commands.backfill_archives.'
+                   'call_command', side_effect=flaky_call_command):
+            call_command('backfill_archives', 'day', '--overwrite',
+                         start_time=test_time + relativedelta(days=1),
+                         end_time=test_time + relativedelta(days=1),
+                         stdout=out, stderr=err)
+
+        self.assertEqual(2, len(calls))
+        self.assertIn('connection reset', err.getvalue())
+        self.assertIn('Retrying 1 failed task(s)', out.getvalue())
+        self.check_queryset_was_archived(m1, 'day')
+
+        # without retries the failure is raised at the end
+        with patch('measurement.management.commands.backfill_archives.'
+                   'call_command', side_effect=RuntimeError('down')):
+            with self.assertRaises(CommandError):
+                call_command('backfill_archives', 'day', '--retries=0',
+                             start_time=test_time, end_time=test_time,
+                             stdout=out, stderr=err)
+
     def check_queryset_was_archived(self, measurements, archive_type):
         """ checks that the entire given queryset of measurements was
         successfully archived """
@@ -353,3 +391,64 @@ class TestArchiveCreation(TestCase):
         max_end = max([measurement.endtime for measurement in measurements])
         self.assertFalse(self.ARCHIVE_TYPE[archive_type].objects.filter(
             endtime=max_end, starttime=min_start, metric=test_metric).exists())
+
+
+class TestParallelBackfill(TransactionTestCase):
+    """ Tests backfill_archives with a pool of worker processes. Workers use
+    their own connections so the data has to be committed """
+
+    def setUp(self):
+        self.user = sample_user()
+        self.net = Network.objects.create(
+            code="UW",
+            name="University of Washington",
+            user=self.user
+        )
+        self.chan = Channel.objects.create(
+            code='EHZ',
+            name="EHZ",
+            station_code='RCM',
+            station_name='Camp Muir',
+            loc="--",
+            network=self.net,
+            lat=45,
+            lon=-122,
+            elev=0,
+            user=self.user
+        )
+        self.metrics = [
+            Metric.objects.create(name=f'Metric {i}', code=f'metric{i}',
+                                  unit='meter', user=self.user)
+            for i in range(2)
+        ]
+
+    def test_backfill_with_workers(self):
+        start = datetime(2010, 1, 1, tzinfo=pytz.UTC)
+        for day in range(3):
+            for metric in self.metrics:
+                for hour in range(4):
+                    Measurement.objects.create(
+                        metric=metric,
+                        channel=self.chan,
+                        value=hour,
+                        starttime=start + relativedelta(days=day,
+                                                        hours=hour),
+                        endtime=start + relativedelta(days=day,
+                                                      hours=hour + 1),
+                        user=self.user
+                    )
+
+        out = StringIO()
+        call_command('backfill_archives', 'day', '--overwrite',
+                     '--workers=2', '--shard_metrics',
+                     start_time=start + relativedelta(days=1),
+                     end_time=start + relativedelta(days=3),
+                     stdout=out)
+
+        # one archive per metric per day
+        self.assertEqual(6, ArchiveDay.objects.count())
+        for metric in self.metrics:
+            for archive in ArchiveDay.objects.filter(metric=metric):
+                self.assertEqual(4, archive.num_samps)
+                self.assertEqual(1.5, archive.mean)
+        self.assertIn('Finished 6/6 task(s)', out.getvalue())
@@ -0,0 +1,157 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from io import StringIO
+
+from measurement.export import (ExportError, export_days, file_path,
+                                manifest_path, read_file, read_manifest)
+from measurement.models import Metric, Measurement
+from measurement.storage import (LocalStorage, Storage, StorageError,
+                                 get_storage)
+from nslc.models import Network, Channel
+from squac.test_mixins import sample_user
+
+from datetime import date, datetime, timedelta
+import numpy as np
+import pytz
+import tempfile
+
+'''Tests for measurement exports:
+to run only this file
+    ./mg.sh "test measurement.tests.test_export && flake8"
+'''
+
+
+class ExportMixin:
+    DAY = date(2021, 3, 1)
+
+    def create_measurements(self):
+        self.user = sample_user()
+        self.metrics = [
+            Metric.objects.create(
+                name=f'Metric {i}', code=f'metric{i}', unit='meter',
+                user=self.user)
+            for i in range(2)]
+        net = Network.objects.create(
+            code="UW", name="University of Washington", user=self.user)
+        self.chans = [
+            Channel.objects.create(
+                code=code, name=code, station_code='RCM',
+                station_name='Camp Muir', loc="--", network=net,
+                lat=45, lon=-122, elev=0, user=self.user)
+            for code in ('EHZ', 'EHN')]
+
+        start = datetime(2021, 3, 1, tzinfo=pytz.UTC)
+        # two days of hourly values for the first metric, one for the other
+        for hour in range(48):
+            for chan in self.chans:
+                Measurement.objects.create(
+                    metric=self.metrics[0], channel=chan, value=hour,
+                    starttime=start + timedelta(hours=hour),
+                    endtime=start + timedelta(hours=hour + 1),
+                    user=self.user)
+        Measurement.objects.create(
+            metric=self.metrics[1], channel=self.chans[0], value=0.5,
+            starttime=start, endtime=start + timedelta(hours=1),
+            user=self.user)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storage = LocalStorage(self.tmpdir.name)
+        self.create_measurements()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class ExportTests(ExportMixin, TestCase):
+
+    def test_export_days(self):
+        metric = self.metrics[0].id
+        exported, errors = export_days(
+            self.storage, [self.DAY, self.DAY + timedelta(days=1)])
+        self.assertEqual([], errors)
+        self.assertEqual(3, len(exported))
+
+        manifest = read_manifest(self.storage, self.DAY)
+        self.assertEqual([metric, self.metrics[1].id],
+                         [entry['metric'] for entry in manifest['files']])
+        self.assertEqual(48, manifest['files'][0]['rows'])
+        self.assertTrue(self.storage.exists(file_path(self.DAY, metric)))
+
+        data = read_file(self.storage, manifest['files'][0])
+        self.assertEqual(48, len(data['value']))
+        self.assertTrue((data['metric_id'] == metric).all())
+        # sorted by channel then starttime
+        self.assertEqual(list(range(24)), list(data['value'][:24]))
+        self.assertEqual(np.datetime64('2021-03-01T00:00:00'),
+                         data['starttime'][0])
+        expected = Measurement.objects.filter(
+            metric=metric, starttime__lt=datetime(2021, 3, 2, tzinfo=pytz.UTC))
+        self.assertEqual(sorted(expected.values_list('id', flat=True)),
+                         sorted(data['id']))
+
+    def test_single_metric_keeps_manifest(self):
+        export_days(self.storage, [self.DAY])
+        export_days(self.storage, [self.DAY], metrics=[self.metrics[1].id])
+        manifest = read_manifest(self.storage, self.DAY)
+        self.assertEqual(2, len(manifest['files']))
+
+    def test_no_overwrite(self):
+        export_days(self.storage, [self.DAY])
+        skipped = []
+        exported, errors = export_days(
+            self.storage, [self.DAY], overwrite=False,
+            report=lambda task, entry, error: skipped.append(task))
+        self.assertEqual([], exported)
+        self.assertEqual(2, len(skipped))
+
+    def test_checksum(self):
+        export_days(self.storage, [self.DAY])
+        entry = read_manifest(self.storage, self.DAY)['files'][0]
+        entry['sha256'] = '0' * 64
+        with self.assertRaises(ExportError):
+            read_file(self.storage, entry)
+
+    def test_local_storage(self):
+        self.storage.write('a/b/c.txt', b'data')
+        self.assertEqual(b'data', self.storage.read('a/b/c.txt'))
+        self.assertEqual(['a/b/c.txt'], self.storage.list('a/'))
+        with self.assertRaises(StorageError):
+            self.storage.read('missing')
+        self.assertIsInstance(get_storage(self.tmpdir.name), LocalStorage)
+        with self.assertRaises(StorageError):
+            get_storage('ftp://somewhere')
+
+        # backends missing part of the interface can't be created
+        class ListOnly(Storage):
+            def list(self, prefix=''):
+                return []
+
+        with self.assertRaises(TypeError):
+            ListOnly()
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command('export_measurements', '--start_date=2021-03-01',
+                     '--end_date=2021-03-02', f'--storage={self.tmpdir.name}',
+                     '--workers=1', stdout=out)
+        self.assertIn('Exported 3 file(s), 97 rows', out.getvalue())
+        self.assertTrue(self.storage.exists(manifest_path(self.DAY)))
+
+        with self.assertRaises(CommandError):
+            call_command('export_measurements', '--storage=ftp://nowhere',
+                         stdout=out)
+
+
+class ParallelExportTests(ExportMixin, TransactionTestCase):
+    ''' worker threads use their own connections, so data must be committed '''
+
+    def test_export_with_workers(self):
+        exported, errors = export_days(
+            self.storage, [self.DAY, self.DAY + timedelta(days=1)], workers=3)
+        self.assertEqual([], errors)
+        self.assertEqual(97, sum(entry['rows'] for entry in exported))
+        self.assertEqual(
+            1, len(read_manifest(self.storage,
+                                 self.DAY + timedelta(days=1))['files']))
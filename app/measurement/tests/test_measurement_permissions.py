@@ -318,3 +318,32 @@ class MeasurementPermissionTests(TestCase):
                       kwargs={'pk': self.monitor2.id})
         res = self.reporter_client.get(url)
         self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_update_monitors_needs_change_perm(self):
+        creator = sample_user('creator@pnsn.org')
+        creator.groups.add(create_group(
+            'creator', ['view_monitor', 'add_monitor', 'add_trigger']))
+        client = APIClient()
+        client.force_authenticate(user=creator)
+        self.monitor.user = creator
+        self.monitor.save()
+        url = reverse('measurement:monitor-bulk')
+        payload = [{
+            'channel_group': self.grp.id, 'metric': self.metric.id,
+            'interval_type': 'hour', 'interval_count': 1, 'stat': 'sum',
+            'name': 'bulk', 'triggers': [
+                {'val1': 1, 'num_channels': 1,
+                 'value_operator': '>'}]
+        }]
+        res = client.post(url, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        payload[0]['id'] = self.monitor.id
+        res = client.post(url, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+        self.monitor.refresh_from_db()
+        self.assertEqual('test', self.monitor.name)
+
+        res = self.reporter_client.post(url, payload, format='json')
+        # the reporter can change monitors, but not the creator's
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -1,12 +1,13 @@
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
 
 # from django.db.models import Avg, Count, Max, Min, Sum
 
-from measurement.models import (Monitor, Trigger, Alert, Measurement,
-                                Metric)
+from measurement.models import (ArchiveDay, Monitor, Trigger, Alert,
+                                Measurement, Metric)
 from nslc.models import Channel, Group, Network
 from organization.models import Organization
 
@@ -15,6 +16,8 @@ from rest_framework import status
 
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from io import StringIO
+from unittest.mock import patch
 import pytz
 from squac.test_mixins import sample_user
 
@@ -196,6 +199,88 @@ class PrivateMonitorApiTests(TestCase):
             else:
                 self.assertEqual(payload[key], getattr(trigger, key))
 
+    def bulk_payload(self, n_monitors):
+        trigger = {'val1': 1, 'val2': 5, 'num_channels': 1,
+                   'value_operator': Trigger.ValueOperator.WITHIN,
+                   'emails': [self.user.email]}
+        return [{
+            'channel_group': self.grp.id,
+            'metric': self.metric.id,
+            'interval_type': Monitor.IntervalType.HOUR,
+            'interval_count': 1,
+            'stat': Monitor.Stat.AVERAGE,
+            'name': f'Station {i}',
+            'triggers': [dict(trigger, val2=5 + j) for j in range(3)],
+        } for i in range(n_monitors)]
+
+    def test_bulk_create_monitors(self):
+        url = reverse('measurement:monitor-bulk')
+        n_alerts = Alert.objects.count()
+        # the number of queries doesn't grow with the number of monitors
+        with self.assertNumQueries(10):
+            res = self.client.post(url, self.bulk_payload(20), format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(20, len(res.data))
+        self.assertEqual([3] * 20, [len(monitor['triggers'])
+                                    for monitor in res.data])
+        self.assertEqual(n_alerts + 60, Alert.objects.count())
+        trigger = Trigger.objects.get(id=res.data[0]['triggers'][2]['id'])
+        self.assertEqual(7, trigger.val2)
+        self.assertEqual(self.user, trigger.user)
+        self.assertFalse(trigger.latest_alert.in_alarm)
+        self.assertEqual(trigger.latest_alert,
+                         trigger.alerts.order_by('-timestamp').first())
+
+    def test_bulk_update_monitors(self):
+        url = reverse('measurement:monitor-bulk')
+        other = Trigger.objects.create(
+            monitor=self.monitor, val1=1, num_channels=1,
+            value_operator=Trigger.ValueOperator.GREATER_THAN,
+            user=self.user)
+        payload = self.bulk_payload(2)
+        payload[0]['id'] = self.monitor.id
+        payload[0]['triggers'] = [{
+            'id': self.trigger.id, 'val1': 0, 'val2': 10, 'num_channels': 2,
+            'value_operator': Trigger.ValueOperator.OUTSIDE_OF}]
+        res = self.client.post(url, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        self.monitor.refresh_from_db()
+        self.assertEqual('Station 0', self.monitor.name)
+        self.assertEqual(Monitor.Stat.AVERAGE, self.monitor.stat)
+        self.trigger.refresh_from_db()
+        self.assertEqual((0, 10), (self.trigger.val1, self.trigger.val2))
+        self.assertGreater(self.trigger.updated_at, self.monitor.created_at)
+        # every trigger of an updated monitor is reset, as Monitor.save does
+        for trigger in (self.trigger, other):
+            trigger.refresh_from_db()
+            self.assertFalse(trigger.latest_alert.in_alarm)
+        self.assertEqual(2, self.monitor.triggers.count())
+
+        # nothing is created
+        res = self.client.post(url, payload[:1], format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_bulk_monitors_validation(self):
+        url = reverse('measurement:monitor-bulk')
+        n_monitors = Monitor.objects.count()
+        payload = self.bulk_payload(3)
+        payload[0]['metric'] = 999999
+        payload[1]['triggers'][0]['val2'] = 0
+        payload[2]['triggers'][0]['id'] = Trigger.objects.get(pk=1).id
+        res = self.client.post(url, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('val2 must be greater than val1', str(res.data))
+
+        payload[1]['triggers'][0]['val2'] = 5
+        res = self.client.post(url, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = res.data['non_field_errors']
+        self.assertEqual(2, len(errors))
+        self.assertIn('metric 999999 does not exist', errors[0])
+        self.assertIn('trigger 1 is not one of its triggers', errors[1])
+        self.assertEqual(n_monitors, Monitor.objects.count())
+
     def test_trigger_most_recent_alarm(self):
         url = reverse('measurement:trigger-list')
         payload = {
@@ -283,6 +368,47 @@ class PrivateMonitorApiTests(TestCase):
         for q_item in q_list:
             self.assertEqual(q_item['sum'], chan_vals[q_item['channel']])
 
+    def test_last_n_single_query(self):
+        monitor = Monitor.objects.create(
+            channel_group=Group.objects.get(pk=1),
+            metric=Metric.objects.get(pk=1),
+            interval_type=Monitor.IntervalType.LASTN,
+            interval_count=1,
+            stat=Monitor.Stat.SUM,
+            user=self.user
+        )
+        monitor = Monitor.objects.select_related('metric').get(pk=monitor.pk)
+        endtime = datetime(2018, 2, 1, 4, 30, 0, 0, tzinfo=pytz.UTC)
+        # one query for the group's channels, one for the aggregates
+        with self.assertNumQueries(2):
+            q_list = monitor.agg_measurements(endtime=endtime)
+        self.assertEqual({1: 3, 2: 6, 3: 8},
+                         {q['channel']: q['sum'] for q in q_list})
+
+        # the window follows the metric's sample rate
+        self.assertEqual(endtime - relativedelta(hours=2),
+                         monitor.calc_starttime(endtime))
+
+    def test_last_n_daily(self):
+        '''The last n values of a daily metric, beyond the gaps' cap'''
+        self.metric.sample_rate = 24 * 60 * 60
+        self.metric.save()
+        self.monitor.interval_type = Monitor.IntervalType.LASTN
+        self.monitor.interval_count = 10
+        endtime = datetime(2020, 1, 20, tzinfo=pytz.UTC)
+        for day in range(12):
+            Measurement.objects.create(
+                metric=self.metric, channel=self.chan1, value=day,
+                starttime=endtime - relativedelta(days=day + 1),
+                endtime=endtime - relativedelta(days=day), user=self.user)
+        # ten days of samples and a week for gaps
+        self.assertEqual(endtime - relativedelta(days=17),
+                         self.monitor.calc_starttime(endtime))
+        values = {q['channel']: q for q in
+                  self.monitor.agg_measurements(endtime=endtime)}
+        self.assertEqual(10, values[self.chan1.id]['count'])
+        self.assertEqual(sum(range(10)), values[self.chan1.id]['sum'])
+
     def test_agg_measurements(self):
         monitor = Monitor.objects.get(pk=1)
         endtime = datetime(2018, 2, 1, 4, 30, 0, 0, tzinfo=pytz.UTC)
@@ -397,6 +523,103 @@ class PrivateMonitorApiTests(TestCase):
         # check number of channels returned
         self.assertEqual(len(q_list), monitor.channel_group.channels.count())
 
+    def test_agg_measurements_from_archives(self):
+        '''Settled days of long windows come from day archives'''
+        monitor = self.getTestMonitor(interval_type=Monitor.IntervalType.DAY,
+                                      interval_count=3)
+        basetime = datetime(2019, 5, 5, 8, 8, 7, 0, tzinfo=pytz.UTC)
+        for hours in range(0, 3 * 24, 5):
+            for channel, sign in ((self.chan1, 1), (self.chan2, -1)):
+                self.getTestMeasurement(self.metric, channel,
+                                        sign * (hours % 7 - 3),
+                                        relativedelta(hours=hours))
+        endtime = basetime + relativedelta(days=3)
+        with patch.object(Monitor, 'aggregate_archived',
+                          return_value=None) as archived:
+            expected = monitor.agg_measurements(endtime)
+        self.assertEqual(1, archived.call_count)
+
+        for day in (6, 7):
+            call_command('archive_measurements', 'day',
+                         f'--period_end=05-{day + 1:02}-2019',
+                         stdout=StringIO())
+        self.assertEqual(
+            [datetime(2019, 5, 6, tzinfo=pytz.UTC),
+             datetime(2019, 5, 7, tzinfo=pytz.UTC)],
+            Monitor.archived_days(self.metric.id,
+                                  monitor.calc_starttime(endtime), endtime))
+        # the archived days aren't read from measurements anymore
+        Measurement.objects.filter(
+            starttime__gte=datetime(2019, 5, 6, tzinfo=pytz.UTC),
+            starttime__lt=datetime(2019, 5, 8, tzinfo=pytz.UTC)).delete()
+        for stat in Monitor.ARCHIVE_STATS:
+            monitor.stat = stat
+            for value, archive_value in zip(
+                    expected, monitor.agg_measurements(endtime)):
+                self.assertEqual(value['channel'], archive_value['channel'])
+                self.assertAlmostEqual(value[stat], archive_value[stat])
+                self.assertEqual(value['first_starttime'],
+                                 archive_value['first_starttime'])
+
+        # percentiles can't be combined from archives
+        monitor.stat = Monitor.Stat.MEDIAN
+        self.assertLess(monitor.agg_measurements(endtime)[0]['count'],
+                        expected[0]['count'])
+
+    def test_agg_measurements_unsettled_archives(self):
+        '''Archives written too soon after their day ended aren't used'''
+        now = datetime.now(tz=pytz.UTC)
+        yesterday = now - relativedelta(
+            days=1, hour=0, minute=0, second=0, microsecond=0)
+        ArchiveDay.objects.create(
+            channel=self.chan1, metric=self.metric, min=1, max=1, mean=1,
+            median=1, stdev=0, num_samps=1, p05=1, p10=1, p90=1, p95=1,
+            starttime=yesterday, endtime=yesterday)
+        with self.settings(MONITOR_ARCHIVE_SETTLE_HOURS=48):
+            self.assertEqual([], Monitor.archived_days(
+                self.metric.id, now - relativedelta(days=3), now))
+        with self.settings(MONITOR_ARCHIVE_SETTLE_HOURS=0):
+            self.assertEqual([yesterday], Monitor.archived_days(
+                self.metric.id, now - relativedelta(days=3), now))
+
+    def test_agg_measurements_partial_archives(self):
+        '''Channels missing from a day's archives are read from raw data'''
+        monitor = self.getTestMonitor(interval_type=Monitor.IntervalType.DAY,
+                                      interval_count=3)
+        basetime = datetime(2019, 5, 5, 8, 8, 7, 0, tzinfo=pytz.UTC)
+        for hours in range(0, 3 * 24, 5):
+            for channel in (self.chan1, self.chan2):
+                self.getTestMeasurement(self.metric, channel, hours % 7,
+                                        relativedelta(hours=hours))
+        endtime = basetime + relativedelta(days=3)
+        expected = monitor.agg_measurements(endtime)
+        for day in (6, 7):
+            call_command('archive_measurements', 'day',
+                         f'--period_end=05-{day + 1:02}-2019',
+                         stdout=StringIO())
+        starttime = monitor.calc_starttime(endtime)
+
+        # a day is only settled once all of its archives are
+        day = datetime(2019, 5, 6, tzinfo=pytz.UTC)
+        early = ArchiveDay.objects.filter(
+            starttime__gte=day, starttime__lt=day + relativedelta(days=1),
+            channel=self.chan2)
+        early.update(updated_at=day + relativedelta(days=1, hours=1))
+        self.assertEqual([datetime(2019, 5, 7, tzinfo=pytz.UTC)],
+                         Monitor.archived_days(self.metric.id, starttime,
+                                               endtime))
+
+        # the second channel wasn't archived
+        ArchiveDay.objects.filter(channel=self.chan2).delete()
+        self.assertEqual(2, len(Monitor.archived_days(
+            self.metric.id, starttime, endtime)))
+        for stat in ('count', 'sum', 'max'):
+            monitor.stat = stat
+            self.assertEqual(
+                [(value['channel'], value[stat]) for value in expected],
+                [(value['channel'], value[stat])
+                 for value in monitor.agg_measurements(endtime)])
+
     def test_val2_is_none_error(self):
         with self.assertRaisesRegex(ValidationError,
                                     'val2 must be defined*'):
@@ -453,6 +676,19 @@ class PrivateMonitorApiTests(TestCase):
         self.check_is_breaching(1, 3, {1: False, 2: False, 3: True})
         self.check_is_breaching(1, 4, {1: True, 2: True, 3: False})
 
+    def test_breaching_mask_matches_is_breaching(self):
+        '''The vectorized masks agree with is_breaching for every operator'''
+        values = [-1, 0, 1.5, 2, 3, 4.99, 5, 7, None]
+        channel_values = [{'channel': i, 'sum': value}
+                          for i, value in enumerate(values)]
+        array = self.monitor.stat_values(channel_values)
+        for value_operator in Trigger.ValueOperator.values:
+            trigger = Trigger(monitor=self.monitor, val1=2, val2=5,
+                              value_operator=value_operator)
+            self.assertEqual(
+                [trigger.is_breaching(cv) for cv in channel_values],
+                trigger.breaching_mask(array).tolist(), value_operator)
+
     def check_get_breaching_channels(self, monitor_id, trigger_id,
                                      expected):
         monitor = Monitor.objects.get(pk=monitor_id)
@@ -470,6 +706,27 @@ class PrivateMonitorApiTests(TestCase):
         self.check_get_breaching_channels(1, 3, [3])
         self.check_get_breaching_channels(1, 4, [1, 2])
 
+    def test_get_breaching_channels_queries(self):
+        '''Channel names are looked up once, not per breaching channel'''
+        monitor = Monitor.objects.get(pk=1)
+        endtime = datetime(2018, 2, 1, 4, 30, 0, 0, tzinfo=pytz.UTC)
+        q_list = monitor.agg_measurements(endtime=endtime)
+        trigger = Trigger.objects.select_related('monitor').get(pk=2)
+
+        nslcs = {}
+        with self.assertNumQueries(1):
+            res = trigger.get_breaching_channels(q_list, nslcs)
+        self.assertEqual(3, len(res))
+        for channel in res:
+            self.assertEqual(
+                str(Channel.objects.get(pk=channel['channel_id'])),
+                channel['channel'])
+
+        # the cache is filled, so nothing left to look up
+        with self.assertNumQueries(0):
+            self.assertEqual(res, trigger.get_breaching_channels(
+                q_list, nslcs))
+
     def check_in_alarm_state(self, monitor_id, trigger_id, expected):
         monitor = Monitor.objects.get(pk=monitor_id)
         trigger = Trigger.objects.get(pk=trigger_id)
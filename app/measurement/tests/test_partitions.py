@@ -0,0 +1,341 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+from django.test import TestCase
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from measurement.models import (Alert, ArchiveDay, Measurement, Metric,
+                                Trigger)
+from measurement.partitions import (PartitionManager, Partition,
+                                    clear_retired_alerts,
+                                    measurement_partitions,
+                                    verify_alert_partition,
+                                    verify_measurement_partition)
+from nslc.models import Network, Channel
+from squac.test_mixins import sample_user
+
+from datetime import datetime, timedelta
+import pytz
+
+'''Tests for the partition manager:
+to run only this file
+    ./mg.sh "test measurement.tests.test_partitions && flake8"
+'''
+
+
+class PartitionManagerTests(TestCase):
+    ''' measurement_measurement is not partitioned in the test database, so
+    use a small partitioned table of our own '''
+
+    TABLE = 'test_partitioned'
+    NOW = datetime(2021, 3, 10, 14, 0, tzinfo=pytz.UTC)
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                CREATE TABLE {self.TABLE} (
+                    id SERIAL NOT NULL,
+                    starttime timestamp with time zone NOT NULL
+                ) PARTITION BY RANGE(starttime);''')
+        self.manager = PartitionManager(self.TABLE, 'day')
+
+    def create(self, *days):
+        for day in days:
+            self.manager.create_partition(
+                datetime(2021, 3, day, tzinfo=pytz.UTC))
+
+    def names(self):
+        return [p.name for p in self.manager.list_partitions()]
+
+    def test_is_partitioned(self):
+        self.assertTrue(self.manager.is_partitioned())
+        self.assertFalse(measurement_partitions().is_partitioned())
+
+    def test_list_partitions(self):
+        self.create(9, 8)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.TABLE} (starttime) "
+                           f"VALUES ('2021-03-08 01:00+00')")
+
+        partitions = self.manager.list_partitions()
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_08', f'{self.TABLE}_2021_03_09'],
+            [p.name for p in partitions])
+        self.assertEqual(datetime(2021, 3, 8, tzinfo=pytz.UTC),
+                         partitions[0].start)
+        self.assertEqual(datetime(2021, 3, 9, tzinfo=pytz.UTC),
+                         partitions[0].end)
+        self.assertTrue(partitions[0].size > 0)
+
+    def test_ensure_horizon_fills_gaps(self):
+        self.create(6, 9)
+
+        created, errors = self.manager.ensure_horizon(2, now=self.NOW)
+        self.assertEqual([], errors)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_{day:02d}' for day in (7, 8, 10, 11, 12)],
+            created)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_{day:02d}' for day in range(6, 13)],
+            self.names())
+
+        # nothing left to do
+        created, errors = self.manager.ensure_horizon(2, now=self.NOW)
+        self.assertEqual([], created)
+
+    def test_ensure_horizon_without_partitions(self):
+        created, errors = self.manager.ensure_horizon(1, now=self.NOW)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_10', f'{self.TABLE}_2021_03_11'],
+            created)
+
+    def test_ensure_horizon_without_filling_gaps(self):
+        self.create(1)
+        self.manager.fill_gaps = False
+        created, errors = self.manager.ensure_horizon(1, now=self.NOW)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_10', f'{self.TABLE}_2021_03_11'],
+            created)
+
+    def test_month_partitions(self):
+        manager = PartitionManager(self.TABLE, 'month')
+        created, errors = manager.ensure_horizon(1, now=self.NOW)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03', f'{self.TABLE}_2021_04'], created)
+        partition = manager.list_partitions()[1]
+        self.assertEqual(datetime(2021, 5, 1, tzinfo=pytz.UTC), partition.end)
+
+    def test_retire(self):
+        self.create(1, 2, 3, 9)
+
+        def verifier(partition):
+            if partition.start.day == 2:
+                return ['not exported']
+            return []
+        self.manager.verifier = verifier
+
+        retired, skipped = self.manager.retire(timedelta(days=6),
+                                               now=self.NOW)
+        self.assertEqual([f'{self.TABLE}_2021_03_01',
+                          f'{self.TABLE}_2021_03_03'],
+                         [p.name for p in retired])
+        self.assertEqual([(f'{self.TABLE}_2021_03_02', ['not exported'])],
+                         [(p.name, reasons) for p, reasons in skipped])
+        self.assertEqual([f'{self.TABLE}_2021_03_02',
+                          f'{self.TABLE}_2021_03_09'], self.names())
+
+        # dropped, not only detached
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)",
+                           [f'{self.TABLE}_2021_03_01'])
+            self.assertIsNone(cursor.fetchone()[0])
+
+    def test_ensure_horizon_after_retire(self):
+        '''Gaps left by retiring around a skipped partition stay gaps'''
+        self.create(1, 2, 3, 9)
+        self.manager.verifier = lambda partition: \
+            ['not exported'] if partition.start.day == 2 else []
+        self.manager.retention = timedelta(days=6)
+        self.manager.retire(self.manager.retention, now=self.NOW)
+
+        created, errors = self.manager.ensure_horizon(1, now=self.NOW)
+        self.assertEqual([], errors)
+        cutoff = datetime(2021, 3, 4, tzinfo=pytz.UTC)
+        self.assertEqual(
+            [f'{self.TABLE}_2021_03_{day:02d}'
+             for day in (4, 5, 6, 7, 8, 10, 11)], created)
+        retired, skipped = self.manager.retire(self.manager.retention,
+                                               now=self.NOW)
+        self.assertEqual([], retired)
+        self.assertEqual([f'{self.TABLE}_2021_03_02'],
+                         [p.name for p in self.manager.list_partitions()
+                          if p.start < cutoff])
+
+    def test_measurement_partitions_retention(self):
+        with self.settings(MEASUREMENT_RETENTION_DAYS=0):
+            self.assertIsNone(measurement_partitions().retention)
+        with self.settings(MEASUREMENT_RETENTION_DAYS=30):
+            self.assertEqual(timedelta(days=30),
+                             measurement_partitions().retention)
+
+    def test_on_retire(self):
+        self.create(1, 9)
+        self.manager.on_retire = Mock()
+        self.manager.retire(timedelta(days=6), now=self.NOW)
+        retired, = self.manager.on_retire.call_args.args
+        self.assertEqual([f'{self.TABLE}_2021_03_01'],
+                         [p.name for p in retired])
+
+    def test_detach_only(self):
+        self.create(1)
+        self.manager.retire(timedelta(days=7), now=self.NOW, drop=False)
+        self.assertEqual([], self.names())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)",
+                           [f'{self.TABLE}_2021_03_01'])
+            self.assertIsNotNone(cursor.fetchone()[0])
+
+    def index_manager(self):
+        return PartitionManager(
+            self.TABLE, 'day',
+            index_profiles={
+                'hot': {'starttime_idx': 'USING btree (starttime)'},
+                'cold': {'starttime_brin': 'USING brin (starttime)'},
+            },
+            index_policy=[(0, 'hot'), (7, 'cold')])
+
+    def test_profile_for(self):
+        manager = self.index_manager()
+        self.assertIsNone(self.manager.profile_for(None))
+
+        def partition(day):
+            start = datetime(2021, 3, day, tzinfo=pytz.UTC)
+            return Partition('p', start, start + timedelta(days=1), 0, 0)
+        self.assertEqual('hot', manager.profile_for(partition(11), self.NOW))
+        self.assertEqual('hot', manager.profile_for(partition(3), self.NOW))
+        self.assertEqual('cold', manager.profile_for(partition(2), self.NOW))
+
+    def test_apply_index_policy(self):
+        self.create(1, 9)
+        manager = self.index_manager()
+        old, new = (f'{self.TABLE}_2021_03_01', f'{self.TABLE}_2021_03_09')
+
+        changes = manager.apply_index_policy(now=self.NOW, dry_run=True)
+        self.assertEqual(2, len(changes))
+        self.assertNotIn(f'{old}_starttime_brin', manager.index_names(old))
+
+        changes = manager.apply_index_policy(now=self.NOW)
+        self.assertEqual(
+            [(old, 'cold', [f'{old}_starttime_brin'], []),
+             (new, 'hot', [f'{new}_starttime_idx'], [])],
+            [(p.name, profile, created, dropped)
+             for p, profile, created, dropped in changes])
+        self.assertEqual([], manager.apply_index_policy(now=self.NOW))
+
+        # a week later the newer partition goes cold too
+        changes = manager.apply_index_policy(
+            now=self.NOW + timedelta(days=7))
+        self.assertEqual(
+            [(new, 'cold', [f'{new}_starttime_brin'],
+              [f'{new}_starttime_idx'])],
+            [(p.name, profile, created, dropped)
+             for p, profile, created, dropped in changes])
+
+    def test_create_partition_applies_profile(self):
+        manager = self.index_manager()
+        name = manager.create_partition(datetime.now(tz=pytz.UTC))
+        self.assertIn(f'{name}_starttime_idx', manager.index_names(name))
+
+    def test_analyze(self):
+        self.create(8)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.TABLE} (starttime) "
+                           f"SELECT '2021-03-08 01:00+00'::timestamptz "
+                           f"FROM generate_series(1, 50)")
+        self.manager.analyze(self.manager.list_partitions())
+        self.assertEqual(50, self.manager.list_partitions()[0].rows)
+
+
+class MeasurementPartitionTests(TestCase):
+
+    def setUp(self):
+        self.user = sample_user()
+        self.metric = Metric.objects.create(
+            name='Metric test', code='123', unit='meter', user=self.user)
+        self.net = Network.objects.create(
+            code="UW", name="University of Washington", user=self.user)
+        self.chan = Channel.objects.create(
+            code='EHZ', name="EHZ", station_code='RCM',
+            station_name='Camp Muir', loc="--", network=self.net,
+            lat=45, lon=-122, elev=0, user=self.user)
+        self.day = datetime(2021, 3, 1, tzinfo=pytz.UTC)
+        Measurement.objects.create(
+            metric=self.metric, channel=self.chan, value=1,
+            starttime=self.day + timedelta(hours=1),
+            endtime=self.day + timedelta(hours=2), user=self.user)
+        # the unpartitioned table stands in for a partition of that day
+        self.partition = Partition('measurement_measurement', self.day,
+                                   self.day + timedelta(days=1), 0, 0)
+
+    @patch('measurement.partitions.exported_metrics')
+    def test_verify_measurement_partition(self, exported_metrics):
+        exported_metrics.return_value = set()
+        reasons = verify_measurement_partition(self.partition)
+        self.assertEqual(2, len(reasons))
+
+        ArchiveDay.objects.create(
+            metric=self.metric, channel=self.chan, min=1, max=1, mean=1,
+            median=1, stdev=0, num_samps=1, p05=1, p10=1, p90=1, p95=1,
+            starttime=self.day + timedelta(hours=1),
+            endtime=self.day + timedelta(hours=2))
+        exported_metrics.return_value = {self.metric.id}
+        self.assertEqual([], verify_measurement_partition(self.partition))
+
+    def test_partitions_command_unpartitioned(self):
+        out = StringIO()
+        call_command('partitions', 'status', stdout=out)
+        self.assertIn('not partitioned', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('partitions', 'create', stdout=out)
+
+    def test_benchmark_index_profiles(self):
+        out = StringIO()
+        call_command('benchmark_index_profiles', '--rows=500', '--metrics=2',
+                     '--channels=5', '--batch=100', '--reads=2', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['cold', 'hot', 'legacy'],
+                         [line.split()[0] for line in lines[1:]])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass('benchmark_measurement_hot')")
+            self.assertIsNone(cursor.fetchone()[0])
+
+
+class AlertPartitionTests(TestCase):
+    fixtures = ['alarms.json']
+
+    def setUp(self):
+        # fixtures are loaded without Alert.save keeping latest_alert
+        Trigger.objects.update(latest_alert=Subquery(
+            Alert.objects.filter(trigger=OuterRef('pk')).order_by(
+                '-timestamp').values('id')[:1]))
+        start = datetime(2018, 2, 1, tzinfo=pytz.UTC)
+        # the unpartitioned table stands in for the month's partition
+        self.partition = Partition('measurement_alert', start,
+                                   datetime(2018, 3, 1, tzinfo=pytz.UTC),
+                                   0, 0)
+
+    def test_verify_alert_partition(self):
+        in_alarm = sorted(Trigger.objects.filter(
+            latest_alert__in_alarm=True).values_list('id', flat=True))
+        self.assertTrue(in_alarm)
+        reasons = verify_alert_partition(self.partition)
+        self.assertEqual(1, len(reasons))
+        self.assertIn(', '.join(str(trigger) for trigger in in_alarm),
+                      reasons[0])
+
+        Trigger.objects.update(latest_alert=None)
+        self.assertEqual([], verify_alert_partition(self.partition))
+
+    def test_clear_retired_alerts(self):
+        trigger = Trigger.objects.filter(latest_alert__isnull=False).first()
+        with connection.cursor() as cursor:
+            # as dropping its partition would
+            cursor.execute('DELETE FROM measurement_alert WHERE id = %s;',
+                           [trigger.latest_alert_id])
+        kept = Trigger.objects.filter(latest_alert__isnull=False).count()
+
+        clear_retired_alerts([self.partition])
+        trigger.refresh_from_db()
+        self.assertIsNone(trigger.latest_alert)
+        self.assertEqual(kept - 1, Trigger.objects.filter(
+            latest_alert__isnull=False).count())
+        self.assertTrue(Alert.objects.exists())
+
+    def test_partitions_command_alert(self):
+        out = StringIO()
+        call_command('partitions', 'status', '--table=alert', stdout=out)
+        self.assertIn('measurement_alert is not partitioned', out.getvalue())
@@ -0,0 +1,128 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.urls import reverse
+from io import StringIO
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from measurement.models import Alert, Monitor, Trigger
+from measurement.replay import MAX_STEPS, ReplayError, replay, replay_values
+from squac.test_mixins import sample_user
+
+from datetime import datetime, timedelta
+import numpy as np
+import pytz
+
+'''Tests for monitor replays:
+to run only this file
+    ./mg.sh "test measurement.tests.test_replay && flake8"
+'''
+
+
+class ReplayTests(TestCase):
+    fixtures = ['alarms.json']
+
+    START = datetime(2018, 2, 1, 2, 0, 0, 0, tzinfo=pytz.UTC)
+    END = datetime(2018, 2, 1, 7, 0, 0, 0, tzinfo=pytz.UTC)
+
+    def setUp(self):
+        self.user = sample_user()
+        self.user.is_staff = True
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.monitor = Monitor.objects.get(pk=1)
+
+    def steps(self, step=timedelta(minutes=20)):
+        n_steps = (self.END - self.START) // step + 1
+        return [self.START + i * step for i in range(n_steps)]
+
+    def test_values_match_evaluation(self):
+        '''Replayed stats are the ones evaluate_alarm would use'''
+        windows = [(Monitor.IntervalType.HOUR, 2),
+                   (Monitor.IntervalType.MINUTE, 45),
+                   (Monitor.IntervalType.LASTN, 2)]
+        ends = self.steps()
+        for interval_type, interval_count in windows:
+            self.monitor.interval_type = interval_type
+            self.monitor.interval_count = interval_count
+            for stat in Monitor.Stat.values:
+                self.monitor.stat = stat
+                channel_ids, values = replay_values(self.monitor, ends)
+                for end, replayed in zip(ends, values):
+                    channel_values = sorted(
+                        self.monitor.agg_measurements(end),
+                        key=lambda value: value['channel'])
+                    self.assertEqual(
+                        channel_ids,
+                        [value['channel'] for value in channel_values])
+                    np.testing.assert_allclose(
+                        self.monitor.stat_values(channel_values), replayed,
+                        err_msg=f'{interval_type} {stat} at {end}')
+
+    def test_replay_candidates(self):
+        '''Candidate triggers are replayed without writing alerts'''
+        alerts = Alert.objects.count()
+        triggers = [
+            Trigger(monitor=self.monitor, val1=3, num_channels=0),
+            Trigger(monitor=self.monitor, val1=100,
+                    num_channels_operator=Trigger.NumChannelsOperator.ANY),
+        ]
+        result = replay(self.monitor, self.START, self.END, triggers=triggers)
+        self.assertEqual(alerts, Alert.objects.count())
+        self.assertEqual(3, result['channels'])
+
+        low, high = result['triggers']
+        self.assertEqual(6, len(low['timeline']))
+        self.assertGreater(low['in_alarm_steps'], 0)
+        # fires once when entering alarm
+        fired = [step for step in low['timeline'] if step['fired']]
+        self.assertEqual(1, low['alerts'])
+        self.assertTrue(fired[0]['in_alarm'])
+        self.assertEqual(0, high['in_alarm_steps'])
+        self.assertEqual(0, high['alerts'])
+
+        with self.assertRaises(ReplayError):
+            replay(self.monitor, self.START,
+                   self.START + timedelta(hours=MAX_STEPS))
+
+    def test_replay_endpoint(self):
+        url = reverse('measurement:monitor-replay',
+                      kwargs={'pk': self.monitor.pk})
+        res = self.client.post(url, {
+            'starttime': self.START, 'endtime': self.END,
+            'triggers': [{'val1': 3, 'num_channels': 0}],
+        }, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, len(res.data['triggers']))
+        self.assertIsNone(res.data['triggers'][0]['trigger'])
+
+        # the monitor's own triggers by default
+        res = self.client.post(url, {
+            'starttime': self.START, 'endtime': self.END}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(self.monitor.triggers.values_list('id', flat=True)),
+            sorted(trigger['trigger'] for trigger in res.data['triggers']))
+
+        # invalid candidate
+        res = self.client.post(url, {
+            'starttime': self.START, 'endtime': self.END,
+            'triggers': [{'val1': 3}]}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.post(url, {
+            'starttime': self.END, 'endtime': self.START}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_replay_command(self):
+        out = StringIO()
+        call_command('replay_monitor', str(self.monitor.pk),
+                     '--start_date=2018-02-01', '--end_date=2018-02-02',
+                     '--trigger={"val1": 3, "num_channels": 0}', stdout=out)
+        self.assertIn('1 alert(s)', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('replay_monitor', str(self.monitor.pk),
+                         '--start_date=2018-02-01', '--end_date=2018-02-02',
+                         '--trigger={"val1": 3}', stdout=out)
@@ -0,0 +1,129 @@
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase
+from io import StringIO
+from unittest.mock import patch
+
+from measurement import restore
+from measurement.export import ExportTask, export_days, read_manifest
+from measurement.models import Measurement
+from measurement.partitions import PartitionManager, measurement_partitions
+from measurement.restore import restore_days
+from measurement.tests.test_export import ExportMixin
+
+from datetime import datetime, timedelta
+import pytz
+
+'''Tests for restoring exported measurements:
+to run only this file
+    ./mg.sh "test measurement.tests.test_restore && flake8"
+'''
+
+
+class RestoreTests(ExportMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.days = [self.DAY, self.DAY + timedelta(days=1)]
+        export_days(self.storage, self.days)
+        self.values = sorted(Measurement.objects.values_list(
+            'id', 'metric', 'channel', 'value', 'starttime', 'endtime'))
+
+    def test_restore_command(self):
+        Measurement.objects.all().delete()
+        out = StringIO()
+        call_command('restore_measurements', '--start_date=2021-03-01',
+                     '--end_date=2021-03-02', f'--storage={self.tmpdir.name}',
+                     '--workers=1', stdout=out)
+        self.assertIn('Restored 2 day(s), 97 rows', out.getvalue())
+        self.assertEqual(self.values, sorted(Measurement.objects.values_list(
+            'id', 'metric', 'channel', 'value', 'starttime', 'endtime')))
+
+        # restored ids don't collide with new measurements
+        Measurement.objects.create(
+            metric=self.metrics[0], channel=self.chans[0], value=1,
+            starttime=datetime(2021, 3, 11, tzinfo=pytz.UTC),
+            endtime=datetime(2021, 3, 12, tzinfo=pytz.UTC), user=self.user)
+
+    def test_merge_only_missing(self):
+        Measurement.objects.filter(metric=self.metrics[1]).delete()
+        results, errors = restore_days(self.storage, measurement_partitions(),
+                                       self.days)
+        self.assertEqual([], errors)
+        self.assertEqual([(49, 1), (48, 0)],
+                         [(r.rows, r.merged) for r in results])
+        self.assertEqual(97, Measurement.objects.count())
+
+    def test_failed_file_is_not_merged(self):
+        Measurement.objects.all().delete()
+        manifest = read_manifest(self.storage, self.DAY)
+        self.storage.write(manifest['files'][0]['path'], b'garbage')
+
+        results, errors = restore_days(
+            self.storage, measurement_partitions(), [self.DAY],
+            report=lambda *args: None)
+        self.assertEqual(1, len(errors))
+        self.assertEqual([], results)
+        self.assertEqual(0, Measurement.objects.count())
+
+    def test_failed_merge_is_reported(self):
+        Measurement.objects.all().delete()
+        merge = restore.merge_staging
+
+        def merge_staging(manager, day):
+            if day == self.DAY:
+                raise DatabaseError('merge failed')
+            return merge(manager, day)
+
+        reported = []
+        with patch('measurement.restore.merge_staging',
+                   side_effect=merge_staging):
+            results, errors = restore_days(
+                self.storage, measurement_partitions(), self.days,
+                report=lambda task, *args: reported.append(task))
+        # the other day is still restored
+        self.assertEqual([self.DAY + timedelta(days=1)],
+                         [r.day for r in results])
+        self.assertEqual([(self.DAY, None)], [task for task, _ in errors])
+        self.assertIn(ExportTask(self.DAY, None), reported)
+        self.assertEqual(48, Measurement.objects.count())
+
+    def test_swap_into_partition(self):
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                CREATE TABLE test_restore (
+                    LIKE measurement_measurement INCLUDING DEFAULTS,
+                    UNIQUE (metric_id, channel_id, starttime)
+                ) PARTITION BY RANGE(starttime);''')
+        manager = PartitionManager('test_restore', 'day')
+
+        results, errors = restore_days(self.storage, manager, self.days,
+                                       swap=True)
+        self.assertEqual([], errors)
+        self.assertEqual([True, True], [r.swapped for r in results])
+        self.assertEqual(
+            ['test_restore_2021_03_01', 'test_restore_2021_03_02'],
+            [p.name for p in manager.list_partitions()])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM test_restore;')
+            self.assertEqual(97, cursor.fetchone()[0])
+
+        # partitions aren't empty anymore, so the second time is a merge
+        results, errors = restore_days(self.storage, manager, [self.DAY],
+                                       swap=True)
+        self.assertEqual([(False, 0)],
+                         [(r.swapped, r.merged) for r in results])
+
+
+class ParallelRestoreTests(ExportMixin, TransactionTestCase):
+    ''' worker threads use their own connections, so data must be committed '''
+
+    def test_restore_with_workers(self):
+        days = [self.DAY, self.DAY + timedelta(days=1)]
+        export_days(self.storage, days)
+        Measurement.objects.all().delete()
+
+        results, errors = restore_days(self.storage, measurement_partitions(),
+                                       days, workers=3)
+        self.assertEqual([], errors)
+        self.assertEqual(97, Measurement.objects.count())
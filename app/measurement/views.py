@@ -8,7 +8,9 @@ from rest_framework.response import Response
 from django_filters import rest_framework as filters
 from squac.filters import CharInFilter, NumberInFilter
 from measurement.aggregates.percentile import Percentile
-from django.db.models import Avg, StdDev, Min, Max, Sum, Count, FloatField
+from django.db.models import (Avg, StdDev, Min, Max, Sum, Count, FloatField,
+                              Prefetch)
+from django.db import transaction
 from django.db.models.functions import Coalesce, Abs
 from squac.mixins import (SetUserMixin, DefaultPermissionsMixin,
                           OverrideParamsMixin, OverrideReadParamsMixin,
@@ -16,14 +18,19 @@ from squac.mixins import (SetUserMixin, DefaultPermissionsMixin,
 from .exceptions import MissingParameterException
 from .models import (Metric, Measurement,
                      Alert, ArchiveDay, ArchiveWeek, ArchiveMonth,
-                     ArchiveHour, Monitor, Trigger)
+                     ArchiveHour, Monitor, MonitorState, Trigger)
 from measurement import serializers
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 from measurement.params import measurement_params
+from measurement.replay import ReplayError, replay
 from squac.mixins import EnablePartialUpdateMixin
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.decorators import action
+from rest_framework.exceptions import (NotFound, PermissionDenied,
+                                       ValidationError)
+
+from datetime import timedelta
 
 
 def check_measurement_params(params):
@@ -187,7 +194,11 @@ class MonitorViewSet(MonitorBaseViewSet, EnablePartialUpdateMixin):
     filter_class = MonitorFilter
 
     def get_queryset(self):
-        queryset = Monitor.objects.all()
+        # triggers' latest alerts are serialized with the monitor
+        queryset = Monitor.objects.select_related(
+            'channel_group', 'metric').prefetch_related(Prefetch(
+                'triggers',
+                queryset=Trigger.objects.select_related('latest_alert')))
         if self.request.user.is_staff:
             return queryset
         return queryset.filter(user=self.request.user)
@@ -197,6 +208,85 @@ class MonitorViewSet(MonitorBaseViewSet, EnablePartialUpdateMixin):
             return serializers.MonitorDetailSerializer
         return self.serializer_class
 
+    @swagger_auto_schema(
+        request_body=serializers.ReplaySerializer,
+        operation_description="Evaluate the monitor with its own or "
+                              "candidate triggers over a past range, "
+                              "without creating alerts")
+    @action(detail=True, methods=['post'],
+            serializer_class=serializers.ReplaySerializer)
+    def replay(self, request, pk=None):
+        monitor = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        triggers = None
+        if 'triggers' in params:
+            triggers = [Trigger(monitor=monitor, **definition)
+                        for definition in params['triggers']]
+        try:
+            result = replay(monitor, params['starttime'], params['endtime'],
+                            triggers=triggers,
+                            step=timedelta(seconds=params['step']))
+        except ReplayError as e:
+            raise ValidationError({'detail': str(e)})
+        return Response(result)
+
+    @swagger_auto_schema(
+        request_body=serializers.BulkMonitorSerializer(many=True),
+        operation_description="Create or update monitors with their "
+                              "triggers in one request",
+        responses={
+            200: openapi.Response(
+                "updated monitors, when none was created",
+                serializers.MonitorDetailSerializer(many=True)),
+            201: openapi.Response(
+                "saved monitors",
+                serializers.MonitorDetailSerializer(many=True))})
+    @action(detail=False, methods=['post'],
+            serializer_class=serializers.BulkMonitorSerializer)
+    def bulk(self, request):
+        context = self.get_serializer_context()
+        context['monitors'] = self.get_queryset()
+        serializer = self.get_serializer(data=request.data, many=True,
+                                         context=context)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+        triggers = [trigger for item in items
+                    for trigger in item.get('triggers', [])]
+        # POST only checks add_monitor, updates need their own permissions
+        perms = set()
+        if any('id' in item for item in items):
+            perms.add('measurement.change_monitor')
+        if any('id' in trigger for trigger in triggers):
+            perms.add('measurement.change_trigger')
+        if any('id' not in trigger for trigger in triggers):
+            perms.add('measurement.add_trigger')
+        if not request.user.is_staff and not request.user.has_perms(perms):
+            raise PermissionDenied()
+        with transaction.atomic():
+            monitors = serializer.save(user=request.user)
+        saved = self.get_queryset().filter(
+            id__in=[monitor.id for monitor in monitors])
+        created = any('id' not in item for item in items)
+        return Response(
+            serializers.MonitorDetailSerializer(saved, many=True).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    @swagger_auto_schema(
+        operation_description="Per channel values and breached triggers "
+                              "of the monitor's last evaluation")
+    @action(detail=True, methods=['get'], url_path='status',
+            url_name='status')
+    def live_status(self, request, pk=None):
+        monitor = self.get_object()
+        try:
+            state = MonitorState.objects.get(monitor=monitor)
+        except MonitorState.DoesNotExist:
+            raise NotFound('Monitor has not been evaluated yet')
+        state.monitor = monitor
+        return Response(state.status())
+
 
 class TriggerViewSet(MonitorBaseViewSet,
                      EnablePartialUpdateMixin):
@@ -204,7 +294,7 @@ class TriggerViewSet(MonitorBaseViewSet,
     filter_class = TriggerFilter
 
     def get_queryset(self):
-        queryset = Trigger.objects.all()
+        queryset = Trigger.objects.select_related('latest_alert')
         if self.request.user.is_staff:
             return queryset
         return queryset.filter(user=self.request.user)
@@ -259,7 +349,8 @@ class AlertViewSet(MonitorBaseViewSet):
     filter_class = AlertFilter
 
     def get_queryset(self):
-        queryset = Alert.objects.all().order_by('-timestamp')
+        queryset = Alert.objects.select_related(
+            'trigger__monitor').order_by('-timestamp')
         if self.request.user.is_staff:
             return queryset
         return queryset.filter(user=self.request.user)
@@ -269,6 +360,22 @@ class AlertViewSet(MonitorBaseViewSet):
             return serializers.AlertDetailSerializer
         return self.serializer_class
 
+    def list(self, request, *args, **kwargs):
+        '''alerts stored as changes get their breaching channels back'''
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        alerts = Alert.fill_breaching_channels(
+            list(page if page is not None else queryset))
+        serializer = self.get_serializer(alerts, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        alert = self.get_object()
+        Alert.fill_breaching_channels([alert])
+        return Response(self.get_serializer(alert).data)
+
 
 class ArchiveHourViewSet(ArchiveBaseViewSet):
     serializer_class = serializers.ArchiveHourSerializer
@@ -99,6 +99,16 @@ class Channel(Nslc):
             self.station_code + "." + \
             self.loc + "." + self.code
 
+    @classmethod
+    def nslc_map(cls, channel_ids):
+        '''Return {id: str(channel)} for channel_ids, in a single query'''
+        return {
+            id: f'{net}.{sta}.{loc}.{cha}'.upper()
+            for id, net, sta, loc, cha in cls.objects.filter(
+                id__in=channel_ids).values_list(
+                'id', 'network_id', 'station_code', 'loc', 'code')
+        }
+
 
 class Group(models.Model):
     user = models.ForeignKey(
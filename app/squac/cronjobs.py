@@ -10,7 +10,17 @@ PRODUCTION_CRONJOBS = [  # noqa
         ['update_auto_channels']),
     ('0 20 * * *', 'django.core.management.call_command',
         ['create_table_partition']),
-    ('5 * * * *', 'django.core.management.call_command', ['evaluate_alarms']),
+    ('30 20 * * *', 'django.core.management.call_command',
+        ['partitions', 'retire']),
+    ('45 20 * * *', 'django.core.management.call_command',
+        ['partitions', 'indexes']),
+    ('5 20 * * *', 'django.core.management.call_command',
+        ['partitions', 'create', '--table=alert', '--horizon=3']),
+    ('35 20 * * *', 'django.core.management.call_command',
+        ['partitions', 'retire', '--table=alert']),
+    ('* * * * *', 'django.core.management.call_command',
+        ['evaluate_due_monitors', '--workers=4']),
+    ('* * * * *', 'django.core.management.call_command', ['dispatch_email']),
     ('0 5 * * *', 'django.core.management.call_command', ['s3_query_export']),
     ('0 6 1,10 * *', 'django.core.management.call_command',
         ['archive_measurements', 'month']),
@@ -24,7 +34,9 @@ STAGING_CRONJOBS = [  # noqa
     ('0 10 * * *', 'django.core.management.call_command', ['load_from_fdsn']),
     ('30 10 * * *', 'django.core.management.call_command',
         ['update_auto_channels']),
-    ('5 * * * *', 'django.core.management.call_command', ['evaluate_alarms']),
+    ('* * * * *', 'django.core.management.call_command',
+        ['evaluate_due_monitors', '--workers=4']),
+    ('* * * * *', 'django.core.management.call_command', ['dispatch_email']),
     ('0 6 1,10 * *', 'django.core.management.call_command',
         ['archive_measurements', 'month']),
     ('0 7 * * 1', 'django.core.management.call_command',
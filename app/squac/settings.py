@@ -225,6 +225,13 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_ADMIN = os.environ.get('EMAIL_ADMIN')
 EMAIL_USE_SSL = os.environ.get('EMAIL_USE_SSL')
 DEFAULT_FROM_EMAIL = EMAIL_NO_REPLY
+# queue emails in the outbox table, sent by dispatch_email, rather than
+# sending them while evaluating alarms or handling requests
+EMAIL_OUTBOX = os.environ.get('SQUAC_EMAIL_OUTBOX') == 'True'
+# emails sent per second at most, and attempts before giving up on one
+EMAIL_OUTBOX_RATE = float(os.environ.get('SQUAC_EMAIL_OUTBOX_RATE', 5))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(
+    os.environ.get('SQUAC_EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
 SERVER_EMAIL = EMAIL_NO_REPLY
 
 
@@ -278,6 +285,74 @@ AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
 AWS_SNS_ADMIN_ARN = os.environ.get('AWS_SNS_ADMIN_ARN')
 SQUAC_MEASUREMENTS_BUCKET = os.environ.get('SQUAC_MEASUREMENTS_BUCKET')
 
+# where export_measurements writes to: a local directory (path or file://) or
+# s3://bucket/prefix
+MEASUREMENT_EXPORT_STORAGE = os.environ.get(
+    'SQUAC_MEASUREMENT_EXPORT_STORAGE',
+    f's3://{SQUAC_MEASUREMENTS_BUCKET}' if SQUAC_MEASUREMENTS_BUCKET else '')
+
+# measurement partitions older than this are detached and dropped once they
+# have been archived and exported. 0 keeps them forever
+MEASUREMENT_RETENTION_DAYS = int(
+    os.environ.get('SQUAC_MEASUREMENT_RETENTION_DAYS', 0))
+
+# alert partitions (by month) older than this are detached and dropped,
+# unless they hold the latest alert of a trigger in alarm. 0 keeps them
+ALERT_RETENTION_DAYS = int(os.environ.get('SQUAC_ALERT_RETENTION_DAYS', 0))
+
+# index profile of a measurement partition by age in days, see
+# measurement.partitions.MEASUREMENT_INDEX_PROFILES. cold adds a BRIN for
+# exports, it doesn't shrink partitions: all keep the covering unique index
+MEASUREMENT_INDEX_POLICY = [
+    (0, 'hot'),
+    (int(os.environ.get('SQUAC_MEASUREMENT_COLD_AFTER_DAYS', 7)), 'cold'),
+]
+
+# evaluate_alarms: seconds after which monitors not evaluated yet are skipped,
+# so a run finishes before the next one starts, and days of timings kept
+MONITOR_EVALUATION_DEADLINE = int(
+    os.environ.get('SQUAC_MONITOR_EVALUATION_DEADLINE', 50 * 60))
+MONITOR_EVALUATION_RETENTION_DAYS = int(
+    os.environ.get('SQUAC_MONITOR_EVALUATION_RETENTION_DAYS', 30))
+
+# evaluate_due_monitors: shortest time between evaluations of a monitor, in
+# seconds, whatever its metric's sample_rate
+MONITOR_SCHEDULE_MIN_PERIOD = int(
+    os.environ.get('SQUAC_MONITOR_SCHEDULE_MIN_PERIOD', 60))
+
+# monitors read the days of their window from day archives (see
+# Monitor.aggregate_archived) once the archives were written this many hours
+# after the day ended, leaving time for late measurements
+MONITOR_ARCHIVE_SETTLE_HOURS = int(
+    os.environ.get('SQUAC_MONITOR_ARCHIVE_SETTLE_HOURS', 4))
+
+# monitors with groups of at least this many channels have the database
+# return only their breaching channels (see Monitor.aggregate_breaching),
+# rather than the aggregates of every channel. Their evaluations can't be
+# reused. 0 is off
+MONITOR_SQL_BREACHES_MIN_CHANNELS = int(
+    os.environ.get('SQUAC_MONITOR_SQL_BREACHES_MIN_CHANNELS', 0))
+
+# alerts are stored as changes from the previous alert, with a snapshot of
+# all breaching channels at least every this many alerts of a trigger
+ALERT_SNAPSHOT_EVERY = int(os.environ.get('SQUAC_ALERT_SNAPSHOT_EVERY', 24))
+
+# ingest only moves a metric's last_ingested_at watermark once it is this
+# many seconds old, so concurrent ingests of a metric rarely wait on its row.
+# Evaluations this close to the watermark aren't reused
+MONITOR_WATERMARK_RESOLUTION = int(
+    os.environ.get('SQUAC_MONITOR_WATERMARK_RESOLUTION', 60))
+
+# incremental evaluation: ingest marks (metric, channel) series dirty and
+# evaluate_dirty_monitors re-evaluates the monitors using them once a series
+# has been quiet for the debounce period, or marked for max delay, in seconds
+MONITOR_INCREMENTAL_EVALUATION = os.environ.get(
+    'SQUAC_MONITOR_INCREMENTAL_EVALUATION') == 'True'
+MONITOR_INCREMENTAL_DEBOUNCE = int(
+    os.environ.get('SQUAC_MONITOR_INCREMENTAL_DEBOUNCE', 60))
+MONITOR_INCREMENTAL_MAX_DELAY = int(
+    os.environ.get('SQUAC_MONITOR_INCREMENTAL_MAX_DELAY', 300))
+
 MANAGERS = ADMINS
 
 LOGGING = {
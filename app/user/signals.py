@@ -1,9 +1,10 @@
-from django.core.mail import EmailMultiAlternatives
 from django.dispatch import receiver
 from django.template.loader import render_to_string
 
 from django_rest_passwordreset.signals import reset_password_token_created
 
+from core.mail import queue_mail
+
 
 @receiver(reset_password_token_created)
 def password_reset_token_created(sender, instance, reset_password_token,
@@ -42,7 +43,7 @@ def password_reset_token_created(sender, instance, reset_password_token,
     email_plaintext_message = render_to_string(
         'email/user_reset_password.txt', context)
 
-    msg = EmailMultiAlternatives(
+    queue_mail(
         # title:
         "Password Reset for {title}".format(title="SQUAC"),
         # message:
@@ -50,7 +51,6 @@ def password_reset_token_created(sender, instance, reset_password_token,
         # from:
         "pnsn_web@uw.org",
         # to:
-        [reset_password_token.user.email]
+        [reset_password_token.user.email],
+        html_message=email_html_message
     )
-    msg.attach_alternative(email_html_message, "text/html")
-    msg.send()
@@ -0,0 +1,107 @@
+--
+-- Convert measurement_alert into a table partitioned by month on timestamp.
+--
+-- Run once, after migrating to measurement 0072 (which drops the foreign
+-- keys referencing alerts, a partitioned table can't be referenced by id
+-- alone) and while nothing writes alerts:
+--   psql -v ON_ERROR_STOP=1 -f sql/alert.sql
+--
+-- Partitions are created for every month with alerts up to 3 months ahead.
+-- After that `partitions create --table=alert` keeps them ahead and
+-- `partitions retire --table=alert` applies settings.ALERT_RETENTION_DAYS.
+--
+
+SET TIME ZONE 'UTC';
+
+BEGIN;
+
+ALTER TABLE public.measurement_alert RENAME TO measurement_alert_old;
+ALTER TABLE public.measurement_alert_old
+    RENAME CONSTRAINT measurement_alert_pkey TO measurement_alert_old_pkey;
+
+-- the primary key of a partitioned table has to include the partition key
+CREATE TABLE public.measurement_alert (
+    LIKE public.measurement_alert_old INCLUDING DEFAULTS,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+ALTER TABLE public.measurement_alert OWNER TO deploy;
+
+-- keep the id sequence. Tables created by newer Django versions use an
+-- identity column, whose sequence can't change tables
+DO $$
+BEGIN
+    IF (SELECT attidentity <> '' FROM pg_attribute
+        WHERE attrelid = 'public.measurement_alert_old'::regclass
+          AND attname = 'id') THEN
+        ALTER TABLE public.measurement_alert
+            ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+        PERFORM setval(pg_get_serial_sequence('public.measurement_alert', 'id'),
+                       (SELECT coalesce(max(id), 0) + 1
+                        FROM public.measurement_alert_old), false);
+    ELSE
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY public.measurement_alert.id',
+                       pg_get_serial_sequence('public.measurement_alert_old',
+                                              'id'));
+    END IF;
+END $$;
+
+-- monthly partitions, named like measurement.partitions.PartitionManager
+DO $$
+DECLARE
+    month timestamptz;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', coalesce(min(timestamp), now())),
+            date_trunc('month', now()) + interval '3 months',
+            interval '1 month')
+        FROM public.measurement_alert_old
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE public.%I PARTITION OF public.measurement_alert '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'measurement_alert_' || to_char(month, 'YYYY_MM'),
+            month, month + interval '1 month');
+    END LOOP;
+END $$;
+
+INSERT INTO public.measurement_alert SELECT * FROM public.measurement_alert_old;
+
+-- move the indexes and foreign keys over, under the names Django knows
+CREATE TEMPORARY TABLE alert_definitions ON COMMIT DROP AS
+    SELECT 'index' AS kind, indexname AS name, indexdef AS definition
+    FROM pg_indexes
+    WHERE schemaname = 'public' AND tablename = 'measurement_alert_old'
+      AND indexname <> 'measurement_alert_old_pkey'
+      -- unique constraints bring their own index
+      AND indexname NOT IN (
+          SELECT conname FROM pg_constraint
+          WHERE conrelid = 'public.measurement_alert_old'::regclass
+            AND contype = 'u')
+    UNION ALL
+    SELECT 'constraint', conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = 'public.measurement_alert_old'::regclass
+      AND contype IN ('f', 'u');
+
+DROP TABLE public.measurement_alert_old;
+
+DO $$
+DECLARE
+    item record;
+BEGIN
+    FOR item IN SELECT * FROM alert_definitions LOOP
+        IF item.kind = 'index' THEN
+            EXECUTE replace(item.definition, 'measurement_alert_old',
+                            'measurement_alert');
+        ELSE
+            EXECUTE format('ALTER TABLE public.measurement_alert '
+                           'ADD CONSTRAINT %I %s', item.name, item.definition);
+        END IF;
+    END LOOP;
+END $$;
+
+COMMIT;
+
+ANALYZE public.measurement_alert;